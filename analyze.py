@@ -1,17 +1,28 @@
+import argparse
 import os
 import re
+import time
 
 import pandas as pd
 import glob
-from openpyxl import load_workbook
 from datetime import datetime
 import plotly.express as px
 import logging
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
 import numpy as np
-import time
-import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import artifact_store
+import delta_store
+import duplicates
+import excel_readers
+import ingest_cache
+import normalization
+import profiling
+import schema
+import transfers
+import warehouses
 
 # === НАСТРОЙКА ЛОГИРОВАНИЯ ===
 os.makedirs("логи", exist_ok=True)
@@ -21,20 +32,7 @@ logging.basicConfig(
     format='%(asctime)s — %(levelname)s — %(message)s'
 )
 
-def timing_decorator(func):
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        start = time.time()
-        result = func(*args, **kwargs)
-        end = time.time()
-        duration = end - start
-        msg = f"Время выполнения функции '{func.__name__}': {duration:.3f} секунд"
-        print(msg)
-        logging.info(msg)
-        return result
-    return wrapper
-
-@timing_decorator
+@profiling.counted
 def parse_date_from_cell(cell_value, file_path):
     """
     Безопасно парсит дату из значения ячейки.
@@ -55,98 +53,223 @@ def parse_date_from_cell(cell_value, file_path):
         logging.info(f'Дата из файла {file_path}: "{date_str}" распознана как {date}')
     return date
 
-@timing_decorator
-def read_excel_file(file_path, sklad_name):
-    extension = os.path.splitext(file_path)[1].lower()
-    data = []
+# Увеличивать при любом изменении результата разбора — закэшированные снимки будут сброшены
+PARSER_VERSION = 1
 
-    try:
-        if extension == '.xls':
-            df_raw = pd.read_excel(file_path, header=None, engine='xlrd')
-            date_cell = df_raw.iloc[1, 0]
-            date = parse_date_from_cell(date_cell, file_path)
-
-            for idx in range(4, len(df_raw)):
-                row = df_raw.iloc[idx]
-                if pd.isna(row[5]):
-                    continue
-                data.append({
-                    'Дата': date,
-                    'Номенклатура': row[1],
-                    'Количество': row[2] or 0,
-                    'Цена': row[3] or 0,
-                    'Производитель': row[4],
-                    'Артикул': str(row[5]).strip(),
-                    'Склад': sklad_name
-                })
-
-        elif extension == '.xlsx':
-            wb = load_workbook(filename=file_path, data_only=True)
-            ws = wb.active
-            date_cell = ws['A2'].value
-            date = parse_date_from_cell(date_cell, file_path)
-
-            for i in range(5, ws.max_row + 1):
-                article = ws[f'F{i}'].value
-                if article is None:
-                    continue
-                data.append({
-                    'Дата': date,
-                    'Номенклатура': ws[f'B{i}'].value,
-                    'Количество': ws[f'C{i}'].value or 0,
-                    'Цена': ws[f'D{i}'].value or 0,
-                    'Производитель': ws[f'E{i}'].value,
-                    'Артикул': str(article).strip(),
-                    'Склад': sklad_name
-                })
 
-        logging.info(f'Успешно прочитан файл: {file_path}')
-        return pd.DataFrame(data)
+def _parse_excel_file(file_path, sklad_name, engine=None, layout=excel_readers.DEFAULT_LAYOUT):
+    """Разбирает один снимок в DataFrame; исключения пробрасываются наружу."""
+    date_cell, columns = excel_readers.read_columns(file_path, engine=engine, layout=layout)
+    date = parse_date_from_cell(date_cell, file_path)
+
+    df = pd.DataFrame(columns)
+    df = df[df['Артикул'].notna()]
+    if df.empty:
+        return df
 
+    df['Количество'] = pd.to_numeric(df['Количество'], errors='coerce').fillna(0)
+    df['Цена'] = pd.to_numeric(df['Цена'], errors='coerce').fillna(0)
+    df['Артикул'] = df['Артикул'].astype(str).str.strip()
+    for col in ['Номенклатура', 'Производитель']:
+        # Числа в текстовых колонках приводим к строкам, чтобы колонка была однородной
+        filled = df[col].notna()
+        df.loc[filled, col] = df.loc[filled, col].astype(str)
+    df.insert(0, 'Дата', date)
+    df['Склад'] = sklad_name
+    df = df[['Дата', 'Номенклатура', 'Количество', 'Цена', 'Производитель', 'Артикул', 'Склад']]
+    return df.reset_index(drop=True)
+
+
+@profiling.traced
+def read_excel_file(file_path, sklad_name, engine=None, layout=excel_readers.DEFAULT_LAYOUT):
+    try:
+        df = _parse_excel_file(file_path, sklad_name, engine, layout)
+        logging.info(f'Успешно прочитан файл: {file_path}')
+        return df
     except Exception as e:
         logging.error(f'Ошибка при чтении файла {file_path}: {e}')
         return None
-@timing_decorator
-def process_folder(folder_path, sklad_name):
-    files = sorted(glob.glob(os.path.join(folder_path, '*.xls*')))
-    dfs = []
-    for file in files:
-        df = read_excel_file(file, sklad_name)
-        if df is not None and not df.empty:
-            dfs.append(df)
+
+
+def _ingest_task(task):
+    """
+    Задача для пула процессов: возвращает (DataFrame, None, замеры) или (None, текст ошибки, замеры).
+    Замеры времени возвращаются вызывающему, так как профиль пишет только основной процесс.
+    """
+    file_path, sklad_name, layout, engine = task
+    ts, wall, cpu = time.time(), time.perf_counter(), time.process_time()
+    try:
+        df, error = _parse_excel_file(file_path, sklad_name, engine, layout), None
+    except Exception as e:
+        df, error = None, f'{type(e).__name__}: {e}'
+    stats = {
+        'ts': ts,
+        'wall': time.perf_counter() - wall,
+        'cpu': time.process_time() - cpu,
+        'pid': os.getpid(),
+        'aggregates': profiling.take_worker_aggregates(),
+    }
+    return df, error, stats
+
+
+def list_snapshot_files(folder_path):
+    # ~$имя.xlsx — файлы блокировки открытой в Excel книги, а не снимки
+    return sorted(path for path in glob.glob(os.path.join(folder_path, '*.xls*'))
+                  if not os.path.basename(path).startswith('~$'))
+
+
+def _parse_tasks(pool_tasks, jobs):
+    if not jobs or jobs < 1:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, len(pool_tasks)) if pool_tasks else 1
+
+    if jobs == 1:
+        return [_ingest_task(task) for task in pool_tasks]
+    chunksize = max(1, len(pool_tasks) // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=profiling.init_worker) as executor:
+        return list(executor.map(_ingest_task, pool_tasks, chunksize=chunksize))
+
+
+@profiling.traced
+def ingest_files(tasks, jobs=1, engine=None, use_cache=True, with_paths=False):
+    """
+    Читает файлы (список задач (путь, склад, раскладка)) последовательно или в пуле процессов.
+    С use_cache разбираются только новые и изменённые файлы, остальные берутся из кэша.
+    Порядок результатов совпадает с порядком tasks.
+    Возвращает (список непустых DataFrame, список ошибок (путь, текст));
+    с with_paths вместо DataFrame — пары (путь, DataFrame).
+    """
+    results = [None] * len(tasks)
+    manifest = ingest_cache.load_manifest(PARSER_VERSION) if use_cache else None
+    if manifest is not None:
+        for i, (path, sklad, layout) in enumerate(tasks):
+            cached = ingest_cache.lookup(manifest, path, sklad, warehouses.layout_key(layout))
+            if cached is not None:
+                results[i] = (cached, None)
+                profiling.add_event('файл', time.time(), 0, 0, {'Склад': sklad, 'путь': path,
+                                                                'кэш': True, 'rows_out': len(cached)})
+
+    pending = [i for i, result in enumerate(results) if result is None]
+    if manifest is not None:
+        logging.info(f'Кэш снимков: {len(tasks) - len(pending)} из кэша, {len(pending)} к разбору')
+
+    parsed = _parse_tasks([(*tasks[i], engine) for i in pending], jobs)
+    for i, (df, error, stats) in zip(pending, parsed):
+        results[i] = (df, error)
+        profiling.merge_aggregates(stats['aggregates'])
+        profiling.add_event('файл', stats['ts'], stats['wall'], stats['cpu'], {
+            'Склад': tasks[i][1], 'путь': tasks[i][0], 'ошибка': error,
+            'rows_out': len(df) if df is not None else None,
+        }, pid=stats['pid'])
+        if manifest is not None and error is None:
+            try:
+                ingest_cache.store(manifest, tasks[i][0], tasks[i][1], df, warehouses.layout_key(tasks[i][2]))
+            except Exception as e:
+                logging.warning(f'Не удалось сохранить в кэш файл {tasks[i][0]}: {e}')
+    if manifest is not None:
+        ingest_cache.save_manifest(manifest)
+
+    dfs, errors = [], []
+    for (path, _, _), (df, error) in zip(tasks, results):
+        if error is not None:
+            logging.error(f'Ошибка при чтении файла {path}: {error}')
+            errors.append((path, error))
+            continue
+        if not df.empty:
+            dfs.append((path, df) if with_paths else df)
+
+    if errors:
+        logging.warning(f'Не удалось прочитать файлов: {len(errors)} из {len(tasks)}')
+    return dfs, errors
+
+
+def snapshot_tasks(registry=None):
+    """Задачи чтения (путь, склад, раскладка) по всем складам реестра (по умолчанию — warehouses.json)."""
+    return warehouses.snapshot_tasks(registry or warehouses.load_warehouses(), list_snapshot_files)
+
+
+@profiling.traced
+def process_folders(registry=None, jobs=1, engine=None, use_cache=True):
+    """
+    Читает снимки всех складов реестра одним пулом: файлы разных складов разбираются
+    параллельно, поэтому время растёт с числом файлов, а не с числом складов.
+    Все файлы объединяются одним concat в конце.
+    """
+    registry = registry or warehouses.load_warehouses()
+    dfs, _ = ingest_files(snapshot_tasks(registry), jobs=jobs, engine=engine, use_cache=use_cache)
     if not dfs:
-        logging.warning(f'Нет данных в папке: {folder_path}')
+        logging.warning(f'Нет данных в папках: {", ".join(w["folder"] for w in registry)}')
         return None
     return pd.concat(dfs, ignore_index=True)
-@timing_decorator
-def generate_daily_sales_file(df_all: pd.DataFrame, output_path: str = 'итог_дневные_продажи.csv'):
+
+
+def read_snapshots(tasks, jobs=1, engine=None, use_cache=True):
+    """Читает и подготавливает снимки задач одним пулом: (DataFrame или None, список ошибок)."""
+    dfs, errors = ingest_files(tasks, jobs=jobs, engine=engine, use_cache=use_cache)
+    if not dfs:
+        return None, errors
+    return prepare_snapshots(pd.concat(dfs, ignore_index=True)), errors
+
+
+@profiling.traced
+def load_deltas(registry=None, jobs=1, engine=None, use_cache=True):
+    """
+    Обновляет хранилище дельт снимков (читаются только новые файлы) и возвращает
+    (дельты, календарь, пары (Номенклатура, Артикул)) или None, если данных нет.
+    Без use_cache хранилище пересобирается заново.
+    """
+    return delta_store.update(
+        snapshot_tasks(registry),
+        lambda tasks: read_snapshots(tasks, jobs=jobs, engine=engine, use_cache=use_cache),
+        versions={'parser': PARSER_VERSION, 'normalizer': normalization.NORMALIZER_VERSION},
+        rebuild=not use_cache,
+    )
+
+
+def process_folder(folder_path, sklad_name, jobs=1, engine=None, use_cache=True):
+    registry = [{'name': sklad_name, 'folder': folder_path, 'layout': excel_readers.DEFAULT_LAYOUT}]
+    return process_folders(registry, jobs=jobs, engine=engine, use_cache=use_cache)
+
+
+@profiling.traced
+def build_daily_sales(df_all: pd.DataFrame):
+    """
+    Дневные суммы количества и первая цена дня по (Дата, Артикул, Склад); None, если нет колонок.
+    Режимы анализа берут их из дельт (delta_store.daily_sales); этот расчёт — эталон для сверки.
+    """
+    if 'Дата' not in df_all.columns:
+        logging.error("Колонка 'Дата' отсутствует в данных — невозможно сформировать файл ежедневных продаж.")
+        return None
+
+    if 'Количество' not in df_all.columns:
+        logging.error("Колонка 'Количество' отсутствует в данных — невозможно сформировать файл ежедневных продаж.")
+        return None
+
+    if 'Цена' not in df_all.columns:
+        logging.error("Колонка 'Цена' отсутствует в данных — невозможно сформировать файл с ценами.")
+        return None
+
+    # Агрегация количества и цены (цена — первая за день)
+    df_daily = (
+        df_all
+        .sort_values('Дата')  # чтобы first() работал корректно
+        .groupby(['Дата', 'Артикул', 'Склад'], as_index=False, observed=True)
+        .agg({
+            'Количество': 'sum',
+            'Цена': 'first'
+        })
+        .rename(columns={'Количество': 'Всего_продано', 'Цена': 'Цена_в_начале_дня'})
+    )
+
+    # Сортировка
+    df_daily.sort_values(['Дата', 'Склад', 'Артикул'], inplace=True)
+    return df_daily
+
+
+def generate_daily_sales_file(deltas: pd.DataFrame, calendar: pd.DataFrame,
+                              output_path: str = 'итог_дневные_продажи.csv'):
     try:
-        if 'Дата' not in df_all.columns:
-            logging.error("Колонка 'Дата' отсутствует в данных — невозможно сформировать файл ежедневных продаж.")
-            return
-
-        if 'Количество' not in df_all.columns:
-            logging.error("Колонка 'Количество' отсутствует в данных — невозможно сформировать файл ежедневных продаж.")
-            return
-
-        if 'Цена' not in df_all.columns:
-            logging.error("Колонка 'Цена' отсутствует в данных — невозможно сформировать файл с ценами.")
-            return
-
-        # Агрегация количества и цены (цена — первая за день)
-        df_daily = (
-            df_all
-            .sort_values('Дата')  # чтобы first() работал корректно
-            .groupby(['Дата', 'Артикул', 'Склад'], as_index=False)
-            .agg({
-                'Количество': 'sum',
-                'Цена': 'first'
-            })
-            .rename(columns={'Количество': 'Всего_продано', 'Цена': 'Цена_в_начале_дня'})
-        )
-
-        # Сортировка
-        df_daily.sort_values(['Дата', 'Склад', 'Артикул'], inplace=True)
+        df_daily = delta_store.daily_sales(deltas, calendar)
 
         # ✅ Сохранение в CSV
         df_daily.to_csv(output_path, index=False, encoding='utf-8-sig')
@@ -156,12 +279,16 @@ def generate_daily_sales_file(df_all: pd.DataFrame, output_path: str = 'итог
         logging.error(f"❌ Ошибка при создании файла с дневными продажами: {e}")
 
 
-@timing_decorator
-def analyze_with_restock_vectorized_monthly(df_all):
-    # --- Подготовка и агрегация данных ---
-    df_all['Дата'] = pd.to_datetime(df_all['Дата'], format='%d-%m-%Y', errors='coerce')
+@profiling.traced
+def build_daily_diffs(df_all):
+    """
+    Дневные данные по (Артикул, Склад, Дата) с изменением остатка к предыдущему снимку
+    и первичной разбивкой на продажи и пополнения (без учёта перемещений).
 
-    df_daily = df_all.groupby(['Артикул', 'Склад', 'Дата'], as_index=False).agg({
+    Все режимы анализа считают то же по дельтам (delta_store.daily_diffs); этот расчёт
+    по полным снимкам — эталон для сверки в benchmark.py.
+    """
+    df_daily = df_all.groupby(['Артикул', 'Склад', 'Дата'], as_index=False, observed=True).agg({
         'Количество': 'first',
         'Цена': 'first',
         'Номенклатура': 'first',
@@ -170,157 +297,147 @@ def analyze_with_restock_vectorized_monthly(df_all):
 
     df_daily = df_daily.sort_values(['Артикул', 'Склад', 'Дата']).copy()
 
-    df_daily['Год'] = df_daily['Дата'].dt.year
-    df_daily['Месяц'] = df_daily['Дата'].dt.month
+    df_daily['Год'] = df_daily['Дата'].dt.year.astype('int16')
+    df_daily['Месяц'] = df_daily['Дата'].dt.month.astype('int8')
 
     # --- Вычисление продаж и пополнений ---
-    df_daily['diff_qty'] = df_daily.groupby(['Артикул', 'Склад'])['Количество'].diff().fillna(0)
+    # Для компактных типов остатка (целые до int32, float32) разность точна и во float32
+    diff_dtype = 'float32' if df_daily['Количество'].dtype.itemsize <= 4 else 'float64'
+    df_daily['diff_qty'] = (
+        df_daily.groupby(['Артикул', 'Склад'], observed=True)['Количество'].diff().fillna(0).astype(diff_dtype)
+    )
     df_daily['Продано'] = (-df_daily['diff_qty']).clip(lower=0)
     df_daily['Пополнение'] = df_daily['diff_qty'].clip(lower=0)
+    return df_daily
 
-    # --- Поиск перемещений между складами ---
-    restock_rows = df_daily[df_daily['diff_qty'] > 0][['Дата', 'Артикул', 'Склад', 'diff_qty']].copy()
-    restock_rows.rename(columns={'Склад': 'Склад_куда', 'diff_qty': 'Кол-во'}, inplace=True)
 
-    sold_rows = df_daily[df_daily['diff_qty'] < 0][['Дата', 'Артикул', 'Склад', 'diff_qty']].copy()
-    sold_rows.rename(columns={'Склад': 'Склад_откуда', 'diff_qty': 'Кол-во'}, inplace=True)
-    sold_rows['Кол-во'] = -sold_rows['Кол-во']
+MONTH_KEYS = ['Артикул', 'Склад', 'Год', 'Месяц']
 
-    merged_moves = pd.merge(
-        restock_rows, sold_rows,
-        on=['Дата', 'Артикул', 'Кол-во'], how='inner'
-    )
-    merged_moves = merged_moves[merged_moves['Склад_куда'] != merged_moves['Склад_откуда']]
-
-    for _, row in merged_moves.iterrows():
-        mask_restock = (
-            (df_daily['Дата'] == row['Дата']) &
-            (df_daily['Артикул'] == row['Артикул']) &
-            (df_daily['Склад'] == row['Склад_куда']) &
-            (df_daily['diff_qty'] == row['Кол-во'])
-        )
-        df_daily.loc[mask_restock, 'Пополнение'] = 0
-
-        mask_sold = (
-            (df_daily['Дата'] == row['Дата']) &
-            (df_daily['Артикул'] == row['Артикул']) &
-            (df_daily['Склад'] == row['Склад_откуда']) &
-            (df_daily['diff_qty'] == -row['Кол-во'])
-        )
-        df_daily.loc[mask_sold, 'Продано'] = 0
-
-    перемещения = merged_moves.rename(columns={
-        'Дата': 'Дата',
-        'Артикул': 'Артикул',
-        'Склад_откуда': 'Склад_откуда',
-        'Склад_куда': 'Склад_куда',
-        'Кол-во': 'Кол-во'
-    })[['Дата', 'Артикул', 'Склад_откуда', 'Склад_куда', 'Кол-во']].to_dict(orient='records')
-
-    # --- Фильтр цен (оставил как в оригинале, закомментировано) ---
-    df_unique_price = df_daily.groupby(['Артикул', 'Склад', 'Дата'], as_index=False)['Цена'].first()
-
-    price_counts = df_unique_price.groupby([
-        'Артикул', 'Склад',
-        df_unique_price['Дата'].dt.year.rename('Год'),
-        df_unique_price['Дата'].dt.month.rename('Месяц'),
-        'Цена'
-    ])['Дата'].nunique().reset_index(name='Дней_с_ценой')
-
-    # price_counts = price_counts[price_counts['Дней_с_ценой'] >= 2]
-
-    df_filtered_price = pd.merge(
-        df_unique_price,
-        price_counts[['Артикул', 'Склад', 'Год', 'Месяц', 'Цена']],
-        on=['Артикул', 'Склад', 'Цена'],
-        how='inner'
-    )
 
-    price_stats = df_unique_price.groupby(['Артикул', 'Склад', df_unique_price['Дата'].dt.year.rename('Год'),
-                                           df_unique_price['Дата'].dt.month.rename('Месяц')]).agg(
-        Мин_цена=('Цена', 'min'),
-        Макс_цена=('Цена', 'max')
-    ).reset_index()
+@profiling.traced
+def aggregate_monthly(df_daily):
+    """
+    Месячные показатели по (Артикул, Склад, Год, Месяц) за один проход groupby.
 
-    # --- Продажи по месяцам ---
-    df_sales = df_daily.groupby(['Артикул', 'Склад', 'Год', 'Месяц']).agg(
+    Счётчики дней считаются суммой заранее вычисленных булевых колонок, поэтому
+    все агрегаты выполняются встроенными функциями pandas без вызова Python на группу.
+    df_daily должен быть отсортирован по (Артикул, Склад, Дата) с уникальной датой
+    внутри (Артикул, Склад) — тогда first/last по группе дают цену в начале и в конце месяца.
+
+    Дневные данные по дельтам (delta_store.daily_diffs) содержат колонку Дней — сколько
+    дней снимков представляет строка; дни в наличии и средняя цена тогда взвешиваются по ней.
+    """
+    df = df_daily.assign(
+        _день_продаж=df_daily['Продано'] > 0,
+        _в_наличии=df_daily['Количество'] > 0,
+    )
+    days = {
+        'Средняя_цена': ('Цена', 'mean'),
+        'Дней_в_наличии': ('_в_наличии', 'sum'),
+        'Уникальных_дней': ('Дата', 'count'),
+    }
+    if 'Дней' in df.columns:
+        df['_в_наличии'] = df['_в_наличии'] * df['Дней']
+        df['_цена_за_дни'] = df['Цена'] * df['Дней']
+        days = {**days, 'Средняя_цена': ('_цена_за_дни', 'sum'), 'Уникальных_дней': ('Дней', 'sum')}
+    df_sales = df.groupby(MONTH_KEYS, observed=True).agg(
         Номенклатура=('Номенклатура', 'first'),
         Производитель=('Производитель', 'first'),
         Всего_продано=('Продано', 'sum'),
         Всего_пополнено=('Пополнение', 'sum'),
-        Дней_продаж=('Продано', lambda x: (x > 0).sum()),
-        Средняя_цена=('Цена', 'mean'),
-        Дней_в_наличии=('Количество', lambda x: (x > 0).sum()),
+        Дней_продаж=('_день_продаж', 'sum'),
+        Средняя_цена=days['Средняя_цена'],
+        Дней_в_наличии=days['Дней_в_наличии'],
         Последний_остаток=('Количество', 'last'),
-        Уникальных_дней=('Дата', 'nunique')
+        Уникальных_дней=days['Уникальных_дней'],
+        Мин_цена=('Цена', 'min'),
+        Макс_цена=('Цена', 'max'),
+        Цена_в_начале=('Цена', 'first'),
+        Цена_в_конце=('Цена', 'last'),
     ).reset_index()
+    if 'Дней' in df.columns:
+        df_sales['Средняя_цена'] = df_sales['Средняя_цена'] / df_sales['Уникальных_дней']
 
     df_sales['Дней_в_наличии'] = df_sales[['Дней_в_наличии', 'Уникальных_дней']].min(axis=1)
     df_sales['Оборачиваемость'] = df_sales['Всего_продано'] / df_sales['Дней_продаж'].replace(0, 1)
 
-    df_price = df_daily.sort_values('Дата').groupby(['Артикул', 'Склад', 'Год', 'Месяц']).agg(
-        Цена_в_начале=('Цена', 'first'),
-        Цена_в_конце=('Цена', 'last')
-    ).reset_index()
-
-    df_price['Изменение_цены_абс'] = df_price['Цена_в_конце'] - df_price['Цена_в_начале']
-    df_price['Изменение_цены_%'] = ((df_price['Цена_в_конце'] / df_price['Цена_в_начале']) - 1) * 100
-    df_price['Изменение_цены_%'] = df_price['Изменение_цены_%'].fillna(0)
-    df_price['Изменение_цены_абс'] = df_price['Изменение_цены_абс'].fillna(0)
+    df_sales['Изменение_цены_абс'] = (df_sales['Цена_в_конце'] - df_sales['Цена_в_начале']).fillna(0)
+    df_sales['Изменение_цены_%'] = (((df_sales['Цена_в_конце'] / df_sales['Цена_в_начале']) - 1) * 100).fillna(0)
 
-    df_sales = df_sales.merge(price_stats, on=['Артикул', 'Склад', 'Год', 'Месяц'], how='left')
-    df_sales = df_sales.merge(df_price, on=['Артикул', 'Склад', 'Год', 'Месяц'], how='left')
+    return df_sales[[
+        *MONTH_KEYS, 'Номенклатура', 'Производитель', 'Всего_продано', 'Всего_пополнено',
+        'Дней_продаж', 'Средняя_цена', 'Дней_в_наличии', 'Последний_остаток', 'Уникальных_дней',
+        'Оборачиваемость', 'Мин_цена', 'Макс_цена', 'Цена_в_начале', 'Цена_в_конце',
+        'Изменение_цены_абс', 'Изменение_цены_%',
+    ]]
 
-    # --- Проверка артикула/номенклатуры на возможные подмены ---
-    def normalize_article(article):
-        if pd.isna(article):
-            return article
-        return article.replace('-', '').replace(' ', '').upper()
 
-    def normalize_nomenclature(nom):
-        if pd.isna(nom):
-            return nom
-        nom = nom.lower().replace('дефект', '').strip()
-        return nom
+@profiling.traced
+def analyze_with_restock_vectorized_monthly(deltas, calendar, pairs, transfer_lag_days=0, transfer_qty_tolerance=0):
+    """Месячные продажи, перемещения и подмены артикулов; pairs — результат duplicates.unique_pairs."""
+    # --- Изменения остатков прямо по дельтам снимков: строки только в дни изменений ---
+    df_daily = delta_store.daily_diffs(deltas, calendar)
 
-    df_all['Артикул_норм'] = df_all['Артикул'].apply(normalize_article)
-    df_all['Номенклатура_норм'] = df_all['Номенклатура'].apply(normalize_nomenclature)
+    # --- Поиск перемещений между складами ---
+    df_daily, df_moves = transfers.reconcile_transfers(
+        df_daily, max_lag_days=transfer_lag_days, qty_tolerance=transfer_qty_tolerance
+    )
+    перемещения = df_moves.to_dict(orient='records')
 
-    grouped = df_all.groupby('Номенклатура_норм')['Артикул_норм'].nunique().reset_index()
-    problematic = grouped[grouped['Артикул_норм'] > 1]
+    df_sales = aggregate_monthly(df_daily)
 
-    problematic_articles = df_all[df_all['Номенклатура_норм'].isin(problematic['Номенклатура_норм'])][
-        ['Номенклатура', 'Артикул', 'Артикул_норм', 'Номенклатура_норм']].drop_duplicates().reset_index(drop=True)
+    # --- Проверка артикула/номенклатуры на возможные подмены (по уникальным парам) ---
+    problematic_articles = duplicates.find_name_conflicts(pairs)
 
     return df_sales, перемещения, problematic_articles
 
-@timing_decorator
-def normalize_article(article):
-    # Простая нормализация артикула: удаляем дефисы, пробелы, подчёркивания и приводим к верхнему регистру
-    if not isinstance(article, str):
-        return article
-    return article.replace('-', '').replace(' ', '').replace('_', '').upper()
 
-def run_month_analysis():
-    logging.info("🔍 Начало анализа месяца")
+def build_totals(df_result):
+    """Итоги по (Артикул, Склад) за весь период из месячной таблицы."""
+    df_total = df_result.groupby(['Артикул', 'Склад'], observed=True).agg(
+        Номенклатура=('Номенклатура', 'first'),
+        Производитель=('Производитель', 'first'),
+        Всего_продано=('Всего_продано', 'sum'),
+        Всего_пополнено=('Всего_пополнено', 'sum'),
+        Дней_продаж=('Дней_продаж', 'sum'),
+        Средняя_цена=('Средняя_цена', 'mean'),
+        Мин_цена=('Мин_цена', 'min'),
+        Макс_цена=('Макс_цена', 'max'),
+        Цена_в_начале=('Цена_в_начале', 'first'),
+        Цена_в_конце=('Цена_в_конце', 'last'),
+        Дней_в_наличии=('Дней_в_наличии', 'sum')
+    ).reset_index()
 
-    df_moscow = process_folder('data/moscow', 'Москва')
-    df_khabarovsk = process_folder('data/khabarovsk', 'Хабаровск')
+    df_total['Дней_продаж'] = df_total['Дней_продаж'].replace(0, 1)
+    df_total['Оборачиваемость'] = df_total['Всего_продано'] / df_total['Дней_продаж']
+    return df_total
 
-    if df_moscow is None and df_khabarovsk is None:
-        logging.error("❌ Нет данных для анализа")
-        return
 
-    df_all = pd.concat([df for df in [df_moscow, df_khabarovsk] if df is not None], ignore_index=True)
-    df_all.dropna(subset=['Артикул'], inplace=True)
+# Наборы, которые по --excel дополнительно выгружаются в прежние файлы
+EXCEL_EXPORTS = ['итог_по_месяцу', 'фиксация_перемещений', 'кандидаты_дублей',
+                 'самые_ходовые', 'залежалые', 'чаще_всего_пополнялись']
+CSV_EXPORTS = {'итог_дневные_продажи': ['Дата', 'Артикул', 'Склад', 'Всего_продано', 'Цена_в_начале_дня']}
+TOP_N = 1000
+
+
+def prepare_snapshots(df_all):
+    """Очистка, компактные типы и нормализация артикулов объединённых снимков."""
+    with profiling.span('подготовка', rows_in=len(df_all)) as info:
+        df_all.dropna(subset=['Артикул'], inplace=True)
+
+        # Компактные типы: категории с общим словарём для ключей, минимальные числовые типы
+        df_all = schema.apply_schema(df_all)
 
-    # Приводим артикулы к строкам, убираем пробелы и нормализуем
-    df_all['Артикул'] = df_all['Артикул'].astype(str).str.strip().apply(normalize_article)
+        # Нормализуем артикулы: удаляем дефисы, пробелы, подчёркивания и приводим к верхнему регистру
+        df_all['Артикул'] = normalization.normalize_articles(df_all['Артикул'])
 
-    df_all['Дата'] = pd.to_datetime(df_all['Дата'], errors='coerce')
+        df_all['Дата'] = pd.to_datetime(df_all['Дата'], errors='coerce')
+        info['rows_out'] = len(df_all)
+    return df_all
 
-    df_result, перемещения, df_flags = analyze_with_restock_vectorized_monthly(df_all)
 
+def finalize_monthly(df_result):
+    """Унифицирует имена колонок месячной таблицы и добавляет недостающие."""
     # Переименование колонок для унификации
     rename_map = {
         'Количество': 'Всего_продано',
@@ -341,45 +458,199 @@ def run_month_analysis():
     for col in needed_cols:
         if col not in df_result.columns:
             df_result[col] = 0 if 'цена' not in col.lower() else None
+    return df_result
 
+
+def format_flags(df_flags):
     if isinstance(df_flags, list):
         df_flags = pd.DataFrame(df_flags) if df_flags else pd.DataFrame()
 
     if not df_flags.empty and 'Дата' in df_flags.columns:
         df_flags['Дата'] = pd.to_datetime(df_flags['Дата'], errors='coerce').dt.strftime('%d/%m/%Y')
+    return df_flags
 
-    df_result.to_excel('итог_по_месяцу.xlsx', index=False)
-    df_flags.to_excel('фиксация_перемещений.xlsx', index=False)
 
-    df_total = df_result.groupby(['Артикул', 'Склад']).agg(
-        Номенклатура=('Номенклатура', 'first'),
-        Производитель=('Производитель', 'first'),
-        Всего_продано=('Всего_продано', 'sum'),
-        Всего_пополнено=('Всего_пополнено', 'sum'),
-        Дней_продаж=('Дней_продаж', 'sum'),
-        Средняя_цена=('Средняя_цена', 'mean'),
-        Мин_цена=('Мин_цена', 'min'),
-        Макс_цена=('Макс_цена', 'max'),
-        Цена_в_начале=('Цена_в_начале', 'first'),
-        Цена_в_конце=('Цена_в_конце', 'last'),
-        Дней_в_наличии=('Дней_в_наличии', 'sum')
-    ).reset_index()
+def build_tops(df_total, top_n=TOP_N):
+    """Топы товаров по итогам: ходовые, залежалые и чаще всего пополнявшиеся."""
+    return {
+        'самые_ходовые': df_total[df_total['Всего_продано'] > 0]
+        .sort_values('Оборачиваемость', ascending=False).head(top_n),
+        'залежалые': df_total[df_total['Всего_продано'] == 0]
+        .sort_values('Дней_в_наличии', ascending=False).head(top_n),
+        'чаще_всего_пополнялись': df_total.sort_values('Всего_пополнено', ascending=False).head(top_n),
+    }
 
-    df_total['Дней_продаж'] = df_total['Дней_продаж'].replace(0, 1)
-    df_total['Оборачиваемость'] = df_total['Всего_продано'] / df_total['Дней_продаж']
 
-    top_fast = df_total[df_total['Всего_продано'] > 0].sort_values('Оборачиваемость', ascending=False).head(1000)
-    top_slow = df_total[df_total['Всего_продано'] == 0].sort_values('Дней_в_наличии', ascending=False).head(1000)
-    top_restocked = df_total.sort_values('Всего_пополнено', ascending=False).head(1000)
+def collect_outputs(df_result, df_total, tops, df_flags, df_candidates, df_daily_sales):
+    """Наборы для публикации: {имя прежнего файла выгрузки: (данные, колонки разделов, порядок строк)}."""
+    outputs = {
+        'итог_по_месяцу': (df_result, ['Склад', 'Год', 'Месяц'], MONTH_KEYS),
+        'итоги': (df_total, None, None),
+        **{name: (df, None, None) for name, df in tops.items()},
+        'фиксация_перемещений': (df_flags, None, None),
+        'кандидаты_дублей': (df_candidates, None, None),
+    }
+    if df_daily_sales is not None:
+        outputs['итог_дневные_продажи'] = (with_month_columns(df_daily_sales), ['Склад', 'Год', 'Месяц'],
+                                           ['Дата', 'Склад', 'Артикул'])
+    return outputs
+
+
+def with_month_columns(df_daily_sales):
+    """Колонки Год и Месяц для разбиения дневных продаж на разделы."""
+    return df_daily_sales.assign(Год=df_daily_sales['Дата'].dt.year.astype('int16'),
+                                 Месяц=df_daily_sales['Дата'].dt.month.astype('int8'))
+
+
+@profiling.traced(name='экспорт_excel')
+def export_files(outputs):
+    """
+    Необязательная выгрузка опубликованных наборов в Excel/CSV для ручной работы.
+    Файл пишется во временный и затем переименовывается — читатель не увидит его наполовину записанным.
+    """
+    for name in EXCEL_EXPORTS:
+        if name in outputs:
+            outputs[name][0].to_excel(f'{name}.tmp.xlsx', index=False)
+            os.replace(f'{name}.tmp.xlsx', f'{name}.xlsx')
+    for name, columns in CSV_EXPORTS.items():
+        if name in outputs:
+            outputs[name][0][columns].to_csv(f'{name}.csv.tmp', index=False, encoding='utf-8-sig')
+            os.replace(f'{name}.csv.tmp', f'{name}.csv')
+            logging.info(f"📁 CSV-файл с дневными продажами и ценами сохранён: {name}.csv")
+
+
+def export_published():
+    """Выгрузка в xlsx/csv полных наборов из хранилища — для режимов, не держащих их в памяти целиком."""
+    outputs = {}
+    for name in EXCEL_EXPORTS + list(CSV_EXPORTS):
+        df = artifact_store.read_dataset(name, categories=False)
+        if df is not None:
+            outputs[name] = (df, None, None)
+    export_files(outputs)
+
+
+def publish_outputs(outputs, export_excel=False):
+    with profiling.span('публикация'):
+        manifest = artifact_store.publish(outputs)
+    if export_excel:
+        export_files(outputs)
+    return manifest
+
+
+def run_month_analysis(jobs=1, engine=None, use_cache=True, transfer_lag_days=0, transfer_qty_tolerance=0,
+                       export_excel=False):
+    logging.info("🔍 Начало анализа месяца")
+    with profiling.run('анализ_месяца'):
+        _run_month_analysis(jobs, engine, use_cache, transfer_lag_days, transfer_qty_tolerance, export_excel)
+
+
+def _run_month_analysis(jobs, engine, use_cache, transfer_lag_days, transfer_qty_tolerance, export_excel):
+    store = load_deltas(jobs=jobs, engine=engine, use_cache=use_cache)
+
+    if store is None:
+        logging.error("❌ Нет данных для анализа")
+        return
+    deltas, calendar, pairs = store
+    # Уникальные пары с нормализацией — общие для проверки подмен и поиска дублей
+    pairs = duplicates.unique_pairs(pairs)
+
+    df_result, перемещения, df_flags = analyze_with_restock_vectorized_monthly(
+        deltas, calendar, pairs, transfer_lag_days=transfer_lag_days, transfer_qty_tolerance=transfer_qty_tolerance
+    )
+    df_result = finalize_monthly(df_result)
+    df_flags = format_flags(df_flags)
+
+    df_candidates = duplicates.find_near_duplicates(pairs)
+    logging.info(f"🔎 Кандидатов в дубли артикулов/наименований: {len(df_candidates)}")
 
-    top_fast.to_excel('самые_ходовые.xlsx', index=False)
-    top_slow.to_excel('залежалые.xlsx', index=False)
-    top_restocked.to_excel('чаще_всего_пополнялись.xlsx', index=False)
+    with profiling.span('итоги', rows_in=len(df_result)) as info:
+        df_total = build_totals(df_result)
+        info['rows_out'] = len(df_total)
 
-    generate_daily_sales_file(df_all, output_path='итог_дневные_продажи.csv')
+    tops = build_tops(df_total)
+    df_daily_sales = delta_store.daily_sales(deltas, calendar)
+
+    publish_outputs(collect_outputs(df_result, df_total, tops, df_flags, df_candidates, df_daily_sales),
+                    export_excel=export_excel)
 
     logging.info("✅ Анализ месяца завершен")
 
 
+def sources_signature(registry=None):
+    """Склад, размер и mtime каждого снимка — по изменению подписи режим наблюдения запускает анализ."""
+    signature = {}
+    for path, sklad_name, layout in snapshot_tasks(registry):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        signature[os.path.abspath(path)] = (sklad_name, warehouses.layout_key(layout), stat.st_size, stat.st_mtime_ns)
+    return signature
+
+
+def watch(interval=5.0, **run_kwargs):
+    """
+    Режим наблюдения: опрашивает папки складов каждые interval секунд и при появлении
+    новых или изменённых снимков запускает в фоновом потоке инкрементальный анализ
+    (incremental.update_monthly): пересчитываются только месяцы, затронутые новыми снимками,
+    а состояние общее с запуском incremental.py. Файлы ещё копируются, пока их размер
+    или mtime меняются между опросами, поэтому запуск ждёт одного опроса без изменений.
+    Изменения во время анализа обрабатываются следующим запуском.
+    Результаты публикуются атомарно новой версией хранилища — её подхватывает дашборд.
+    """
+    # incremental импортирует этот модуль, поэтому импорт здесь, а не в начале файла
+    import incremental
+
+    logging.info(f'👀 Режим наблюдения: опрос папок складов каждые {interval} с')
+    analyzed, previous, running = None, None, None
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        try:
+            while True:
+                if running is not None and running.done():
+                    # После ошибки анализ повторяется при следующем изменении снимков
+                    if running.exception() is not None:
+                        logging.error(f'❌ Ошибка анализа в режиме наблюдения: {running.exception()}')
+                    running = None
+                try:
+                    current = sources_signature()
+                except Exception as e:
+                    logging.error(f'❌ Не удалось просмотреть папки складов: {e}')
+                    current = previous
+                if running is None and current is not None and current != analyzed and current == previous:
+                    known = analyzed or {}
+                    changed = sum(current.get(path) != known.get(path) for path in current.keys() | known.keys())
+                    logging.info(f'🆕 Изменились снимки: {changed}, запускаю анализ')
+                    analyzed = current
+                    running = executor.submit(incremental.run_update, **run_kwargs)
+                previous = current
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            logging.info('⏹ Режим наблюдения остановлен')
+
+
 if __name__ == '__main__':
-    run_month_analysis()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Анализ складских остатков по месяцам')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='число процессов для чтения файлов (0 — по числу ядер)')
+    parser.add_argument('--engine', choices=sorted(excel_readers.READERS),
+                        help='движок чтения Excel (по умолчанию — самый быстрый доступный)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='не использовать кэш разобранных снимков, разобрать все файлы заново')
+    parser.add_argument('--transfer-lag', type=int, default=0,
+                        help='допустимая задержка перемещения между складами, дней')
+    parser.add_argument('--transfer-tolerance', type=int, default=0,
+                        help='допустимое расхождение количества отправленного и полученного товара, целых штук')
+    parser.add_argument('--excel', action='store_true',
+                        help='кроме Parquet-хранилища выгрузить результаты в прежние xlsx/csv-файлы')
+    parser.add_argument('--watch', action='store_true',
+                        help='не завершаться: следить за папками складов и инкрементально пересчитывать при новых снимках')
+    parser.add_argument('--interval', type=float, default=5.0,
+                        help='период опроса папок в режиме наблюдения, секунд')
+    args = parser.parse_args()
+    run_kwargs = dict(jobs=args.jobs, engine=args.engine, use_cache=not args.no_cache,
+                      transfer_lag_days=args.transfer_lag, transfer_qty_tolerance=args.transfer_tolerance,
+                      export_excel=args.excel)
+    if args.watch:
+        watch(interval=args.interval, **run_kwargs)
+    else:
+        run_month_analysis(**run_kwargs)
\ No newline at end of file
@@ -0,0 +1,238 @@
+"""
+Хранилище результатов анализа: типизированные Parquet-наборы с манифестом.
+
+Каждая публикация пишется в отдельный каталог версии (артефакты/<версия>/<набор>/),
+после чего атомарно заменяется манифест артефакты/manifest.json. Читатели всегда
+открывают версию из манифеста, поэтому никогда не видят наполовину записанный результат.
+Крупные наборы разбиваются на разделы по колонкам (например, Склад/Год/Месяц),
+так что чтение одного склада или месяца не затрагивает остальные файлы.
+"""
+import json
+import logging
+import os
+import shutil
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from urllib.parse import unquote
+
+STORE_DIR = 'артефакты'
+MANIFEST_NAME = 'manifest.json'
+KEEP_VERSIONS = 2
+
+
+def load_manifest(store_dir=STORE_DIR):
+    """Текущий манифест хранилища или None, если публикаций ещё не было."""
+    path = os.path.join(store_dir, MANIFEST_NAME)
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning(f'Манифест хранилища {path} повреждён: {e}')
+        return None
+
+
+def manifest_signature(store_dir=STORE_DIR):
+    """
+    Дешёвая проверка новой публикации без чтения манифеста: (inode, mtime, размер) файла
+    манифеста или None. Манифест заменяется атомарно, поэтому смена подписи означает новую версию.
+    """
+    try:
+        stat = os.stat(os.path.join(store_dir, MANIFEST_NAME))
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _write_json_atomic(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+def _write_dataset(df, path, partition_cols=None, tag='0'):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if partition_cols:
+        # Имя файла с версией и номером части: новые файлы не совпадают с перенесёнными
+        pq.write_to_dataset(table, path, partition_cols=partition_cols,
+                            basename_template=f'part-{tag}-{{i}}.parquet')
+    else:
+        os.makedirs(path, exist_ok=True)
+        pq.write_table(table, os.path.join(path, f'part-{tag}.parquet'))
+
+
+def _link(src, dst):
+    """Переносит файл прежней версии жёсткой ссылкой (без копирования), иначе копирует."""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _partition_values(relative_dir):
+    """'Склад=%D0%9C.../Год=2025' -> {'Склад': 'М...', 'Год': '2025'}."""
+    values = {}
+    for part in relative_dir.split(os.sep):
+        if '=' in part:
+            key, value = part.split('=', 1)
+            values[unquote(key)] = unquote(value)
+    return values
+
+
+def _carry_files(old_path, new_path, keep_file=None):
+    """Переносит файлы набора прежней версии; keep_file(значения разделов) отбирает разделы."""
+    rows = 0
+    for root, _, files in os.walk(old_path):
+        relative = os.path.relpath(root, old_path)
+        if not files or (keep_file is not None and not keep_file(_partition_values(relative))):
+            continue
+        for name in files:
+            src = os.path.join(root, name)
+            _link(src, os.path.join(new_path, relative, name))
+            rows += pq.read_metadata(src).num_rows
+    return rows
+
+
+def _prune_versions(store_dir, keep, current):
+    versions = sorted(
+        name for name in os.listdir(store_dir)
+        if os.path.isdir(os.path.join(store_dir, name)) and name != current
+    )
+    for name in versions[:max(0, len(versions) - (keep - 1))]:
+        shutil.rmtree(os.path.join(store_dir, name), ignore_errors=True)
+
+
+def publish(datasets, store_dir=STORE_DIR, keep=KEEP_VERSIONS, carry_over=(), replace_partitions=None):
+    """
+    Публикует наборы одной версией. datasets: {имя: (DataFrame, колонки_разделов или None,
+    колонки_сортировки или None)}. Колонки сортировки восстанавливают порядок строк
+    при чтении разбитого на разделы набора. Вместо DataFrame можно передать
+    последовательность частей (например, генератор) — они пишутся по одной,
+    и набор целиком в памяти не собирается. Возвращает новый манифест.
+
+    carry_over — имена наборов текущей версии, которые переносятся без изменений.
+    replace_partitions — {имя: функция(значения разделов) -> bool} для частичного
+    обновления разбитого набора: разделы текущей версии, для которых функция истинна,
+    заменяются строками нового DataFrame, остальные переносятся без изменений.
+    Перенос — жёсткие ссылки на файлы, поэтому его стоимость не зависит от объёма истории.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    version = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    tmp_dir = os.path.join(store_dir, f'.{version}.tmp')
+    current = load_manifest(store_dir)
+    replace_partitions = replace_partitions or {}
+
+    def current_path(name):
+        if current is None or name not in current['datasets']:
+            return None
+        return os.path.join(store_dir, current['version'], name)
+
+    entries = {}
+    for name in carry_over:
+        if name in datasets or current_path(name) is None:
+            continue
+        _carry_files(current_path(name), os.path.join(tmp_dir, name))
+        entries[name] = current['datasets'][name]
+
+    for name, (data, partition_cols, sort_by) in datasets.items():
+        path = os.path.join(tmp_dir, name)
+        is_partial = name in replace_partitions and current_path(name) is not None
+        stored = current['datasets'][name]['columns'] if is_partial else {}
+        rows, columns = 0, {}
+        for i, df in enumerate([data] if isinstance(data, pd.DataFrame) else data):
+            # Категории остаются категориями во всех файлах набора (прежних и других частей),
+            # иначе схемы файлов несовместимы
+            reference = stored or columns
+            df = df.astype({col: 'category' for col in df.columns
+                            if reference.get(col) == 'category' and not isinstance(df[col].dtype, pd.CategoricalDtype)})
+            _write_dataset(df, path, partition_cols, f'{version}-{i}')
+            rows += len(df)
+            for col, dtype in df.dtypes.items():
+                columns.setdefault(col, str(dtype))
+        if is_partial:
+            is_replaced = replace_partitions[name]
+            rows += _carry_files(current_path(name), path, lambda values: not is_replaced(values))
+            columns = {**stored, **columns}
+        entries[name] = {
+            'rows': rows,
+            'columns': columns,
+            'partition_cols': list(partition_cols or []),
+            'sort_by': list(sort_by or []),
+        }
+
+    os.makedirs(tmp_dir, exist_ok=True)
+    os.replace(tmp_dir, os.path.join(store_dir, version))
+    manifest = {'version': version, 'published': datetime.now().isoformat(), 'datasets': entries}
+    _write_json_atomic(os.path.join(store_dir, MANIFEST_NAME), manifest)
+    _prune_versions(store_dir, keep, version)
+    logging.info(f'📦 Опубликованы наборы {", ".join(entries)} (версия {version})')
+    return manifest
+
+
+def _open_dataset(path):
+    """
+    Набор Parquet-файлов с общей схемой: после частичных обновлений типы колонок
+    в разных файлах могут различаться (int16 и int32), поэтому схемы объединяются с расширением типов.
+    """
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    file_schema = pa.unify_schemas([pq.read_schema(f) for f in dataset.files], promote_options='permissive')
+    partition_fields = [field for field in dataset.schema if field.name not in file_schema.names]
+    schema = pa.schema(list(file_schema) + partition_fields, metadata=file_schema.metadata)
+    return ds.dataset(path, format='parquet', partitioning='hive', schema=schema)
+
+
+def read_dataset(name, store_dir=STORE_DIR, filters=None, columns=None, categories=True):
+    """
+    Читает набор из текущей версии хранилища; None, если набора нет.
+    filters — фильтры pyarrow по колонкам разделов, например [('Склад', '=', 'Москва')].
+    categories=False возвращает категориальные колонки обычными (как после чтения Excel).
+    """
+    manifest = load_manifest(store_dir)
+    if manifest is None or name not in manifest['datasets']:
+        return None
+    entry = manifest['datasets'][name]
+    path = os.path.join(store_dir, manifest['version'], name)
+    try:
+        dataset = _open_dataset(path)
+        expression = pq.filters_to_expression(filters) if filters else None
+        df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+    except Exception as e:
+        logging.warning(f'Не удалось прочитать набор {name} из {path}: {e}')
+        return None
+
+    # Колонки разделов читаются строками или int32 — возвращаем исходные типы и порядок
+    ordered = [col for col in entry['columns'] if col in df.columns]
+    df = df[ordered]
+    for col in entry['partition_cols']:
+        if col in df.columns and str(df[col].dtype) != entry['columns'][col]:
+            df[col] = df[col].astype(entry['columns'][col])
+    # Словари категорий при чтении нескольких файлов объединяются в порядке файлов
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].cat.reorder_categories(df[col].cat.categories.sort_values())
+    if entry['sort_by'] and set(entry['sort_by']) <= set(df.columns):
+        df = df.sort_values(entry['sort_by'], kind='stable', ignore_index=True)
+    if not categories:
+        df = df.astype({col: df[col].cat.categories.dtype
+                        for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)})
+    return df
+
+
+def read_or_excel(name, xlsx_path, store_dir=STORE_DIR, **kwargs):
+    """Набор из хранилища, а если его нет — прежний Excel-файл (пустой DataFrame при ошибке)."""
+    df = read_dataset(name, store_dir=store_dir, **kwargs)
+    if df is not None:
+        return df
+    try:
+        if xlsx_path and os.path.exists(xlsx_path):
+            return pd.read_excel(xlsx_path)
+    except Exception as e:
+        logging.warning(f'Не удалось прочитать {xlsx_path}: {e}')
+    return pd.DataFrame()
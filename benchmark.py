@@ -0,0 +1,1112 @@
+"""
+Замеры производительности этапов анализа на синтетических данных.
+
+Запуск: python benchmark.py [имя_замера ...] — без аргументов выполняются все замеры.
+"""
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import numpy as np
+import pandas as pd
+
+import analyze
+import artifact_store
+import delta_store
+import downsampling
+import duplicates
+import excel_readers
+import incremental
+import normalization
+import pipeline
+import schema
+import sharded
+import spike_analysis
+import spike_detectors
+import transfers
+
+
+def write_snapshot_xlsx(path, date, rows):
+    """Снимок остатков на дату date в раскладке DEFAULT_LAYOUT: rows — (номенклатура, количество, цена, производитель, артикул)."""
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(['Остатки товаров'])
+    ws.append([f'{pd.Timestamp(date):%d.%m.%Y}'])
+    ws.append([])
+    ws.append(['', 'Номенклатура', 'Количество', 'Цена', 'Производитель', 'Артикул'])
+    for row in rows:
+        ws.append([None, *row])
+    wb.save(path)
+
+
+def make_snapshot_xlsx(path, rows=50000, seed=0):
+    """Пишет синтетический снимок остатков в раскладке DEFAULT_LAYOUT."""
+    rng = np.random.default_rng(seed)
+    qty = rng.integers(0, 100, rows)
+    price = rng.integers(100, 10000, rows)
+    write_snapshot_xlsx(path, '2025-02-19', (
+        (f'Товар {i}', int(qty[i]), int(price[i]), f'Производитель {i % 50}', f'ART-{i:06d}') for i in range(rows)))
+
+
+def bench_readers(paths=None, rows=50000):
+    """Пропускная способность каждого доступного движка чтения снимков."""
+    with tempfile.TemporaryDirectory() as tmp:
+        if not paths:
+            path = os.path.join(tmp, 'snapshot.xlsx')
+            make_snapshot_xlsx(path, rows=rows)
+            paths = [path]
+
+        for path in paths:
+            extension = os.path.splitext(path)[1].lower()
+            size_mb = os.path.getsize(path) / 1024 / 1024
+            for engine in excel_readers.available_engines(extension):
+                start = time.perf_counter()
+                _, columns = excel_readers.read_columns(path, engine=engine)
+                df = pd.DataFrame(columns)
+                duration = time.perf_counter() - start
+                print(f'{os.path.basename(path)} [{engine}]: {len(df)} строк за {duration:.3f} с '
+                      f'({len(df) / duration:,.0f} строк/с, {size_mb / duration:.1f} МБ/с)')
+
+
+def make_daily_snapshots(n_articles=2000, n_days=60, sklads=('Москва', 'Хабаровск'),
+                         transfer_rate=0.02, transfer_lag=0, sales_rate=0.7, seed=0):
+    """
+    Синтетические ежедневные снимки в формате process_folders: остатки каждого артикула
+    на каждом складе со случайными продажами, пополнениями и перемещениями между складами.
+    Перемещение уходит со склада в день d и приходит на другой склад в день d + transfer_lag.
+    sales_rate — среднее число продаж артикула на складе в день.
+    """
+    rng = np.random.default_rng(seed)
+    n_sklads = len(sklads)
+    deltas = -rng.poisson(sales_rate, size=(n_sklads, n_articles, n_days)).astype(float)
+    restock = rng.random((n_sklads, n_articles, n_days)) < 0.05
+    deltas[restock] += rng.integers(5, 50, restock.sum())
+
+    n_moves = int(transfer_rate * n_articles * n_days)
+    src = rng.integers(0, n_sklads, n_moves)
+    dst = (src + rng.integers(1, n_sklads, n_moves)) % n_sklads if n_sklads > 1 else src
+    art = rng.integers(0, n_articles, n_moves)
+    day = rng.integers(1, max(n_days - transfer_lag, 2), n_moves)
+    qty = rng.integers(1, 30, n_moves)
+    deltas[src, art, day] = -qty
+    arrive = np.minimum(day + transfer_lag, n_days - 1)
+    deltas[dst, art, arrive] = qty
+    deltas[:, :, 0] = 0
+
+    stock = 500 + np.cumsum(deltas, axis=2)
+    price = np.repeat(rng.integers(100, 10000, (1, n_articles, 1)), n_sklads, axis=0) * np.ones((1, 1, n_days))
+    price_change = rng.random((n_sklads, n_articles, n_days)) < 0.01
+    price = price * np.cumprod(np.where(price_change, 1.1, 1.0), axis=2)
+
+    dates = pd.date_range('2025-01-01', periods=n_days, freq='D')
+    s_idx, a_idx, d_idx = np.indices((n_sklads, n_articles, n_days)).reshape(3, -1)
+    df = pd.DataFrame({
+        'Дата': dates[d_idx],
+        'Номенклатура': np.char.add('Товар ', a_idx.astype(str)),
+        'Количество': stock.reshape(-1),
+        'Цена': price.reshape(-1).round(2),
+        'Производитель': np.char.add('Производитель ', (a_idx % 50).astype(str)),
+        'Артикул': np.char.add('ART', a_idx.astype(str)),
+        'Склад': np.asarray(sklads, dtype=object)[s_idx],
+    })
+    # Часть позиций отсутствует в отдельных снимках
+    df = df[rng.random(len(df)) > 0.01]
+    df['Номенклатура'] = df['Номенклатура'].astype(object)
+    df['Производитель'] = df['Производитель'].astype(object)
+    df['Артикул'] = df['Артикул'].astype(object)
+    return df.sort_values(['Склад', 'Дата']).reset_index(drop=True)
+
+
+def _legacy_reconcile_transfers(df_daily):
+    """Исходная реализация: цикл iterrows с полным сканированием df_daily на каждое перемещение."""
+    restock_rows = df_daily[df_daily['diff_qty'] > 0][['Дата', 'Артикул', 'Склад', 'diff_qty']].copy()
+    restock_rows.rename(columns={'Склад': 'Склад_куда', 'diff_qty': 'Кол-во'}, inplace=True)
+
+    sold_rows = df_daily[df_daily['diff_qty'] < 0][['Дата', 'Артикул', 'Склад', 'diff_qty']].copy()
+    sold_rows.rename(columns={'Склад': 'Склад_откуда', 'diff_qty': 'Кол-во'}, inplace=True)
+    sold_rows['Кол-во'] = -sold_rows['Кол-во']
+
+    merged_moves = pd.merge(restock_rows, sold_rows, on=['Дата', 'Артикул', 'Кол-во'], how='inner')
+    merged_moves = merged_moves[merged_moves['Склад_куда'] != merged_moves['Склад_откуда']]
+
+    for _, row in merged_moves.iterrows():
+        mask_restock = (
+            (df_daily['Дата'] == row['Дата']) &
+            (df_daily['Артикул'] == row['Артикул']) &
+            (df_daily['Склад'] == row['Склад_куда']) &
+            (df_daily['diff_qty'] == row['Кол-во'])
+        )
+        df_daily.loc[mask_restock, 'Пополнение'] = 0
+
+        mask_sold = (
+            (df_daily['Дата'] == row['Дата']) &
+            (df_daily['Артикул'] == row['Артикул']) &
+            (df_daily['Склад'] == row['Склад_откуда']) &
+            (df_daily['diff_qty'] == -row['Кол-во'])
+        )
+        df_daily.loc[mask_sold, 'Продано'] = 0
+
+    return df_daily, merged_moves[transfers.MOVE_COLUMNS].to_dict(orient='records')
+
+
+def bench_transfers(n_articles=300, n_days=60):
+    """Сверка с исходным циклом iterrows и замер времени сведения перемещений."""
+    df_daily = analyze.build_daily_diffs(make_daily_snapshots(n_articles, n_days))
+
+    start = time.perf_counter()
+    legacy_daily, legacy_moves = _legacy_reconcile_transfers(df_daily.copy())
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new_daily, new_moves = transfers.reconcile_transfers(df_daily.copy())
+    new_time = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(legacy_daily, new_daily)
+    assert legacy_moves == new_moves.to_dict(orient='records')
+    print(f'{len(df_daily)} дневных строк, {len(legacy_moves)} перемещений: результаты совпадают')
+    print(f'iterrows: {legacy_time:.3f} с, по ключам: {new_time:.3f} с (x{legacy_time / new_time:.0f})')
+
+
+def _check_transfer_fallback():
+    """
+    Пополнение, уступившее лучшее списание другому, сопоставляется со следующим свободным:
+    Новосибирск (1 мая) и Хабаровск (2 мая) оба ближе всего к отправке из Москвы (1 мая),
+    Хабаровску должна достаться отправка из Казани (29 апреля).
+    """
+    df_daily = pd.DataFrame({
+        'Дата': pd.to_datetime(['2025-05-01', '2025-04-29', '2025-05-01', '2025-05-02']),
+        'Артикул': 'A1',
+        'Склад': ['Москва', 'Казань', 'Новосибирск', 'Хабаровск'],
+        'diff_qty': [-10.0, -10.0, 10.0, 10.0],
+    })
+    moves = transfers.find_lagged_transfers(df_daily, 3)
+    pairs = set(zip(moves['Склад_откуда'], moves['Склад_куда']))
+    assert pairs == {('Москва', 'Новосибирск'), ('Казань', 'Хабаровск')}, pairs
+    print('освободившиеся отправки достаются следующим пополнениям: 2 перемещения из 2')
+
+
+def bench_lagged_transfers(n_articles=5000, n_days=100, lag=3):
+    """Сколько перемещений с задержкой находится при разных окнах и сколько это стоит."""
+    _check_transfer_fallback()
+    sklads = ('Москва', 'Хабаровск', 'Новосибирск')
+    df_all = make_daily_snapshots(n_articles, n_days, sklads=sklads, transfer_lag=lag)
+    df_daily = analyze.build_daily_diffs(df_all)
+    print(f'{len(df_daily)} дневных строк, {len(sklads)} склада, задержка в данных {lag} дн.')
+    for max_lag, tolerance in [(0, 0), (lag, 0), (lag + 2, 0), (lag + 2, 2)]:
+        start = time.perf_counter()
+        _, moves = transfers.reconcile_transfers(df_daily.copy(), max_lag, tolerance)
+        duration = time.perf_counter() - start
+        print(f'окно {max_lag} дн., допуск {tolerance}: {len(moves)} перемещений за {duration:.3f} с')
+
+
+def _per_warehouse_lagged_transfers(df_daily, max_lag_days, qty_tolerance=0):
+    """Прежнее сопоставление с задержкой: merge_asof отдельно для каждого склада-получателя."""
+    arrivals = df_daily.loc[df_daily['diff_qty'] > 0, ['Дата', 'Артикул', 'Склад', 'diff_qty']]
+    arrivals = arrivals.rename(columns={'Склад': 'Склад_куда', 'diff_qty': 'Кол-во'}).sort_values('Дата')
+    shipments = df_daily.loc[df_daily['diff_qty'] < 0, ['Дата', 'Артикул', 'Склад', 'diff_qty']]
+    shipments = shipments.rename(columns={'Дата': 'Дата_отправки', 'Склад': 'Склад_откуда',
+                                          'diff_qty': 'Кол-во_отправлено'})
+    shipments['Кол-во_отправлено'] = -shipments['Кол-во_отправлено']
+    shipments = shipments.sort_values('Дата_отправки')
+
+    parts = []
+    for sklad, left in arrivals.groupby('Склад_куда', sort=False, observed=True):
+        right = shipments[shipments['Склад_откуда'] != sklad]
+        for offset in sorted(range(-int(qty_tolerance), int(qty_tolerance) + 1), key=abs):
+            matched = pd.merge_asof(
+                left, right.assign(**{'Кол-во': right['Кол-во_отправлено'] + offset}),
+                left_on='Дата', right_on='Дата_отправки', by=['Артикул', 'Кол-во'],
+                tolerance=pd.Timedelta(days=max_lag_days), direction='backward'
+            )
+            parts.append(matched[matched['Склад_откуда'].notna()])
+    moves = pd.concat(parts, ignore_index=True)
+    return (
+        moves.assign(_qty_gap=(moves['Кол-во'] - moves['Кол-во_отправлено']).abs(),
+                     _lag=moves['Дата'] - moves['Дата_отправки'])
+        .sort_values(['_qty_gap', '_lag', 'Дата'], kind='stable')
+        .drop_duplicates(['Дата', 'Артикул', 'Склад_куда'])
+        .drop_duplicates(['Дата_отправки', 'Артикул', 'Склад_откуда'])
+    )
+
+
+def bench_warehouse_transfers(n_articles=1500, n_days=60, lag=2):
+    """
+    Масштабирование сопоставления перемещений по числу складов: прежний проход
+    по каждому складу-получателю против одного соединения по корзинам дат.
+    Результаты могут отличаться только выбором склада-отправителя при равных
+    кандидатах (одна дата отправки и одно количество на нескольких складах).
+    """
+    for n_sklads in (2, 4, 8, 16):
+        sklads = tuple(f'Склад {i}' for i in range(n_sklads))
+        df_all = make_daily_snapshots(n_articles, n_days, sklads=sklads, transfer_lag=lag)
+        df_daily = analyze.build_daily_diffs(schema.apply_schema(df_all))
+
+        start = time.perf_counter()
+        legacy = _per_warehouse_lagged_transfers(df_daily, lag + 1)
+        legacy_time = time.perf_counter() - start
+        start = time.perf_counter()
+        moves = transfers.find_lagged_transfers(df_daily, lag + 1)
+        new_time = time.perf_counter() - start
+
+        keys = ['Дата', 'Артикул', 'Склад_куда']
+        same = len(legacy[keys].merge(moves[keys]))
+        print(f'{n_sklads:>2} складов, {len(df_daily)} строк: перемещений {len(legacy)} / {len(moves)}, '
+              f'общих пополнений {same}; по складам {legacy_time:.3f} с, соединение {new_time:.3f} с '
+              f'(x{legacy_time / new_time:.1f})')
+
+
+def _legacy_aggregate_monthly(df_daily):
+    """Исходная месячная агрегация: три groupby с лямбдами и слиянием результатов."""
+    df_unique_price = df_daily.groupby(['Артикул', 'Склад', 'Дата'], as_index=False)['Цена'].first()
+
+    price_counts = df_unique_price.groupby([
+        'Артикул', 'Склад',
+        df_unique_price['Дата'].dt.year.rename('Год'),
+        df_unique_price['Дата'].dt.month.rename('Месяц'),
+        'Цена'
+    ])['Дата'].nunique().reset_index(name='Дней_с_ценой')
+
+    pd.merge(
+        df_unique_price,
+        price_counts[['Артикул', 'Склад', 'Год', 'Месяц', 'Цена']],
+        on=['Артикул', 'Склад', 'Цена'],
+        how='inner'
+    )
+
+    price_stats = df_unique_price.groupby(['Артикул', 'Склад', df_unique_price['Дата'].dt.year.rename('Год'),
+                                           df_unique_price['Дата'].dt.month.rename('Месяц')]).agg(
+        Мин_цена=('Цена', 'min'),
+        Макс_цена=('Цена', 'max')
+    ).reset_index()
+
+    df_sales = df_daily.groupby(['Артикул', 'Склад', 'Год', 'Месяц']).agg(
+        Номенклатура=('Номенклатура', 'first'),
+        Производитель=('Производитель', 'first'),
+        Всего_продано=('Продано', 'sum'),
+        Всего_пополнено=('Пополнение', 'sum'),
+        Дней_продаж=('Продано', lambda x: (x > 0).sum()),
+        Средняя_цена=('Цена', 'mean'),
+        Дней_в_наличии=('Количество', lambda x: (x > 0).sum()),
+        Последний_остаток=('Количество', 'last'),
+        Уникальных_дней=('Дата', 'nunique')
+    ).reset_index()
+
+    df_sales['Дней_в_наличии'] = df_sales[['Дней_в_наличии', 'Уникальных_дней']].min(axis=1)
+    df_sales['Оборачиваемость'] = df_sales['Всего_продано'] / df_sales['Дней_продаж'].replace(0, 1)
+
+    df_price = df_daily.sort_values('Дата').groupby(['Артикул', 'Склад', 'Год', 'Месяц']).agg(
+        Цена_в_начале=('Цена', 'first'),
+        Цена_в_конце=('Цена', 'last')
+    ).reset_index()
+
+    df_price['Изменение_цены_абс'] = df_price['Цена_в_конце'] - df_price['Цена_в_начале']
+    df_price['Изменение_цены_%'] = ((df_price['Цена_в_конце'] / df_price['Цена_в_начале']) - 1) * 100
+    df_price['Изменение_цены_%'] = df_price['Изменение_цены_%'].fillna(0)
+    df_price['Изменение_цены_абс'] = df_price['Изменение_цены_абс'].fillna(0)
+
+    df_sales = df_sales.merge(price_stats, on=['Артикул', 'Склад', 'Год', 'Месяц'], how='left')
+    return df_sales.merge(df_price, on=['Артикул', 'Склад', 'Год', 'Месяц'], how='left')
+
+
+def bench_monthly(n_articles=6000, n_days=90):
+    """Сверка однопроходной месячной агрегации с исходной и замер ускорения."""
+    df_daily = analyze.build_daily_diffs(make_daily_snapshots(n_articles, n_days))
+    df_daily, _ = transfers.reconcile_transfers(df_daily)
+
+    start = time.perf_counter()
+    legacy = _legacy_aggregate_monthly(df_daily)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new = analyze.aggregate_monthly(df_daily)
+    new_time = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(legacy, new)
+    print(f'{len(df_daily)} дневных строк → {len(new)} месячных: результаты совпадают')
+    print(f'три groupby с лямбдами: {legacy_time:.3f} с, один проход: {new_time:.3f} с '
+          f'(x{legacy_time / new_time:.1f})')
+
+
+def bench_schema(n_articles=6000, n_days=90):
+    """Память и время дневного и месячного этапов на исходных и компактных типах."""
+    df_all = make_daily_snapshots(n_articles, n_days)
+    for label, df in [('object/float64', df_all), ('category/downcast', schema.apply_schema(df_all))]:
+        memory_mb = df.memory_usage(deep=True).sum() / 1024 / 1024
+        start = time.perf_counter()
+        df_daily = analyze.build_daily_diffs(df)
+        df_daily, _ = transfers.reconcile_transfers(df_daily)
+        analyze.aggregate_monthly(df_daily)
+        duration = time.perf_counter() - start
+        daily_mb = df_daily.memory_usage(deep=True).sum() / 1024 / 1024
+        print(f'{label}: снимки {memory_mb:.0f} МБ, дневные {daily_mb:.0f} МБ, '
+              f'дневной + месячный этап {duration:.2f} с')
+
+
+def bench_delta_store(n_articles=20000, n_days=120, sales_rate=0.05):
+    """
+    Полные снимки против дельт: объём хранения и время дневного и месячного этапов.
+    Месячные итоги и дневные продажи по дельтам сверяются с расчётом по полным снимкам.
+    """
+    df_all = analyze.prepare_snapshots(make_daily_snapshots(n_articles, n_days, sales_rate=sales_rate))
+
+    start = time.perf_counter()
+    df_daily = analyze.build_daily_diffs(df_all)
+    df_daily, _ = transfers.reconcile_transfers(df_daily)
+    dense = analyze.aggregate_monthly(df_daily)
+    dense_sales = analyze.build_daily_sales(df_all)
+    dense_time = time.perf_counter() - start
+
+    calendar = delta_store.build_calendar(df_all)
+    deltas = delta_store.encode(delta_store.daily_values(df_all), calendar)
+    start = time.perf_counter()
+    df_daily = delta_store.daily_diffs(deltas, calendar)
+    df_daily, _ = transfers.reconcile_transfers(df_daily)
+    delta = analyze.aggregate_monthly(df_daily)
+    delta_sales = delta_store.daily_sales(deltas, calendar)
+    delta_time = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(dense, delta, check_dtype=False)
+    pd.testing.assert_frame_equal(dense_sales.reset_index(drop=True), delta_sales, check_dtype=False)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        df_all.to_parquet(os.path.join(tmp, 'снимки.parquet'), index=False)
+        deltas.to_parquet(os.path.join(tmp, 'дельты.parquet'), index=False)
+        calendar.to_parquet(os.path.join(tmp, 'календарь.parquet'), index=False)
+        size = {name: os.path.getsize(os.path.join(tmp, f'{name}.parquet')) / 1024 / 1024
+                for name in ['снимки', 'дельты', 'календарь']}
+    print(f'{len(df_all)} строк снимков → {len(deltas)} дельт (x{len(df_all) / len(deltas):.0f}), '
+          f'результаты совпадают')
+    print(f'Parquet: снимки {size["снимки"]:.1f} МБ, дельты и календарь {size["дельты"] + size["календарь"]:.1f} МБ')
+    print(f'дневной и месячный этапы с дневными продажами: по снимкам {dense_time:.2f} с, '
+          f'по дельтам {delta_time:.2f} с (x{dense_time / delta_time:.1f})')
+
+
+def bench_normalization(n_articles=20000, n_days=50):
+    """Построчный .apply против векторной нормализации уникальных значений."""
+    df_all = schema.apply_schema(make_daily_snapshots(n_articles, n_days, transfer_rate=0))
+    articles = df_all['Артикул'].astype(object)
+
+    def legacy(article):
+        if not isinstance(article, str):
+            return article
+        return article.replace('-', '').replace(' ', '').replace('_', '').upper()
+
+    start = time.perf_counter()
+    expected = articles.apply(legacy)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = normalization.normalize_articles(df_all['Артикул'], persist=False)
+    new_time = time.perf_counter() - start
+
+    assert (result.astype(object) == expected).all()
+    print(f'{len(articles)} строк, {articles.nunique()} уникальных артикулов: результаты совпадают')
+    print(f'.apply по строкам: {legacy_time:.3f} с, по уникальным значениям: {new_time:.3f} с '
+          f'(x{legacy_time / new_time:.0f})')
+
+
+def make_catalog(n_articles=3000, typo_rate=0.05, seed=0):
+    """Синтетический каталог: артикулы-коды и часть «опечаток» (одна изменённая буква)."""
+    rng = np.random.default_rng(seed)
+    letters = np.array(list('ABCDEFGHJKLMNPRSTUVXYZ0123456789'))
+    codes = [''.join(rng.choice(letters, 8)) for _ in range(n_articles)]
+    typos = []
+    for code in rng.choice(codes, int(n_articles * typo_rate), replace=False):
+        pos = rng.integers(len(code))
+        typos.append(code[:pos] + rng.choice(letters) + code[pos + 1:])
+    articles = codes + typos
+    words = np.array(['фильтр', 'масляный', 'воздушный', 'колодки', 'тормозные', 'передние', 'задние',
+                      'ремень', 'грм', 'свеча', 'зажигания', 'комплект', 'датчик', 'насос'])
+    names = [' '.join(rng.choice(words, 4, replace=False)) + f' {i % 50}' for i in range(len(articles))]
+    return pd.DataFrame({'Номенклатура': names, 'Артикул': articles})
+
+
+def _naive_similar_pairs(values, tokenize, threshold):
+    grams = [tokenize(v) for v in values]
+    found = set()
+    for i in range(len(values)):
+        for j in range(i + 1, len(values)):
+            shared = len(grams[i] & grams[j])
+            if shared and shared / (len(grams[i]) + len(grams[j]) - shared) >= threshold:
+                found.add((i, j))
+    return found
+
+
+def bench_duplicates(n_small=1500, n_large=100000):
+    """Попарное сравнение против блокировки по n-граммам; затем масштаб каталога."""
+    articles = pd.Index(make_catalog(n_small)['Артикул'].unique())
+
+    start = time.perf_counter()
+    expected = _naive_similar_pairs(articles, duplicates.char_ngrams, 0.6)
+    naive_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = duplicates.similar_pairs(articles, duplicates.char_ngrams, 0.6)
+    new_time = time.perf_counter() - start
+
+    assert set(zip(result['id_1'], result['id_2'])) == expected
+    print(f'{len(articles)} артикулов, {len(expected)} похожих пар: результаты совпадают')
+    print(f'попарно: {naive_time:.3f} с, с блокировкой: {new_time:.3f} с (x{naive_time / new_time:.0f})')
+
+    catalog = make_catalog(n_large)
+    start = time.perf_counter()
+    candidates = duplicates.find_near_duplicates(duplicates.unique_pairs(catalog.astype('category')))
+    print(f'{len(catalog)} пар артикул/наименование: {len(candidates)} кандидатов '
+          f'за {time.perf_counter() - start:.2f} с')
+
+
+def make_monthly_sales(n_series=20000, n_months=24, gap_rate=0.05, seed=0):
+    """
+    Синтетический месячный итог: ряды (Артикул, Склад) разной длины с редким спросом,
+    пустыми продажами и пропущенными месяцами (товара не было в снимках).
+    """
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, n_months + 1, n_series)
+    series = np.repeat(np.arange(n_series), lengths)
+    month = np.concatenate([np.arange(n) for n in lengths])
+    sales = rng.poisson(3, len(series)).astype(np.float32) * rng.integers(1, 4, len(series))
+    sales[rng.random(len(series)) < 0.3] = 0
+    sales[rng.random(len(series)) < 0.02] = np.nan
+    date = pd.Timestamp('2023-01-01') + pd.to_timedelta(month * 31, unit='D')
+    df = pd.DataFrame({
+        'Артикул': [f'A{i // 2:06d}' for i in series],
+        'Склад': np.where(series % 2 == 0, 'Москва', 'Хабаровск'),
+        'Год': date.year.astype(np.int16),
+        'Месяц': date.month.astype(np.int8),
+        'Дата': date.to_period('M').to_timestamp(),
+        'Всего_продано': sales,
+    })
+    df = df[rng.random(len(df)) >= gap_rate]
+    return df.sort_values(['Артикул', 'Склад', 'Дата']).reset_index(drop=True)
+
+
+def _legacy_find_sales_spikes(df, window=3, spike_factor=1.5):
+    """Исходный поиск всплесков: rolling в лямбде на каждый ряд, один вариант за запуск."""
+    df = df.copy()
+    df['Среднее_последних_месяцев'] = df.groupby(['Артикул', 'Склад'])['Всего_продано']\
+        .transform(lambda x: x.rolling(window=window, min_periods=1).mean().shift(1))
+    df['Всплеск'] = df['Всего_продано'] > (df['Среднее_последних_месяцев'] * spike_factor)
+    df['Всплеск'] = df['Всплеск'].fillna(False)
+    return df
+
+
+def bench_spikes(n_series=5000, windows=(2, 3, 6, 12), factors=(1.3, 1.5, 2.0)):
+    """Сверка векторного поиска всплесков с исходным и замер на сетке окон и коэффициентов."""
+    df = make_monthly_sales(n_series)
+    # Перемешанный порядок строк: движок не должен полагаться на сортировку по рядам
+    shuffled = df.sample(frac=1, random_state=0)
+
+    start = time.perf_counter()
+    legacy = [_legacy_find_sales_spikes(shuffled, w, f) for w in windows for f in factors]
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    grid = spike_analysis.find_sales_spikes_grid(shuffled, windows, factors)
+    grid_time = time.perf_counter() - start
+
+    for i, expected in enumerate(legacy):
+        variant = grid.iloc[i * len(df):(i + 1) * len(df)].drop(columns=['Окно', 'Коэффициент'])
+        pd.testing.assert_frame_equal(expected, variant.set_axis(expected.index), check_exact=False)
+    single = spike_analysis.find_sales_spikes(shuffled, windows[0], factors[0])
+    pd.testing.assert_frame_equal(legacy[0], single)
+    print(f'{len(df)} месячных строк, {len(windows) * len(factors)} вариантов: результаты совпадают')
+    print(f'rolling в лямбде по вариантам: {legacy_time:.2f} с, накопленные суммы по сетке: {grid_time:.2f} с '
+          f'(x{legacy_time / grid_time:.1f})')
+
+
+def _reference_detector(df, method, window, min_periods=3, min_scale=1.0):
+    """Детектор по одному ряду средствами pandas (rolling/ewm/shift на полном календаре месяцев)."""
+    first = (df['Год'].astype(int) * 12 + df['Месяц'].astype(int) - 1).min()
+    month = df['Год'].astype(int) * 12 + df['Месяц'].astype(int) - 1 - first
+    baseline = pd.Series(np.nan, index=df.index)
+    score = pd.Series(np.nan, index=df.index)
+    for _, group in df.groupby(['Артикул', 'Склад']):
+        months = month[group.index]
+        values = pd.Series(group['Всего_продано'].to_numpy(dtype=np.float64), index=months.to_numpy())
+        values = values.reindex(np.arange(months.min(), months.max() + 1))
+        if method == 'mad':
+            rolling = values.rolling(window, min_periods=min_periods)
+            base = rolling.median().shift(1)
+            mad = rolling.apply(lambda a: np.nanmedian(np.abs(a - np.nanmedian(a))), raw=True).shift(1)
+            scale = spike_detectors.MAD_SCALE * mad
+        elif method == 'ewma':
+            ewm = values.ewm(alpha=2 / (window + 1), adjust=False, ignore_na=True, min_periods=min_periods)
+            base = ewm.mean().shift(1)
+            scale = np.sqrt(ewm.var(bias=True)).shift(1)
+            seen = values.notna().cumsum().shift(1)
+            base, scale = base.where(seen >= min_periods), scale.where(seen >= min_periods)
+        else:
+            previous = pd.concat([values.shift(12 * years) for years in range(1, window + 1)], axis=1)
+            base = previous.mean(axis=1)
+            scale = np.sqrt(base)
+        values_score = (values - base) / np.maximum(scale, min_scale)
+        baseline[group.index] = base.reindex(months.to_numpy()).to_numpy()
+        score[group.index] = values_score.reindex(months.to_numpy()).to_numpy()
+    return baseline, score
+
+
+def bench_spike_detectors(n_check=1500, n_series=200000, n_months=36):
+    """Сверка матричных детекторов с расчётом по рядам в pandas и время на полном каталоге."""
+    df = make_monthly_sales(n_check, n_months).sample(frac=1, random_state=0)
+    for method, window in [('mad', 6), ('ewma', 6), ('seasonal', 2)]:
+        result = spike_detectors.detect_spikes(df, method, [window])
+        baseline, score = _reference_detector(df, method, window)
+        np.testing.assert_allclose(result['Базовый_уровень'], baseline, rtol=1e-9, equal_nan=True)
+        np.testing.assert_allclose(result['Оценка'], score, rtol=1e-9, atol=1e-9, equal_nan=True)
+    print(f'{len(df)} строк: mad, ewma и seasonal совпадают с расчётом по рядам в pandas')
+
+    df = make_monthly_sales(n_series, n_months)
+    df_mean = spike_analysis.find_sales_spikes_grid(df)
+    print(f'{n_series} рядов × {n_months} месяцев ({len(df)} строк), всплесков по правилу среднее × 1.5: '
+          f'{int(df_mean["Всплеск"].sum())}')
+    for method in spike_detectors.DETECTORS:
+        start = time.perf_counter()
+        result = spike_detectors.detect_spikes(df, method, [6 if method != 'seasonal' else 2])
+        duration = time.perf_counter() - start
+        is_intermittent = (df['Всего_продано'] == 0).groupby([df['Артикул'], df['Склад']]).transform('mean') > 0.3
+        print(f'{method}: {duration:.2f} с, всплесков {int(result["Всплеск"].sum())}, '
+              f'из них на товарах с редким спросом {int(result["Всплеск"][is_intermittent.to_numpy()].sum())} '
+              f'(правило среднего: {int(df_mean["Всплеск"][is_intermittent.to_numpy()].sum())})')
+
+
+def make_dashboard_data(workdir, n_articles=4000, n_days=120):
+    """
+    Синтетические входные данные дашборда в workdir: data/itog.parquet и хранилище результатов
+    (месячный итог и топы) — как после запуска analyze.py.
+    """
+    df_all = make_daily_snapshots(n_articles, n_days)
+    df_daily = analyze.build_daily_diffs(df_all)
+    df_daily, _ = transfers.reconcile_transfers(df_daily)
+    df_result = analyze.finalize_monthly(analyze.aggregate_monthly(df_daily))
+    df_total = analyze.build_totals(df_result)
+    tops = analyze.build_tops(df_total)
+    artifact_store.publish({
+        'итог_по_месяцу': (df_result, ['Склад', 'Год', 'Месяц'], analyze.MONTH_KEYS),
+        **{name: (df, None, None) for name, df in tops.items()},
+    }, store_dir=os.path.join(workdir, artifact_store.STORE_DIR))
+
+    itog = df_all.rename(columns={'Количество': 'Остаток'})
+    itog['Дата'] = itog['Дата'].dt.strftime('%Y-%m-%d 15:00:00')
+    itog['Номенклатура'] = itog['Номенклатура'] + ' насос форсунка 0414799005/A0280745902'
+    itog['Артикул_товар'] = itog['Артикул'] + '|' + itog['Номенклатура']
+    itog['Номенклатура_канон'] = itog['Номенклатура']
+    itog['Продано'] = df_daily['Продано'].reindex(itog.index).fillna(0).to_numpy()
+    os.makedirs(os.path.join(workdir, 'data'), exist_ok=True)
+    itog.to_parquet(os.path.join(workdir, 'data', 'itog.parquet'), index=False)
+    return itog
+
+
+def _scan_item_rows(df, article=None, nom=None, sklads=None):
+    """Прежний поиск рядов для графика 2025: фильтры по всей таблице и по каждому складу."""
+    if article:
+        df = df[df['Артикул_товар'].astype(str) == str(article)]
+    if nom:
+        df = df[df['Номенклатура_канон'] == nom]
+    if sklads:
+        df = df[df['Склад'].isin(sklads)]
+    return {sklad: df[df['Склад'] == sklad].sort_values('Дата') for sklad in df['Склад'].unique()}
+
+
+def bench_item_index(sizes=(500, 4000), n_days=120, lookups=50):
+    """Сверка поиска рядов товара по индексу отрезков с полным просмотром таблицы и замер на двух размерах."""
+    import dashboard
+
+    for n_articles in sizes:
+        df_all = make_daily_snapshots(n_articles, n_days)
+        itog = df_all.rename(columns={'Количество': 'Остаток'})
+        itog['Артикул_товар'] = itog['Артикул'] + '|' + itog['Номенклатура']
+        itog['Номенклатура_канон'] = itog['Номенклатура']
+        itog = itog.sample(frac=1, random_state=0).reset_index(drop=True)
+
+        start = time.perf_counter()
+        ordered = dashboard.sort_by_item(itog)
+        blocks = dashboard.build_item_blocks(ordered)
+        index = dashboard.build_item_index(blocks)
+        build_time = time.perf_counter() - start
+
+        rng = np.random.default_rng(0)
+        articles = rng.choice(itog['Артикул_товар'].unique(), lookups)
+        sklads = sorted(itog['Склад'].unique())
+        start = time.perf_counter()
+        expected = [_scan_item_rows(itog, article, None, sklads) for article in articles]
+        scan_time = (time.perf_counter() - start) / lookups
+        start = time.perf_counter()
+        found = [dashboard.item_rows(ordered, blocks, index, article, None, sklads) for article in articles]
+        index_time = (time.perf_counter() - start) / lookups
+
+        for old, new in zip(expected, found):
+            assert old.keys() == new.keys()
+            for sklad in old:
+                pd.testing.assert_frame_equal(old[sklad].reset_index(drop=True), new[sklad].reset_index(drop=True))
+        print(f'{len(itog)} строк, {len(blocks)} отрезков: индекс строится {build_time:.2f} с, ряды совпадают')
+        print(f'  на товар: просмотр таблицы {scan_time * 1000:.1f} мс, индекс {index_time * 1000:.2f} мс')
+
+
+def _memory_kb(pid):
+    """
+    Rss, Pss и Private_Dirty процесса по /proc/<pid>/smaps_rollup, КБ. Private_Dirty — память,
+    которую занимает только этот процесс (куча и страницы, скопированные после fork);
+    отображённые файлы сюда не входят: их страницы в кэше ОС общие для всех процессов.
+    """
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            key, _, rest = line.partition(':')
+            if key in ('Rss', 'Pss', 'Private_Dirty'):
+                values[key] = int(rest.split()[0])
+    return values['Rss'], values['Pss'], values['Private_Dirty']
+
+
+def _processes_memory(pid):
+    return [_memory_kb(pid)] + [_memory_kb(child) for child in _children(pid)]
+
+
+def _children(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+
+def _cpu_ticks(pids):
+    total = 0
+    for pid in pids:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        total += int(fields[11]) + int(fields[12])
+    return total
+
+
+def _dash_update(port, output, inputs):
+    """Вызов колбэка Dash так же, как это делает страница."""
+    component, prop = output.split('.')
+    body = json.dumps({
+        'output': output, 'outputs': {'id': component, 'property': prop},
+        'inputs': [{'id': i, 'property': p, 'value': v} for i, p, v in inputs],
+        'changedPropIds': [f'{i}.{p}' for i, p, _ in inputs], 'state': [],
+    }).encode('utf-8')
+    request = urllib.request.Request(f'http://127.0.0.1:{port}/_dash-update-component', data=body,
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=120) as response:
+        return response.status
+
+
+def _run_gunicorn(workdir, workers, preload, shared, requests):
+    """
+    Запускает дашборд под gunicorn и возвращает память процессов (главный первым)
+    после загрузки данных и после прогона запросов.
+    """
+    shutil.rmtree(os.path.join(workdir, 'кэш'), ignore_errors=True)
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    env = {**os.environ, 'DASHBOARD_SHARED_FRAMES': '1' if shared else '0',
+           'PYTHONPATH': os.path.dirname(os.path.abspath(__file__))}
+    # Каталог с данными — временный, поэтому настройки (хук --preload) указываются явно
+    config = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py')
+    command = [sys.executable, '-m', 'gunicorn', 'dashboard:server', '--config', config, '--workers', str(workers),
+               '--bind', f'127.0.0.1:{port}', '--timeout', '600'] + (['--preload'] if preload else [])
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + 600
+        while True:
+            try:
+                urllib.request.urlopen(f'http://127.0.0.1:{port}/_dash-layout', timeout=5)
+                break
+            except OSError:
+                if process.poll() is not None or time.time() > deadline:
+                    raise RuntimeError('gunicorn не запустился')
+                time.sleep(0.5)
+        # Все рабочие процессы загрузили данные, когда их процессорное время перестаёт расти
+        ticks = -1
+        while ticks != _cpu_ticks([process.pid, *_children(process.pid)]):
+            ticks = _cpu_ticks([process.pid, *_children(process.pid)])
+            time.sleep(2)
+        loaded = _processes_memory(process.pid)
+        for _ in range(requests):
+            for output, inputs in REQUESTS:
+                _dash_update(port, output, inputs)
+        served = _processes_memory(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+    return loaded, served
+
+
+# Запросы, затрагивающие большие таблицы дашборда
+REQUESTS = [
+    ('top-100-table.data', [('sklad-2025-filter', 'value', ['Москва', 'Хабаровск'])]),
+    ('graph-2025-line.figure', [('sklad-2025-filter', 'value', ['Москва']), ('article-2025-filter', 'value', None),
+                                ('nom-2025-filter', 'value', 'Товар 7 насос форсунка 0414799005/A0280745902'),
+                                ('chart-width', 'data', 1200), ('graph-2025-line', 'relayoutData', None)]),
+    ('graph-top-fast.figure', [('sklad-filter', 'value', ['Москва', 'Хабаровск']), ('top-n-selector', 'value', 100),
+                               ('data-version', 'data', None)]),
+]
+
+
+def bench_dashboard_memory(workers=4, n_articles=4000, n_days=120, requests=4):
+    """
+    Память процессов gunicorn с дашбордом: таблицы в памяти каждого процесса и общие
+    Arrow-файлы через mmap, с --preload и без. Rss считает общие страницы в каждом процессе,
+    поэтому главное — Pss (общие страницы делятся между процессами) и собственная память.
+    После запросов собственная память растёт и от временных таблиц колбэков, которые
+    распределитель памяти не возвращает системе.
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        itog = make_dashboard_data(workdir, n_articles, n_days)
+        print(f'data/itog.parquet: {len(itog)} строк, в pandas {itog.memory_usage(deep=True).sum() / 1024 ** 2:.0f} МБ; '
+              f'рабочих процессов: {workers}')
+        for label, preload, shared in [
+            ('в памяти процессов', False, False),
+            ('в памяти процессов, --preload', True, False),
+            ('Arrow через mmap', False, True),
+            ('Arrow через mmap, --preload', True, True),
+        ]:
+            start = time.perf_counter()
+            snapshots = _run_gunicorn(workdir, workers, preload, shared, requests)
+            print(f'{label} (запуск и запросы {time.perf_counter() - start:.0f} с):')
+            for stage, memory in zip(['после загрузки', 'после запросов'], snapshots):
+                rss, pss, private = (np.mean([m[i] for m in memory[1:]]) / 1024 for i in range(3))
+                total_pss = sum(m[1] for m in memory) / 1024
+                print(f'  {stage}: на рабочий процесс Rss {rss:.0f} МБ, Pss {pss:.0f} МБ, '
+                      f'собственная {private:.0f} МБ; всего Pss {total_pss:.0f} МБ')
+
+
+def _legacy_line_traces(series):
+    """Прежние следы графика остатков 2025: цвета и размеры через apply по строкам, подписи — списками."""
+    import plotly.graph_objs as go
+
+    traces = []
+    for sklad, df_s in series.items():
+        df_s = df_s.copy()
+        df_s['Продано_fix'] = (df_s['Остаток'].shift(1) - df_s['Остаток']).clip(lower=0).fillna(0)
+        df_s['Пополнено_fix'] = (df_s['Остаток'] - df_s['Остаток'].shift(1)).clip(lower=0).fillna(0)
+        df_s['Среднее_Продано'] = df_s['Продано_fix'].rolling(window=7, min_periods=1).mean()
+        df_s['Всплеск'] = df_s['Продано_fix'] > 1.5 * df_s['Среднее_Продано']
+        df_s['Цена_изменилась'] = df_s['Цена'].diff().fillna(0) != 0
+        df_s['Цвет'] = df_s.apply(
+            lambda row: 'purple' if row['Всплеск'] and row['Цена_изменилась']
+                        else 'red' if row['Всплеск']
+                        else 'orange' if row['Цена_изменилась']
+                        else 'blue',
+            axis=1
+        )
+        df_s['Размер'] = df_s['Всплеск'].apply(lambda x: 10 if x else 5)
+        traces.append(go.Scatter(
+            x=df_s['Дата'], y=df_s['Остаток'], mode='lines+markers', name=str(sklad),
+            marker=dict(size=df_s['Размер'], color=df_s['Цвет']),
+            text=[sklad] * len(df_s),
+            customdata=df_s[['Продано_fix', 'Пополнено_fix', 'Цена', 'Артикул_товар', 'Номенклатура_канон',
+                             'Всплеск', 'Цена_изменилась']].values,
+            showlegend=False
+        ))
+    return go.Figure(traces)
+
+
+def make_item_history(n_sklads=4, n_days=1500, seed=0):
+    """Ряды одного товара на нескольких складах: {склад: строки по датам} — как у графика остатков 2025."""
+    rng = np.random.default_rng(seed)
+    series = {}
+    for i in range(n_sklads):
+        stock = np.maximum(0, 200 + np.cumsum(rng.integers(-6, 5, n_days)))
+        stock[rng.random(n_days) < 0.03] += rng.integers(50, 300)
+        series[f'Склад {i}'] = pd.DataFrame({
+            'Дата': pd.date_range('2021-01-01', periods=n_days, freq='D'),
+            'Остаток': stock.astype(float),
+            'Цена': 1000.0 + 50 * np.cumsum(rng.random(n_days) < 0.02),
+            'Артикул_товар': 'A-100|Насос',
+            'Номенклатура_канон': 'Насос',
+        })
+    return series
+
+
+def bench_line_figure(n_sklads=4, sizes=(120, 1500), repeats=5):
+    """Сверка векторного построения графика остатков 2025 с прежним и замер построения и сериализации."""
+    import dashboard
+    import plotly.graph_objs as go
+
+    for n_days in sizes:
+        series = make_item_history(n_sklads, n_days)
+        trace_type = go.Scattergl if n_sklads * n_days > dashboard.WEBGL_POINTS else go.Scatter
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            legacy = _legacy_line_traces(series)
+            legacy_json = legacy.to_json()
+        legacy_time = (time.perf_counter() - start) / repeats
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fig = go.Figure([dashboard.line_trace(sklad, dashboard.line_points(df_s), trace_type)
+                             for sklad, df_s in series.items()])
+            fig_json = fig.to_json()
+        new_time = (time.perf_counter() - start) / repeats
+
+        for old, new in zip(legacy.data, fig.data):
+            np.testing.assert_array_equal(np.asarray(old.y, dtype=float), new.y)
+            colors = [dashboard.LINE_LEGEND[dashboard.LINE_MARKS[mark]] for mark in new.marker.color]
+            assert list(old.marker.color) == colors
+            assert list(old.marker.size) == list(new.marker.size)
+            np.testing.assert_array_equal(np.asarray(old.customdata[:, :3], dtype=float), new.customdata)
+        print(f'{n_sklads} склада × {n_days} дней ({type(fig.data[0]).__name__}): следы совпадают')
+        print(f'  apply по строкам: {legacy_time * 1000:.0f} мс, {len(legacy_json) / 1024:.0f} КБ; '
+              f'NumPy: {new_time * 1000:.0f} мс, {len(fig_json) / 1024:.0f} КБ')
+
+
+def _line_figure(series, width=None, zoom=None):
+    """График остатков 2025 как в колбэке: без width — все точки, иначе — прореженные по ширине."""
+    import dashboard
+    import plotly.graph_objs as go
+
+    traces = []
+    for sklad, df_s in series.items():
+        points = dashboard.line_points(df_s)
+        if width is not None:
+            keep = points['Отметка'].to_numpy() > 0
+            budget = downsampling.point_budget(width)
+            points = points.iloc[downsampling.select_points(points['Дата'], points['Остаток'], budget, keep, zoom)]
+        traces.append(dashboard.line_trace(sklad, points, go.Scattergl))
+    return go.Figure(traces)
+
+
+def bench_downsampling(n_sklads=4, n_days=3650, width=1200, repeats=3):
+    """
+    Проверка прореживания графика остатков (огибающая ряда и отмеченные точки сохраняются)
+    и замер построения и объёма графика: все точки, прореженные и увеличенный фрагмент.
+    """
+    import dashboard
+
+    series = make_item_history(n_sklads, n_days)
+    budget = downsampling.point_budget(width)
+    for sklad, fig_data in zip(series, _line_figure(series, width).data):
+        full = dashboard.line_points(series[sklad])
+        chosen = pd.DataFrame({'Дата': pd.to_datetime(fig_data.x), 'Остаток': fig_data.y})
+        marked = full[full['Отметка'] > 0]
+        if len(marked) <= budget:
+            assert set(marked['Дата']) <= set(chosen['Дата'])
+        # В каждом отрезке оси X крайние значения ряда совпадают с полными
+        edges = pd.date_range(full['Дата'].iloc[0], full['Дата'].iloc[-1], periods=(budget - 2) // 2 + 1)
+        for data in (full, chosen):
+            data['Отрезок'] = np.searchsorted(edges, data['Дата'], side='right')
+        expected = full.groupby('Отрезок')['Остаток'].agg(['min', 'max'])
+        pd.testing.assert_frame_equal(chosen.groupby('Отрезок')['Остаток'].agg(['min', 'max']), expected)
+
+    dates = series[next(iter(series))]['Дата']
+    zoom = (dates.iloc[n_days // 2], dates.iloc[n_days // 2 + 90])
+    print(f'{n_sklads} склада × {n_days} дней, ширина {width} px: огибающая и отметки сохранены')
+    for title, options in [('все точки', {}), ('прореженные', {'width': width}),
+                           ('увеличено до 90 дней', {'width': width, 'zoom': zoom})]:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fig_json = _line_figure(series, **options).to_json()
+        elapsed = (time.perf_counter() - start) / repeats
+        points = sum(len(trace['x']) for trace in json.loads(fig_json)['data'])
+        print(f'  {title}: {points} точек, {len(fig_json) / 1024:.0f} КБ, {elapsed * 1000:.0f} мс')
+
+
+INCREMENTAL_SKLADS = {'Москва': 'data/moscow', 'Хабаровск': 'data/khabarovsk'}
+
+
+def _incremental_stock(days, n_articles=12, seed=0):
+    """
+    Остатки по складам и дням для проверки инкрементального режима: случайные ряды и два перемещения
+    через границу месяца — Москва → Хабаровск 30 мая → 2 июня и 29 апреля → 2 мая, по 10 и 20 штук.
+    Пустое значение — артикула нет в снимке: ART005 пропадает в Москве с 25 мая по 3 июня,
+    ART902 появляется 4 июня.
+    """
+    rng = np.random.default_rng(seed)
+    stock = {}
+    for sklad in INCREMENTAL_SKLADS:
+        walk = 60 + np.cumsum(rng.integers(-3, 3, (len(days), n_articles)), axis=0)
+        stock[sklad] = pd.DataFrame(np.maximum(walk, 0), index=days,
+                                    columns=[f'ART{i:03d}' for i in range(n_articles)]).astype(float)
+        stock[sklad]['ART900'] = 100.0
+        stock[sklad]['ART901'] = 100.0
+    stock['Москва'].loc['2025-05-30':, 'ART900'] -= 10
+    stock['Хабаровск'].loc['2025-06-02':, 'ART900'] += 10
+    stock['Москва'].loc['2025-04-29':, 'ART901'] -= 20
+    stock['Хабаровск'].loc['2025-05-02':, 'ART901'] += 20
+    stock['Москва'].loc['2025-05-25':'2025-06-03', 'ART005'] = np.nan
+    for sklad in INCREMENTAL_SKLADS:
+        stock[sklad]['ART902'] = np.where(days >= pd.Timestamp('2025-06-04'), 30.0, np.nan)
+    return stock
+
+
+def _write_incremental_snapshots(workdir, stock, days):
+    with open(os.path.join(workdir, 'warehouses.json'), 'w', encoding='utf-8') as f:
+        json.dump({'warehouses': [{'name': name, 'folder': folder} for name, folder in INCREMENTAL_SKLADS.items()]},
+                  f, ensure_ascii=False)
+    for sklad, folder in INCREMENTAL_SKLADS.items():
+        os.makedirs(os.path.join(workdir, folder), exist_ok=True)
+        for day in days:
+            values = stock[sklad].loc[day]
+            write_snapshot_xlsx(os.path.join(workdir, folder, f'{day:%Y%m%d}.xlsx'), day, (
+                (f'Товар {article}', float(qty), 100.0, 'Производитель', article)
+                for article, qty in values.dropna().items()))
+
+
+def _published(workdir):
+    """Все наборы текущей версии хранилища workdir: {имя: DataFrame в едином порядке строк}."""
+    store_dir = os.path.join(workdir, artifact_store.STORE_DIR)
+    datasets = {}
+    for name in artifact_store.load_manifest(store_dir)['datasets']:
+        df = artifact_store.read_dataset(name, store_dir=store_dir, categories=False)
+        df = df[sorted(df.columns)]
+        datasets[name] = df.sort_values(list(df.columns), ignore_index=True)
+    return datasets
+
+
+def bench_incremental(lags=(0, 5), steps=('2025-04-30', '2025-05-31', '2025-06-03', '2025-06-05'),
+                      unreadable_step=2):
+    """
+    Сверка инкрементального режима с полным анализом: снимки добавляются по шагам (в том числе
+    после перемещений через границу месяца), после последнего шага все наборы хранилища
+    должны совпасть с полным запуском analyze.py на тех же файлах. Перед шагом unreadable_step
+    опубликованная месячная таблица удаляется: шаг должен перейти к полному пересчёту.
+    """
+    days = pd.date_range('2025-04-20', steps[-1])
+    stock = _incremental_stock(days)
+    cwd = os.getcwd()
+    for lag in lags:
+        with tempfile.TemporaryDirectory() as full_dir, tempfile.TemporaryDirectory() as steps_dir:
+            try:
+                os.chdir(full_dir)
+                _write_incremental_snapshots(full_dir, stock, days)
+                analyze.run_month_analysis(use_cache=False, transfer_lag_days=lag)
+
+                os.chdir(steps_dir)
+                durations = []
+                previous = days[0] - pd.Timedelta(days=1)
+                for step, cutoff in enumerate(pd.to_datetime(steps)):
+                    if step == unreadable_step:
+                        version = artifact_store.load_manifest()['version']
+                        shutil.rmtree(os.path.join(artifact_store.STORE_DIR, version, 'итог_по_месяцу'))
+                    _write_incremental_snapshots(steps_dir, stock, days[(days > previous) & (days <= cutoff)])
+                    start = time.perf_counter()
+                    incremental.update_monthly(transfer_lag_days=lag)
+                    durations.append(time.perf_counter() - start)
+                    previous = cutoff
+            finally:
+                os.chdir(cwd)
+
+            full, stepped = _published(full_dir), _published(steps_dir)
+            assert full.keys() == stepped.keys(), (full.keys(), stepped.keys())
+            for name in full:
+                pd.testing.assert_frame_equal(stepped[name], full[name], check_dtype=False, obj=name)
+            monthly = full['итог_по_месяцу']
+            moved = monthly[monthly['Артикул'].isin(['ART900', 'ART901'])]
+            print(f'задержка {lag} дн.: {len(steps)} шагов ({", ".join(f"{d:.2f}" for d in durations)} с) '
+                  f'совпадают с полным запуском по {len(full)} наборам; продано у перемещённых товаров '
+                  f'{moved["Всего_продано"].sum():.0f}')
+
+
+def bench_entry_points(lags=(0, 5), n_shards=3):
+    """
+    Сверка режимов запуска: analyze.py, pipeline.py, sharded.py и incremental.py на одних и тех же
+    снимках (с перемещениями через границу месяца, пропадающими и новыми артикулами) публикуют
+    одинаковые наборы; sharded.py дополнительно публикует итоги.
+    """
+    days = pd.date_range('2025-04-20', '2025-06-05')
+    stock = _incremental_stock(days)
+    runs = {
+        'analyze.py': lambda lag: analyze.run_month_analysis(use_cache=False, transfer_lag_days=lag),
+        'pipeline.py': lambda lag: pipeline.run(use_cache=False, transfer_lag_days=lag),
+        'sharded.py': lambda lag: sharded.run_sharded(n_shards=n_shards, use_cache=False, transfer_lag_days=lag),
+        'incremental.py': lambda lag: incremental.update_monthly(use_cache=False, transfer_lag_days=lag),
+    }
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as sources_dir:
+        _write_incremental_snapshots(sources_dir, stock, days)
+        for lag in lags:
+            published, durations = {}, {}
+            for name, run in runs.items():
+                with tempfile.TemporaryDirectory() as workdir:
+                    shutil.copytree(sources_dir, workdir, dirs_exist_ok=True)
+                    try:
+                        os.chdir(workdir)
+                        start = time.perf_counter()
+                        run(lag)
+                        durations[name] = time.perf_counter() - start
+                    finally:
+                        os.chdir(cwd)
+                    published[name] = _published(workdir)
+
+            expected = published['analyze.py']
+            for name, datasets in published.items():
+                assert expected.keys() <= datasets.keys(), (name, expected.keys(), datasets.keys())
+                for dataset in expected:
+                    pd.testing.assert_frame_equal(datasets[dataset], expected[dataset], check_dtype=False,
+                                                  obj=f'{name}: {dataset}')
+            print(f'задержка {lag} дн.: {len(expected)} наборов совпадают; '
+                  + ', '.join(f'{name} {duration:.2f} с' for name, duration in durations.items()))
+
+
+def bench_shared_frames(n_articles=4000, n_days=120):
+    """
+    Таблица через Arrow-файл (DASHBOARD_SHARED_FRAMES=1) даёт те же значения, что в памяти:
+    подготовленный итог 2025 и колонки object с флагами, пропусками и смешанными значениями.
+    Замер записи и открытия файла.
+    """
+    import dashboard
+    import shared_frames
+
+    with tempfile.TemporaryDirectory() as workdir:
+        itog = make_dashboard_data(workdir, n_articles, n_days)
+        path = os.path.join(workdir, 'data', 'itog.parquet')
+        df = dashboard.load_and_prepare_2025_parquet(path)
+        flags = pd.Series([True, False, None], dtype=object)
+        df['Флаг'] = flags.take(np.arange(len(df)) % 3).to_numpy()
+        df['Артикул_смешанный'] = pd.Series(['A1', 123, None], dtype=object).take(np.arange(len(df)) % 3).to_numpy()
+
+        start = time.perf_counter()
+        shared_frames.save_frame(df, os.path.join(workdir, 'итог.arrow'))
+        save_time = time.perf_counter() - start
+        start = time.perf_counter()
+        opened = shared_frames.open_frame(os.path.join(workdir, 'итог.arrow'))
+        open_time = time.perf_counter() - start
+
+    def values(series):
+        # Пропуски разных типов (None, NaN, NaT, <NA>) сравниваются как один
+        series = series.astype(object)
+        return series.where(series.notna(), None)
+
+    # Смешанные значения хранятся строками — как их и сравнивает дашборд
+    expected = df.assign(Артикул_смешанный=df['Артикул_смешанный'].map(lambda v: None if v is None else str(v)))
+    for col in expected.columns:
+        pd.testing.assert_series_equal(values(opened[col]), values(expected[col]), check_names=False, obj=col)
+    print(f'{len(itog)} строк итога, {len(df.columns)} колонок: значения совпадают; '
+          f'запись {save_time:.2f} с, открытие {open_time:.3f} с')
+
+
+BENCHMARKS = {
+    'readers': bench_readers,
+    'transfers': bench_transfers,
+    'lagged_transfers': bench_lagged_transfers,
+    'warehouse_transfers': bench_warehouse_transfers,
+    'monthly': bench_monthly,
+    'schema': bench_schema,
+    'delta_store': bench_delta_store,
+    'normalization': bench_normalization,
+    'duplicates': bench_duplicates,
+    'spikes': bench_spikes,
+    'spike_detectors': bench_spike_detectors,
+    'dashboard_memory': bench_dashboard_memory,
+    'shared_frames': bench_shared_frames,
+    'item_index': bench_item_index,
+    'line_figure': bench_line_figure,
+    'downsampling': bench_downsampling,
+    'incremental': bench_incremental,
+    'entry_points': bench_entry_points,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f'=== {name} ===')
+        BENCHMARKS[name]()
@@ -1,69 +1,173 @@
+import time
+_started = time.perf_counter()  # для отчёта о времени запуска
+
 import dash
 from dash import dcc, html, Input, Output, State, dash_table
 import plotly.express as px
 import plotly.graph_objs as go
 import pandas as pd
+import numpy as np
 import os
-from dash import ctx
 import io
 import dash_bootstrap_components as dbc
 import logging
-import glob
-import numpy as np
-import xlsxwriter
-from openpyxl import load_workbook
-from openpyxl.utils import get_column_letter
-from zipfile import ZipFile
-import requests
-from io import BytesIO
-import pyarrow
-import pyarrow.parquet as pq
+import threading
+import functools
+import hashlib
+from dash.exceptions import PreventUpdate
+
+import artifact_store
+import downsampling
+import shared_frames
+import spike_analysis
+import spike_detectors
+
+_libraries_loaded = time.perf_counter()
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
 # --------------------
 # НАСТРОЙКИ
 # --------------------
 HEIGHT_PER_BAR = 30  # высота одной строки в px
 MAX_VISIBLE_BARS = 50  # сколько строк показывать без прокрутки
 MAX_HEIGHT = HEIGHT_PER_BAR * MAX_VISIBLE_BARS  # высота контейнера в px
+DATA_CHECK_INTERVAL_MS = 5000  # как часто страница проверяет, не опубликованы ли новые результаты
+SPIKE_CACHE_SIZE = 8  # сколько наборов параметров всплесков держать посчитанными
+WEBGL_POINTS = 5000  # с какого числа точек график остатков рисуется через WebGL (Scattergl)
+# Таблицы в общих для процессов gunicorn Arrow-файлах (кэш/arrow); 0 — в памяти каждого процесса
+SHARED_FRAMES = os.environ.get('DASHBOARD_SHARED_FRAMES', '1') != '0'
+ITOG_2025_PATH = 'data/itog.parquet'
+RESULT_NAMES = ['итог_по_месяцу', 'самые_ходовые', 'чаще_всего_пополнялись']
+# Правила поиска всплесков: подпись, окно и коэффициент/порог по умолчанию
+SPIKE_METHODS = {
+    'mean': ('Среднее × коэффициент', 3, 1.5),
+    'mad': ('Медиана/MAD', 6, spike_detectors.DETECTORS['mad'][1]),
+    'ewma': ('EWMA z-оценка', 6, spike_detectors.DETECTORS['ewma'][1]),
+    'seasonal': ('Тот же месяц прошлых лет', 2, spike_detectors.DETECTORS['seasonal'][1]),
+}
 
 # --------------------
-# ЗАГРУЗКА И ПРЕДОБРАБОТКА (один раз при старте)
+# ЗАГРУЗКА И ПРЕДОБРАБОТКА (при первом обращении, а не при импорте)
 # --------------------
-def safe_read_excel(path):
-    try:
-        if path and os.path.exists(path):
-            return pd.read_excel(path)
-    except Exception:
-        pass
-    return pd.DataFrame()
-
-df_result = safe_read_excel('итог_по_месяцу.xlsx')
-df_fast = safe_read_excel('самые_ходовые.xlsx')
-df_restock = safe_read_excel('чаще_всего_пополнялись.xlsx')
-df_peaks = pd.read_excel('всплески_продаж1.xlsx')
-df_peaks['Дата'] = pd.to_datetime(df_peaks['Дата'])
-
-# Опционально: привести колонку Всплеск к булевому типу, если нужно
-df_peaks['Всплеск'] = df_peaks['Всплеск'].astype(bool)
-
-# Приведение числовых колонок
-if not df_fast.empty:
-    df_fast['Всего_продано'] = pd.to_numeric(df_fast.get('Всего_продано', 0), errors='coerce').fillna(0)
-    df_fast = df_fast.dropna(subset=['Номенклатура'])
-
-if not df_restock.empty:
-    df_restock['Всего_пополнено'] = pd.to_numeric(df_restock.get('Всего_пополнено', df_restock.get('Всего_продано', 0)), errors='coerce').fillna(0)
-    df_restock = df_restock.dropna(subset=['Номенклатура'])
-
-
-# Группировки для топов
-fast_grouped = df_fast.groupby(['Склад', 'Номенклатура', 'Артикул'], as_index=False)['Всего_продано'].sum() if not df_fast.empty else pd.DataFrame()
-restock_grouped = df_restock.groupby(['Склад', 'Номенклатура', 'Артикул'], as_index=False)['Всего_пополнено'].sum() if not df_restock.empty else pd.DataFrame()
+def load_result(name):
+    """Результат анализа из Parquet-хранилища, а если его нет — из прежнего xlsx-файла."""
+    return artifact_store.read_or_excel(name, f'{name}.xlsx', categories=False)
+
+def shared(name, key, build):
+    """
+    Таблица из общего для всех процессов Arrow-файла, открытого через mmap (см. shared_frames),
+    а при DASHBOARD_SHARED_FRAMES=0 — построенная в памяти процесса.
+    """
+    return shared_frames.shared_frame(name, key, build) if SHARED_FRAMES else build()
+
+def file_key(*paths):
+    """Ключ версии по размерам и датам изменения файлов (отсутствующий файл — тоже версия)."""
+    stats = [(os.stat(p).st_size, os.stat(p).st_mtime_ns) if os.path.exists(p) else None for p in paths]
+    return hashlib.sha1(repr(stats).encode('utf-8')).hexdigest()[:12]
+
+def results_key(signature):
+    """Ключ общих таблиц результатов: подпись манифеста хранилища, без него — прежние xlsx-файлы."""
+    if signature is None:
+        return file_key(*[f'{name}.xlsx' for name in RESULT_NAMES])
+    return hashlib.sha1(repr(signature).encode('utf-8')).hexdigest()[:12]
+
+def unique_values(df, col):
+    """
+    Отсортированные непустые значения колонки для фильтров. unique() — до dropna и приведения
+    к строкам, чтобы не копировать всю колонку (в общих таблицах она только в отображённом файле).
+    """
+    if df.empty or col not in df.columns:
+        return []
+    return sorted((v for v in df[col].unique() if not pd.isna(v)), key=str)
+
+def prepare_fast(fast):
+    # Приведение числовых колонок
+    if not fast.empty:
+        fast['Всего_продано'] = pd.to_numeric(fast.get('Всего_продано', 0), errors='coerce').fillna(0)
+        fast = fast.dropna(subset=['Номенклатура'])
+    return fast
+
+def prepare_restock(restock):
+    if not restock.empty:
+        restock['Всего_пополнено'] = pd.to_numeric(restock.get('Всего_пополнено', restock.get('Всего_продано', 0)), errors='coerce').fillna(0)
+        restock = restock.dropna(subset=['Номенклатура'])
+    return restock
+
+def group_top(df, value_col):
+    # Группировки для топов
+    return df.groupby(['Склад', 'Номенклатура', 'Артикул'], as_index=False)[value_col].sum() if not df.empty else pd.DataFrame()
+
+def load_results():
+    """
+    Загружает результаты анализа и производные таблицы в глобальные переменные.
+    Подпись манифеста берётся до чтения: если во время загрузки вышла новая версия,
+    следующая проверка загрузит её.
+    """
+    global df_result, df_fast, df_restock, fast_grouped, restock_grouped, unique_sklads, data_signature
+    global df_monthly, unique_peak_sklads, unique_peak_articles
+    started = time.perf_counter()
+    signature = artifact_store.manifest_signature()
+    key = results_key(signature)
+    result = shared('итог_по_месяцу', key, lambda: load_result('итог_по_месяцу'))
+    fast = shared('самые_ходовые', key, lambda: prepare_fast(load_result('самые_ходовые')))
+    restock = shared('чаще_всего_пополнялись', key, lambda: prepare_restock(load_result('чаще_всего_пополнялись')))
+    fast_grouped = shared('самые_ходовые_по_складам', key, lambda: group_top(fast, 'Всего_продано'))
+    restock_grouped = shared('пополнения_по_складам', key, lambda: group_top(restock, 'Всего_пополнено'))
+
+    # Уникальные значения для фильтров
+    unique_sklads = result['Склад'].dropna().unique().tolist() if not result.empty else []
+
+    # Месячный итог для всплесков: сами всплески считаются по запросу с выбранными параметрами
+    monthly = shared('итог_по_месяцу_для_всплесков', key,
+                     lambda: spike_analysis.prepare_monthly_data(result) if not result.empty else pd.DataFrame())
+    unique_peak_sklads = unique_values(monthly, 'Склад')
+    unique_peak_articles = unique_values(monthly, 'Артикул')
+
+    df_result, df_fast, df_restock, df_monthly = result, fast, restock, monthly
+    data_signature = signature
+    compute_spikes.cache_clear()
+    logger.info(f'⏱ Результаты анализа загружены за {time.perf_counter() - started:.2f} с')
+
+
+_reload_lock = threading.Lock()
+_NOT_LOADED = object()
+data_signature = _NOT_LOADED
+unique_sklads, unique_peak_sklads, unique_peak_articles = [], [], []
+
+
+def refresh_results():
+    """
+    Перечитывает результаты, если анализ опубликовал новую версию хранилища
+    (и загружает их при первом вызове). Проверка — один stat манифеста, поэтому
+    вызывается в начале каждого колбэка: так каждый процесс gunicorn сам подхватывает новую версию.
+    """
+    if artifact_store.manifest_signature() != data_signature:
+        with _reload_lock:
+            if artifact_store.manifest_signature() != data_signature:
+                load_results()
+                logging.info('Загружена новая версия результатов анализа')
+    return data_signature
+
+
+@functools.lru_cache(maxsize=SPIKE_CACHE_SIZE)
+def compute_spikes(version, method, window, factor):
+    """
+    Всплески по всему месячному итогу для одного набора параметров. Версия данных входит в ключ,
+    чтобы после публикации не отдать всплески по прежним результатам; при перезагрузке кэш очищается.
+    """
+    if df_monthly.empty:
+        return df_monthly
+    return spike_analysis.find_spikes(df_monthly, [window], [factor], method, threshold=factor)
+
+
+def get_spikes(method, window, factor):
+    """Всплески для параметров из элементов управления (None — если параметры не заданы)."""
+    version = str(refresh_results())
+    if method not in SPIKE_METHODS or not window or window < 1 or factor is None:
+        return None
+    return compute_spikes(version, method, int(window), float(factor))
 
-# Уникальные значения для фильтров
-unique_sklads = df_result['Склад'].dropna().unique().tolist() if not df_result.empty else []
-unique_peak_sklads = sorted(df_peaks['Склад'].dropna().unique()) if not df_peaks.empty else []
-unique_peak_articles = sorted(df_peaks['Артикул'].dropna().unique()) if not df_peaks.empty else []
-unique_peak_noms = sorted(df_peaks['Номенклатура'].dropna().unique()) if not df_peaks.empty else []
 
 
 # --- Функции подготовки данных ---
@@ -182,211 +286,337 @@ def safe_filter_anomaly(df: pd.DataFrame) -> pd.DataFrame:
     return df.loc[~df["Аномалия"]].copy()
 
 
-# --- Использование ---
-df_2025 = load_and_prepare_2025_parquet("data/itog.parquet")
-df_2025_clean = safe_filter_anomaly(df_2025)
+# --- Индекс строк по товарам ---
+ITEM_ORDER = ["Артикул_товар", "Склад", "Дата"]
+ITEM_KEYS = ["Артикул_товар", "Склад", "Номенклатура_канон"]
 
-unique_sklads_2025 = sorted(df_2025_clean["Склад"].dropna().unique().tolist()) if not df_2025_clean.empty else []
-unique_articles_2025 = sorted(df_2025_clean["Артикул_товар"].dropna().astype(str).unique().tolist()) if not df_2025_clean.empty and "Артикул_товар" in df_2025_clean.columns else []
-unique_noms_2025 = sorted(df_2025_clean["Номенклатура_канон"].dropna().unique().tolist()) if not df_2025_clean.empty and "Номенклатура_канон" in df_2025_clean.columns else []
+def sort_by_item(df: pd.DataFrame) -> pd.DataFrame:
+    """Строки по товару, складу и дате: ряд каждого товара на складе идёт подряд."""
+    keys = [c for c in ITEM_ORDER if c in df.columns]
+    if df.empty or not keys:
+        return df
+    return df.sort_values(keys, kind="stable").reset_index(drop=True)
+
+def build_item_blocks(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Отрезки отсортированной таблицы с одинаковыми Артикул_товар, Склад и Номенклатура_канон:
+    значения ключей и номера строк start, stop (строки отрезка — df.iloc[start:stop]).
+    """
+    keys = [c for c in ITEM_KEYS if c in df.columns]
+    if df.empty or not keys:
+        return pd.DataFrame(columns=keys + ["start", "stop"])
+    is_start = np.zeros(len(df), dtype=bool)
+    is_start[0] = True
+    for col in keys:
+        codes = pd.factorize(df[col])[0]
+        is_start[1:] |= codes[1:] != codes[:-1]
+    starts = np.flatnonzero(is_start)
+    blocks = df[keys].take(starts).reset_index(drop=True)
+    blocks["start"] = starts
+    blocks["stop"] = np.append(starts[1:], len(df))
+    return blocks
+
+def build_item_index(blocks: pd.DataFrame) -> dict:
+    """Номера отрезков по значению: {"Артикул_товар" | "Номенклатура_канон": {значение: массив номеров}}."""
+    index = {}
+    for col in ["Артикул_товар", "Номенклатура_канон"]:
+        if col in blocks.columns:
+            groups = blocks.groupby(col, sort=False, observed=True).indices
+            index[col] = {str(value): rows for value, rows in groups.items()}
+    return index
+
+def item_rows(df, blocks, index, article=None, nom=None, sklads=None):
+    """
+    Строки товара по складам: {склад: строки по датам}. Отрезки находятся по словарям индекса,
+    строки — срезы отсортированной таблицы без копирования, поэтому время не зависит от её размера.
+    """
+    selected = None
+    for col, value in [("Артикул_товар", article), ("Номенклатура_канон", nom)]:
+        if value:
+            found = index.get(col, {}).get(str(value), np.empty(0, dtype=np.intp))
+            selected = found if selected is None else np.intersect1d(selected, found)
+    if selected is None or not len(selected):
+        return {}
+
+    chosen = blocks.take(selected)
+    if sklads:
+        chosen = chosen[chosen["Склад"].isin(sklads)]
+    series = {}
+    for sklad, group in chosen.groupby("Склад", sort=False, observed=True):
+        parts = [df.iloc[start:stop] for start, stop in zip(group["start"], group["stop"])]
+        # Несколько отрезков на складе — разные артикулы одной номенклатуры: сводим по дате
+        series[sklad] = parts[0] if len(parts) == 1 else pd.concat(parts).sort_values("Дата", kind="stable")
+    return series
+
+
+# --- Использование ---
+_loaded_2025 = False
+unique_sklads_2025, unique_articles_2025, unique_noms_2025 = [], [], []
+item_blocks_2025, item_index_2025 = pd.DataFrame(), {}
+
+def load_2025():
+    """Таблицы вкладки «Анализ 2025» и значения её фильтров в глобальные переменные."""
+    global df_2025, df_2025_clean, unique_sklads_2025, unique_articles_2025, unique_noms_2025, _loaded_2025
+    global item_blocks_2025, item_index_2025
+    started = time.perf_counter()
+    key = file_key(ITOG_2025_PATH)
+    df_2025 = shared('итог_2025', key, lambda: load_and_prepare_2025_parquet(ITOG_2025_PATH))
+    # Без аномалий и по товарам: строки товара на складе — один срез, индекс отрезков общий для процессов
+    df_2025_clean = shared('итог_2025_по_товарам', key, lambda: sort_by_item(safe_filter_anomaly(df_2025)))
+    item_blocks_2025 = shared('итог_2025_отрезки', key, lambda: build_item_blocks(df_2025_clean))
+    item_index_2025 = build_item_index(item_blocks_2025)
+
+    unique_sklads_2025 = unique_values(df_2025_clean, "Склад")
+    unique_articles_2025 = [str(a) for a in unique_values(df_2025_clean, "Артикул_товар")]
+    unique_noms_2025 = unique_values(df_2025_clean, "Номенклатура_канон")
+    _loaded_2025 = True
+    logger.info(f'⏱ Данные 2025 загружены за {time.perf_counter() - started:.2f} с')
+
+def ensure_2025():
+    """Загружает данные 2025 при первом обращении."""
+    if not _loaded_2025:
+        with _reload_lock:
+            if not _loaded_2025:
+                load_2025()
 
 # --------------------
 # DASH APP
 # --------------------
 app = dash.Dash(__name__)
 server = app.server
-app.layout = html.Div([
-    html.H1("Анализ складских данных"),
-
-    dcc.Tabs([
-        dcc.Tab(label="Основной анализ", children=[
-            # ===================== Блок ТОПЫ =====================
-            html.Div([
-                html.H2("ТОПы по складам"),
-                html.Label("Выберите склад:"),
-                dcc.Dropdown(
-                    id='sklad-filter',
-                    options=[{'label': s, 'value': s} for s in unique_sklads],
-                    value=unique_sklads,
-                    multi=True,
-                    placeholder="Выберите один или несколько складов",
-                    clearable=True,
-                    style={'marginBottom': '20px'}
-                ),
-                html.Label("Выберите количество позиций для отображения ходовых товаров:"),
-                dcc.RadioItems(
-                    id='top-n-selector',
-                    options=[
-                        {'label': 'Топ 100', 'value': 100},
-                        {'label': 'Топ 500', 'value': 500},
-                        {'label': 'Топ 1000', 'value': 1000},
-                    ],
-                    value=100,
-                    labelStyle={'display': 'inline-block', 'marginRight': '15px'},
-                    style={'marginBottom': '20px'}
-                ),
-                html.H3("Топ самых ходовых товаров"),
-                html.Div(
-                    dcc.Graph(id='graph-top-fast'),
-                    style={'height': '700px', 'overflowY': 'scroll',
-                           'border': '1px solid #ddd', 'padding': '5px',
-                           'marginBottom': '10px', 'backgroundColor': 'white'}
-                ),
-                dbc.Button("📥 Выгрузить топ ходовых в Excel", id="download-top-fast-btn", color="success", className="mb-4"),
-
-                html.Label("Выберите количество позиций для отображения товаров по пополнениям:"),
-                dcc.RadioItems(
-                    id='top-n-selector-restock',
-                    options=[
-                        {'label': 'Топ 100', 'value': 100},
-                        {'label': 'Топ 500', 'value': 500},
-                        {'label': 'Топ 1000', 'value': 1000},
-                    ],
-                    value=100,
-                    labelStyle={'display': 'inline-block', 'marginRight': '15px'},
-                    style={'marginBottom': '20px'}
-                ),
-                html.H3("Топ товаров по пополнениям"),
-                html.Div(
-                    dcc.Graph(id='graph-top-restock'),
-                    style={'height': '700px', 'overflowY': 'scroll',
-                           'border': '1px solid #ddd', 'padding': '5px',
-                           'marginBottom': '10px', 'backgroundColor': 'white'}
-                ),
-                dbc.Button("📥 Выгрузить топ пополнений в Excel", id="download-top-restock-btn", color="success"),
-
-                dcc.Download(id="download-top-fast"),
-                dcc.Download(id="download-top-restock"),
-            ], style={'marginBottom': 40}),
-
-            # ===================== Блок ВСПЛЕСКИ =====================
-            html.Div([
-                html.H2("Всплески продаж"),
+def build_layout():
+    """Разметка страницы со значениями фильтров из уже загруженных таблиц."""
+    return html.Div([
+        html.H1("Анализ складских данных"),
+        html.Div(id='data-version-label', style={'color': 'gray', 'marginBottom': '10px'}),
+        dcc.Interval(id='data-refresh', interval=DATA_CHECK_INTERVAL_MS),
+        dcc.Store(id='data-version'),
+        dcc.Store(id='chart-width'),
+
+        dcc.Tabs([
+            dcc.Tab(label="Основной анализ", children=[
+                # ===================== Блок ТОПЫ =====================
                 html.Div([
-                    html.Label("Склад:"),
+                    html.H2("ТОПы по складам"),
+                    html.Label("Выберите склад:"),
                     dcc.Dropdown(
-                        id='peak-sklad-filter',
-                        options=[{'label': s, 'value': s} for s in unique_peak_sklads],
-                        multi=False,
-                        placeholder="Выберите склад для всплесков",
+                        id='sklad-filter',
+                        options=[{'label': s, 'value': s} for s in unique_sklads],
+                        value=unique_sklads,
+                        multi=True,
+                        placeholder="Выберите один или несколько складов",
                         clearable=True,
+                        style={'marginBottom': '20px'}
                     ),
-                    html.Label("Артикул:"),
-                    dcc.Dropdown(
-                        id='peak-article-filter',
-                        options=[{'label': a, 'value': a} for a in unique_peak_articles],
-                        multi=False,
-                        placeholder="Выберите артикул",
-                        clearable=True,
+                    html.Label("Выберите количество позиций для отображения ходовых товаров:"),
+                    dcc.RadioItems(
+                        id='top-n-selector',
+                        options=[
+                            {'label': 'Топ 100', 'value': 100},
+                            {'label': 'Топ 500', 'value': 500},
+                            {'label': 'Топ 1000', 'value': 1000},
+                        ],
+                        value=100,
+                        labelStyle={'display': 'inline-block', 'marginRight': '15px'},
+                        style={'marginBottom': '20px'}
                     ),
-                    html.Label("Номенклатура:"),
-                    dcc.Dropdown(
-                        id='peak-nom-filter',
-                        options=[],
-                        multi=False,
-                        placeholder="Выберите номенклатуру",
-                        clearable=True,
-                        searchable=True,
-                        style={'width': '100%'}
+                    html.H3("Топ самых ходовых товаров"),
+                    html.Div(
+                        dcc.Graph(id='graph-top-fast'),
+                        style={'height': '700px', 'overflowY': 'scroll',
+                               'border': '1px solid #ddd', 'padding': '5px',
+                               'marginBottom': '10px', 'backgroundColor': 'white'}
                     ),
-                    html.Button("📥 Скачать в Excel", id="btn-download-peaks", n_clicks=0),
-                    dcc.Download(id="download-peaks-xlsx"),
-                ], style={'maxWidth': 450, 'marginBottom': 30, 'display': 'flex', 'flexDirection': 'column', 'gap': '10px'}),
+                    dbc.Button("📥 Выгрузить топ ходовых в Excel", id="download-top-fast-btn", color="success", className="mb-4"),
+
+                    html.Label("Выберите количество позиций для отображения товаров по пополнениям:"),
+                    dcc.RadioItems(
+                        id='top-n-selector-restock',
+                        options=[
+                            {'label': 'Топ 100', 'value': 100},
+                            {'label': 'Топ 500', 'value': 500},
+                            {'label': 'Топ 1000', 'value': 1000},
+                        ],
+                        value=100,
+                        labelStyle={'display': 'inline-block', 'marginRight': '15px'},
+                        style={'marginBottom': '20px'}
+                    ),
+                    html.H3("Топ товаров по пополнениям"),
+                    html.Div(
+                        dcc.Graph(id='graph-top-restock'),
+                        style={'height': '700px', 'overflowY': 'scroll',
+                               'border': '1px solid #ddd', 'padding': '5px',
+                               'marginBottom': '10px', 'backgroundColor': 'white'}
+                    ),
+                    dbc.Button("📥 Выгрузить топ пополнений в Excel", id="download-top-restock-btn", color="success"),
 
-                dcc.Graph(id='graph-peaks'),
+                    dcc.Download(id="download-top-fast"),
+                    dcc.Download(id="download-top-restock"),
+                ], style={'marginBottom': 40}),
 
+                # ===================== Блок ВСПЛЕСКИ =====================
                 html.Div([
-                    html.P("График отображает:"),
-                    html.Ul([
-                        html.Li("Продажи (оси слева)"),
-                        html.Li("Средняя цена (пунктирная линия, правая ось)"),
-                        html.Li("Изменение цены в процентах (штриховая линия, правая ось)"),
-                    ]),
-                ], style={'maxWidth': 600, 'fontStyle': 'italic', 'color': 'gray', 'marginTop': 10}),
+                    html.H2("Всплески продаж"),
+                    html.Div([
+                        html.Label("Склад:"),
+                        dcc.Dropdown(
+                            id='peak-sklad-filter',
+                            options=[{'label': s, 'value': s} for s in unique_peak_sklads],
+                            multi=False,
+                            placeholder="Выберите склад для всплесков",
+                            clearable=True,
+                        ),
+                        html.Label("Артикул:"),
+                        dcc.Dropdown(
+                            id='peak-article-filter',
+                            options=[{'label': a, 'value': a} for a in unique_peak_articles],
+                            multi=False,
+                            placeholder="Выберите артикул",
+                            clearable=True,
+                        ),
+                        html.Label("Правило поиска всплесков:"),
+                        dcc.Dropdown(
+                            id='peak-method',
+                            options=[{'label': label, 'value': method} for method, (label, _, _) in SPIKE_METHODS.items()],
+                            value='mean',
+                            clearable=False,
+                        ),
+                        html.Label("Окно, месяцев (для «тот же месяц прошлых лет» — лет):"),
+                        dcc.Input(id='peak-window', type='number', min=1, max=24, step=1,
+                                  value=SPIKE_METHODS['mean'][1], debounce=True),
+                        html.Label("Коэффициент (для устойчивых правил — порог оценки):"),
+                        dcc.Input(id='peak-factor', type='number', min=0, step=0.1,
+                                  value=SPIKE_METHODS['mean'][2], debounce=True),
+                        html.Label("Номенклатура:"),
+                        dcc.Dropdown(
+                            id='peak-nom-filter',
+                            options=[],
+                            multi=False,
+                            placeholder="Выберите номенклатуру",
+                            clearable=True,
+                            searchable=True,
+                            style={'width': '100%'}
+                        ),
+                        html.Button("📥 Скачать в Excel", id="btn-download-peaks", n_clicks=0),
+                        dcc.Download(id="download-peaks-xlsx"),
+                    ], style={'maxWidth': 450, 'marginBottom': 30, 'display': 'flex', 'flexDirection': 'column', 'gap': '10px'}),
+
+                    dcc.Graph(id='graph-peaks'),
+
+                    html.Div([
+                        html.P("График отображает:"),
+                        html.Ul([
+                            html.Li("Продажи (оси слева), всплески (звёздочки) и базовый уровень правила (точечная линия)"),
+                            html.Li("Средняя цена (пунктирная линия, правая ось)"),
+                            html.Li("Изменение цены в процентах (штриховая линия, правая ось)"),
+                        ]),
+                    ], style={'maxWidth': 600, 'fontStyle': 'italic', 'color': 'gray', 'marginTop': 10}),
+                ]),
             ]),
-        ]),
-
-        # ===================== Новая вкладка 2025 =====================
-        dcc.Tab(label="Анализ 2025", children=[
-            html.Div([
-                html.H2("Анализ продаж за 2025 год"),
 
-                # Фильтры
+            # ===================== Новая вкладка 2025 =====================
+            dcc.Tab(label="Анализ 2025", children=[
                 html.Div([
-                    html.Label("Склад:"),
-                    dcc.Dropdown(
-                        id='sklad-2025-filter',
-                        options=[{'label': s, 'value': s} for s in unique_sklads_2025],
-                        value=unique_sklads_2025,  # по умолчанию все склады
-                        multi=True,
-                        placeholder="Выберите склад",
-                        clearable=True,
-                        style={'marginBottom': '15px'}
-                    ),
-                    html.Label("Артикул:"),
-                    dcc.Dropdown(
-                        id='article-2025-filter',
-                        options=[{'label': a, 'value': a} for a in unique_articles_2025],
-                        multi=False,
-                        placeholder="Выберите артикул",
-                        clearable=True,
-                        style={'marginBottom': '15px'}
-                    ),
-                    html.Label("Номенклатура:"),
-                    dcc.Dropdown(
-                        id='nom-2025-filter',
-                        options=[{'label': n, 'value': n} for n in unique_noms_2025],
-                        multi=False,
-                        placeholder="Выберите номенклатуру",
-                        clearable=True,
-                        style={'marginBottom': '20px'}
-                    ),
-                ], style={'maxWidth': 500, 'marginBottom': 30}),
-
-                # Линейный график
-                html.H3("Динамика продаж, пополнений и цены выбранного товара"),
-                dcc.Graph(id='graph-2025-line'),
-
-                # Таблица ТОП-100 товаров
-                html.H3("ТОП-100 товаров по продажам (2025)", style={"marginTop": "20px"}),
-                dash_table.DataTable(
-                    id="top-100-table",
-                    columns=[
-                        {"name": "Артикул", "id": "Артикул"},
-                        {"name": "Номенклатура", "id": "Номенклатура"},
-                        {"name": "Продано", "id": "Продано"},
-                        {"name": "Склад", "id": "Склад"},
-                    ],
-                    style_table={
-                        "overflowX": "auto",
-                        "maxHeight": "500px",
-                        "overflowY": "scroll",
-                        "width": "100%",
-                    },
-                    style_cell={
-                        "textAlign": "left",
-                        "padding": "5px",
-                        "textDecoration": "none",  # убираем подчеркивание
-                        "whiteSpace": "normal",
-                        "height": "auto",
-                    },
-                    style_header={
-                        "fontWeight": "bold",
-                        "backgroundColor": "#f0f0f0",
-                        "textDecoration": "none",
-                    },
-                    page_size=20,
-                    row_selectable="single",  # для клика по строке
-                )
+                    html.H2("Анализ продаж за 2025 год"),
+
+                    # Фильтры
+                    html.Div([
+                        html.Label("Склад:"),
+                        dcc.Dropdown(
+                            id='sklad-2025-filter',
+                            options=[{'label': s, 'value': s} for s in unique_sklads_2025],
+                            value=unique_sklads_2025,  # по умолчанию все склады
+                            multi=True,
+                            placeholder="Выберите склад",
+                            clearable=True,
+                            style={'marginBottom': '15px'}
+                        ),
+                        html.Label("Артикул:"),
+                        dcc.Dropdown(
+                            id='article-2025-filter',
+                            options=[{'label': a, 'value': a} for a in unique_articles_2025],
+                            multi=False,
+                            placeholder="Выберите артикул",
+                            clearable=True,
+                            style={'marginBottom': '15px'}
+                        ),
+                        html.Label("Номенклатура:"),
+                        dcc.Dropdown(
+                            id='nom-2025-filter',
+                            options=[{'label': n, 'value': n} for n in unique_noms_2025],
+                            multi=False,
+                            placeholder="Выберите номенклатуру",
+                            clearable=True,
+                            style={'marginBottom': '20px'}
+                        ),
+                    ], style={'maxWidth': 500, 'marginBottom': 30}),
+
+                    # Линейный график
+                    html.H3("Динамика продаж, пополнений и цены выбранного товара"),
+                    dcc.Graph(id='graph-2025-line'),
+
+                    # Таблица ТОП-100 товаров
+                    html.H3("ТОП-100 товаров по продажам (2025)", style={"marginTop": "20px"}),
+                    dash_table.DataTable(
+                        id="top-100-table",
+                        columns=[
+                            {"name": "Артикул", "id": "Артикул"},
+                            {"name": "Номенклатура", "id": "Номенклатура"},
+                            {"name": "Продано", "id": "Продано"},
+                            {"name": "Склад", "id": "Склад"},
+                        ],
+                        style_table={
+                            "overflowX": "auto",
+                            "maxHeight": "500px",
+                            "overflowY": "scroll",
+                            "width": "100%",
+                        },
+                        style_cell={
+                            "textAlign": "left",
+                            "padding": "5px",
+                            "textDecoration": "none",  # убираем подчеркивание
+                            "whiteSpace": "normal",
+                            "height": "auto",
+                        },
+                        style_header={
+                            "fontWeight": "bold",
+                            "backgroundColor": "#f0f0f0",
+                            "textDecoration": "none",
+                        },
+                        page_size=20,
+                        row_selectable="single",  # для клика по строке
+                    )
+                ])
             ])
         ])
     ])
-])
+
+def serve_layout():
+    """
+    Разметка при открытии страницы, а не при импорте: таблицы загружаются при первом
+    обращении, и процесс gunicorn стартует без чтения данных (с --preload их заранее
+    загружает главный процесс, см. warm_tables).
+    """
+    refresh_results()
+    ensure_2025()
+    return build_layout()
+
+
+def warm_tables():
+    """
+    Загружает все таблицы сразу. Вызывается в главном процессе gunicorn --preload
+    (gunicorn.conf.py) до fork: рабочие процессы наследуют уже открытые таблицы,
+    а не загружают каждый свою копию при первом запросе.
+    """
+    refresh_results()
+    ensure_2025()
+
+# Dash проверяет id колбэков по разметке; пустая разметка не требует загрузки таблиц
+app.validation_layout = build_layout()
+app.layout = serve_layout
 # --------------------
 # КОЛБЭКИ
 # --------------------
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
 
 
 # --- Утилиты ---
@@ -398,23 +628,129 @@ def _to_list(x):
         return list(x)
     return [x]
 
+# --- Новые результаты анализа ---
+@app.callback(
+    Output('data-version', 'data'),
+    Output('data-version-label', 'children'),
+    Output('sklad-filter', 'options'),
+    Output('peak-sklad-filter', 'options'),
+    Output('peak-article-filter', 'options'),
+    Input('data-refresh', 'n_intervals'),
+    State('data-version', 'data'),
+)
+def check_data_version(_, shown_version):
+    """Раз в несколько секунд: если вышла новая версия результатов, графики перерисовываются."""
+    version = str(refresh_results())
+    if version == shown_version:
+        raise PreventUpdate
+    manifest = artifact_store.load_manifest()
+    label = f"Данные от {pd.Timestamp(manifest['published']):%d.%m.%Y %H:%M:%S}" if manifest else ''
+    return (version, label, [{'label': s, 'value': s} for s in unique_sklads],
+            [{'label': s, 'value': s} for s in unique_peak_sklads],
+            [{'label': a, 'value': a} for a in unique_peak_articles])
+
+# --- Ширина графиков ---
+# Графики во всю ширину страницы: по ней сервер выбирает, сколько точек рядов отправлять.
+# Считается в браузере при открытии и при каждой проверке данных; сервер вызывается, только если она изменилась
+app.clientside_callback(
+    """
+    function(_, width) {
+        const current = document.documentElement.clientWidth;
+        return current === width ? window.dash_clientside.no_update : current;
+    }
+    """,
+    Output('chart-width', 'data'),
+    Input('data-refresh', 'n_intervals'),
+    State('chart-width', 'data'),
+)
+
 # ===================== Функции =====================
 
-def get_item_line(df, article=None, nom=None, sklad_filter=None):
-    dff = df.copy()
+def get_item_line(article=None, nom=None, sklad_filter=None):
+    ensure_2025()
     sklads = _to_list(sklad_filter)
-    if sklads:
-        dff = dff[dff["Склад"].isin(sklads)]
-    if article:
-        dff = dff[dff["Артикул_товар"].astype(str) == str(article)]
-    if nom:
-        dff = dff[dff["Номенклатура_канон"] == nom]
-    dff = dff.sort_values("Дата")
+    if article or nom:
+        series = item_rows(df_2025_clean, item_blocks_2025, item_index_2025, article, nom, sklads)
+        dff = pd.concat(series.values()) if series else df_2025_clean.iloc[:0]
+    else:
+        dff = df_2025_clean[df_2025_clean["Склад"].isin(sklads)] if sklads else df_2025_clean
+    dff = dff.sort_values("Дата", kind="stable")
 
     keep = ["Дата", "Склад", "Артикул_товар", "Номенклатура_канон", "Остаток",
             "Продано", "Пришло", "Цена", "Цена_изменилась", "Аномалия"]
     return dff[keep]
 
+LINE_LEGEND = {
+    "Всплеск": "red",
+    "Изменение цены": "orange",
+    "Всплеск + Изм. цены": "purple",
+    "Обычный день": "blue"
+}
+# Цвет маркера — номер отметки (0–3) на ступенчатой шкале: числа plotly проверяет и передаёт
+# массивом целиком, а не по строке на точку
+LINE_MARKS = ["Обычный день", "Изменение цены", "Всплеск", "Всплеск + Изм. цены"]
+LINE_COLORSCALE = [[i / (len(LINE_MARKS) - 1), LINE_LEGEND[mark]] for i, mark in enumerate(LINE_MARKS)]
+
+def line_points(df_s):
+    """
+    Точки ряда склада для графика остатков, по всему ряду. Продажи и пополнения — по разнице остатков
+    (с учётом пропусков дат), всплеск — продажи выше 1.5 × среднего за 7 точек; Отметка — номер в LINE_MARKS.
+    Считается NumPy по всему ряду до прореживания, чтобы среднее и отметки не зависели от масштаба.
+    """
+    stock = df_s["Остаток"].to_numpy(dtype=float)
+    change = np.diff(stock, prepend=np.nan)
+    sold = np.nan_to_num(np.clip(-change, 0, None))
+    spike = sold > 1.5 * pd.Series(sold).rolling(window=7, min_periods=1).mean().to_numpy()
+    price = df_s["Цена"].to_numpy(dtype=float)
+    price_changed = np.nan_to_num(np.diff(price, prepend=np.nan)) != 0
+    return pd.DataFrame({
+        "Дата": df_s["Дата"].to_numpy(),
+        "Остаток": stock,
+        "Продано": sold,
+        "Пополнено": np.nan_to_num(np.clip(change, 0, None)),
+        "Цена": price,
+        "Отметка": np.select([spike & price_changed, spike, price_changed], [3, 2, 1], 0),
+        "Артикул_товар": df_s["Артикул_товар"].to_numpy(),
+        "Номенклатура_канон": df_s["Номенклатура_канон"].to_numpy(),
+    })
+
+def line_trace(sklad, points, trace_type=go.Scatter):
+    """
+    След склада на графике остатков по точкам line_points. В customdata только числа, а постоянные
+    для следа склад, артикул и номенклатура — в шаблоне подсказки.
+    """
+    mark = points["Отметка"].to_numpy()
+    hover = "<b>Склад:</b> " + str(sklad) + "<br>"
+    text = pd.Series(np.array(LINE_MARKS, dtype=object)[mark], index=points.index)
+    for col, title in [("Артикул_товар", "Артикул"), ("Номенклатура_канон", "Номенклатура")]:
+        values = points[col]
+        if values.nunique(dropna=False) <= 1:
+            hover += "<b>" + title + ":</b> " + str(values.iloc[0]) + "<br>"
+        else:
+            # Номенклатура на нескольких артикулах: значение у каждой точки
+            text = text + "<br><b>" + title + ":</b> " + values.astype(str)
+
+    return trace_type(
+        x=points["Дата"],
+        y=points["Остаток"].to_numpy(),
+        mode="lines+markers",
+        name=str(sklad),
+        marker=dict(size=np.where(mark >= LINE_MARKS.index("Всплеск"), 10, 5), color=mark,
+                    colorscale=LINE_COLORSCALE, cmin=0, cmax=len(LINE_MARKS) - 1),
+        text=text.to_numpy(dtype=object),
+        customdata=points[["Продано", "Пополнено", "Цена"]].to_numpy(),
+        hovertemplate=(
+            hover
+            + "<b>Дата:</b> %{x|%d-%m-%Y}<br>"
+            "<b>Остаток:</b> %{y}<br>"
+            "<b>Продано:</b> %{customdata[0]}<br>"
+            "<b>Пополнено:</b> %{customdata[1]}<br>"
+            "<b>Цена:</b> %{customdata[2]}<br>"
+            "<b>Отметка:</b> %{text}<br><extra></extra>"
+        ),
+        showlegend=False
+    )
+
 # ===================== Колбэки =====================
 
 ## ------------------- График остатков -------------------
@@ -422,9 +758,18 @@ def get_item_line(df, article=None, nom=None, sklad_filter=None):
     Output("graph-2025-line", "figure"),
     Input("sklad-2025-filter", "value"),
     Input("article-2025-filter", "value"),
-    Input("nom-2025-filter", "value")
+    Input("nom-2025-filter", "value"),
+    Input("chart-width", "data"),
+    Input("graph-2025-line", "relayoutData"),
 )
-def update_line_graph(selected_sklads, selected_article, selected_nom):
+def update_line_graph(selected_sklads, selected_article, selected_nom, width=None, relayout_data=None):
+    # Увеличение графика — ряды прореживаются заново в видимом диапазоне
+    zoom = None
+    if dash.ctx.triggered_id == "graph-2025-line":
+        if not downsampling.changes_zoom(relayout_data):
+            raise PreventUpdate
+        zoom = downsampling.zoom_range(relayout_data)
+
     if not selected_article and not selected_nom:
         return go.Figure(
             layout=go.Layout(
@@ -434,18 +779,12 @@ def update_line_graph(selected_sklads, selected_article, selected_nom):
             )
         )
 
-    dff = df_2025_clean.copy()
+    # Ряды товара по складам — срезы общей таблицы по индексу, без просмотра всех строк
+    ensure_2025()
+    series = item_rows(df_2025_clean, item_blocks_2025, item_index_2025,
+                       selected_article, selected_nom, _to_list(selected_sklads))
 
-    if selected_sklads:
-        sklads = _to_list(selected_sklads)
-        dff = dff[dff["Склад"].isin(sklads)]
-
-    if selected_article:
-        dff = dff[dff["Артикул_товар"].astype(str) == str(selected_article)]
-    if selected_nom:
-        dff = dff[dff["Номенклатура_канон"] == selected_nom]
-
-    if dff.empty:
+    if not series:
         return go.Figure(
             layout=go.Layout(
                 title="Нет данных для выбранных фильтров",
@@ -454,67 +793,26 @@ def update_line_graph(selected_sklads, selected_article, selected_nom):
             )
         )
 
-    fig = go.Figure()
-
-    for sklad in dff["Склад"].unique():
-        df_s = dff[dff["Склад"] == sklad].sort_values("Дата").copy()
-
-        # Расчёт Продано и Пополнено с учётом пропусков дат
-        df_s["Продано_fix"] = (df_s["Остаток"].shift(1) - df_s["Остаток"]).clip(lower=0).fillna(0)
-        df_s["Пополнено_fix"] = (df_s["Остаток"] - df_s["Остаток"].shift(1)).clip(lower=0).fillna(0)
-
-        # Скользящее среднее и всплески
-        df_s["Среднее_Продано"] = df_s["Продано_fix"].rolling(window=7, min_periods=1).mean()
-        df_s["Всплеск"] = df_s["Продано_fix"] > 1.5 * df_s["Среднее_Продано"]
-        df_s["Цена_изменилась"] = df_s["Цена"].diff().fillna(0) != 0
-
-        # Цвет маркеров
-        df_s["Цвет"] = df_s.apply(
-            lambda row: "purple" if row["Всплеск"] and row["Цена_изменилась"]
-                        else "red" if row["Всплеск"]
-                        else "orange" if row["Цена_изменилась"]
-                        else "blue",
-            axis=1
-        )
-        df_s["Размер"] = df_s["Всплеск"].apply(lambda x: 10 if x else 5)
+    # Не больше точек, чем различимо по ширине графика; всплески и смены цены — все
+    budget = downsampling.point_budget(width)
+    points = {}
+    for sklad, df_s in series.items():
+        sklad_points = line_points(df_s)
+        keep = sklad_points["Отметка"].to_numpy() > 0
+        points[sklad] = sklad_points.iloc[
+            downsampling.select_points(sklad_points["Дата"], sklad_points["Остаток"], budget, keep, zoom)]
 
-        fig.add_trace(go.Scatter(
-            x=df_s["Дата"],
-            y=df_s["Остаток"],
-            mode="lines+markers",
-            name=str(sklad),
-            marker=dict(size=df_s["Размер"], color=df_s["Цвет"]),
-            text=[sklad]*len(df_s),
-            customdata=df_s[[
-                "Продано_fix", "Пополнено_fix", "Цена",
-                "Артикул_товар", "Номенклатура_канон", "Всплеск", "Цена_изменилась"
-            ]].values,
-            hovertemplate=(
-                "<b>Склад:</b> %{text}<br>"
-                "<b>Дата:</b> %{x|%d-%m-%Y}<br>"
-                "<b>Остаток:</b> %{y}<br>"
-                "<b>Продано:</b> %{customdata[0]}<br>"
-                "<b>Пополнено:</b> %{customdata[1]}<br>"
-                "<b>Цена:</b> %{customdata[2]}<br>"
-                "<b>Артикул:</b> %{customdata[3]}<br>"
-                "<b>Номенклатура:</b> %{customdata[4]}<br>"
-                "<b>Всплеск:</b> %{customdata[5]}<br>"
-                "<b>Изм. цены:</b> %{customdata[6]}<br><extra></extra>"
-            ),
-            showlegend=False
-        ))
+    # Много точек SVG рисует медленно: тогда все следы — WebGL
+    trace_type = go.Scattergl if sum(map(len, points.values())) > WEBGL_POINTS else go.Scatter
+    fig = go.Figure([line_trace(sklad, sklad_points, trace_type) for sklad, sklad_points in points.items()])
 
     # Легенда
-    legend_colors = {
-        "Всплеск": "red",
-        "Изменение цены": "orange",
-        "Всплеск + Изм. цены": "purple",
-        "Обычный день": "blue"
-    }
-    for label, color in legend_colors.items():
-        fig.add_trace(go.Scatter(x=[None], y=[None], mode="markers", marker=dict(size=8, color=color), name=label))
+    for label, color in LINE_LEGEND.items():
+        fig.add_trace(trace_type(x=[None], y=[None], mode="markers", marker=dict(size=8, color=color), name=label))
 
     fig.update_layout(
+        # Масштаб, выбранный пользователем, сохраняется, пока не сменился товар
+        uirevision=repr((selected_sklads, selected_article, selected_nom)),
         title="Динамика остатков, продаж и цен (2025)",
         xaxis_title="Дата",
         yaxis_title="Остаток",
@@ -530,7 +828,8 @@ def update_line_graph(selected_sklads, selected_article, selected_nom):
     Input("sklad-2025-filter", "value")
 )
 def update_top_100_table(selected_sklads):
-    df_filtered = df_2025.copy()
+    ensure_2025()
+    df_filtered = df_2025
     if selected_sklads:
         df_filtered = df_filtered[df_filtered["Склад"].isin(selected_sklads)]
 
@@ -605,6 +904,7 @@ def format_excel(dff, writer, sheet_name):
     prevent_initial_call=True
 )
 def export_top_fast_to_excel(n_clicks, selected_sklads, top_n):
+    refresh_results()
     if df_fast.empty or not selected_sklads:
         return None
 
@@ -647,6 +947,7 @@ def export_top_fast_to_excel(n_clicks, selected_sklads, top_n):
     prevent_initial_call=True
 )
 def export_top_restock_to_excel(n_clicks, selected_sklads, top_n):
+    refresh_results()
     if df_restock.empty or not selected_sklads:
         return None
 
@@ -686,8 +987,10 @@ MAX_CONTAINER_HEIGHT = 700  # Максимальная высота контей
     Output('graph-top-fast', 'figure'),
     Input('sklad-filter', 'value'),
     Input('top-n-selector', 'value'),
+    Input('data-version', 'data'),
 )
-def update_top_fast(selected_sklad, top_n):
+def update_top_fast(selected_sklad, top_n, _data_version):
+    refresh_results()
     if not selected_sklad:
         return go.Figure()
 
@@ -722,8 +1025,10 @@ def update_top_fast(selected_sklad, top_n):
     Output('graph-top-restock', 'figure'),
     Input('sklad-filter', 'value'),
     Input('top-n-selector-restock', 'value'),
+    Input('data-version', 'data'),
 )
-def update_top_restock(selected_sklads, top_n):
+def update_top_restock(selected_sklads, top_n, _data_version):
+    refresh_results()
     if not selected_sklads:
         return go.Figure()
 
@@ -762,22 +1067,50 @@ def update_nom_options(selected_sklad, selected_article):
     if not selected_sklad and not selected_article:
         return []
 
-    dff = df_peaks.copy()
+    refresh_results()
+    dff = df_monthly
+    if dff.empty:
+        return []
     if selected_sklad:
         dff = dff[dff["Склад"] == selected_sklad]
     if selected_article:
         dff = dff[dff["Артикул"] == selected_article]
 
-    return [{"label": nom, "value": nom} for nom in sorted(dff["Номенклатура"].unique())]
+    return [{"label": nom, "value": nom} for nom in sorted(dff["Номенклатура"].dropna().unique())]
+
+@app.callback(
+    Output('peak-window', 'value'),
+    Output('peak-factor', 'value'),
+    Input('peak-method', 'value'),
+    prevent_initial_call=True,
+)
+def reset_peak_parameters(method):
+    """У каждого правила свои окно и порог по умолчанию: коэффициент 1.5 для MAD был бы бессмысленным."""
+    _, window, factor = SPIKE_METHODS.get(method, SPIKE_METHODS['mean'])
+    return window, factor
 
 @app.callback(
     Output('graph-peaks', 'figure'),
     Input('peak-sklad-filter', 'value'),
     Input('peak-article-filter', 'value'),
     Input('peak-nom-filter', 'value'),
+    Input('peak-method', 'value'),
+    Input('peak-window', 'value'),
+    Input('peak-factor', 'value'),
+    Input('data-version', 'data'),
+    Input('chart-width', 'data'),
+    Input('graph-peaks', 'relayoutData'),
 )
-def update_peaks_graph(sklad, article, nom):
-    dff = df_peaks.copy()
+def update_peaks_graph(sklad, article, nom, method, window, factor, _data_version, width=None, relayout_data=None):
+    zoom = None
+    if dash.ctx.triggered_id == 'graph-peaks':
+        if not downsampling.changes_zoom(relayout_data):
+            raise PreventUpdate
+        zoom = downsampling.zoom_range(relayout_data)
+
+    dff = get_spikes(method, window, factor)
+    if dff is None or dff.empty:
+        return go.Figure()
     if sklad:
         dff = dff[dff['Склад'] == sklad]
     if article:
@@ -788,11 +1121,17 @@ def update_peaks_graph(sklad, article, nom):
     if dff.empty:
         return go.Figure()
 
-    dff = dff.sort_values('Дата').tail(200)  # ограничение последних 200 строк
+    # Вся история, прореженная по ширине графика; всплески и смены цены остаются
+    dff = dff.sort_values('Дата', kind='stable')
+    budget = downsampling.point_budget(width)
 
+    baseline_col = 'Среднее_последних_месяцев' if method == 'mean' else 'Базовый_уровень'
     fig = go.Figure()
 
-    for sklad_name, group in dff.groupby('Склад'):
+    for sklad_name, group in dff.groupby('Склад', observed=True):
+        price_change = group['Изменение_цены_%'].to_numpy(dtype=float)
+        keep = group['Всплеск'].to_numpy(dtype=bool) | (np.nan_to_num(price_change) != 0)
+        group = group.iloc[downsampling.select_points(group['Дата'], group['Всего_продано'], budget, keep, zoom)]
         fig.add_trace(go.Scatter(
             x=group['Дата'],
             y=group['Всего_продано'],
@@ -803,6 +1142,28 @@ def update_peaks_graph(sklad, article, nom):
             yaxis='y1',
         ))
 
+        spikes = group[group['Всплеск']]
+        fig.add_trace(go.Scatter(
+            x=spikes['Дата'],
+            y=spikes['Всего_продано'],
+            mode='markers',
+            name=f'Всплеск - {sklad_name}',
+            marker=dict(symbol='star', size=12, color='red'),
+            hovertemplate='Дата: %{x}<br>Всплеск: %{y}<br>Базовый уровень: %{customdata:.2f}<extra></extra>',
+            customdata=spikes[baseline_col],
+            yaxis='y1',
+        ))
+
+        fig.add_trace(go.Scatter(
+            x=group['Дата'],
+            y=group[baseline_col],
+            mode='lines',
+            name=f'Базовый уровень - {sklad_name}',
+            line=dict(dash='dot', width=1),
+            hovertemplate='Дата: %{x}<br>Базовый уровень: %{y:.2f}<extra></extra>',
+            yaxis='y1',
+        ))
+
         fig.add_trace(go.Scatter(
             x=group['Дата'],
             y=group['Средняя_цена'],
@@ -824,6 +1185,7 @@ def update_peaks_graph(sklad, article, nom):
         ))
 
     fig.update_layout(
+        uirevision=repr((sklad, article, nom, method, window, factor)),
         title='Всплески продаж и динамика цен',
         xaxis=dict(title='Дата'),
         yaxis=dict(title='Продано', side='left', showgrid=False, zeroline=False),
@@ -842,10 +1204,15 @@ def update_peaks_graph(sklad, article, nom):
     State("peak-sklad-filter", "value"),
     State("peak-article-filter", "value"),
     State("peak-nom-filter", "value"),
+    State("peak-method", "value"),
+    State("peak-window", "value"),
+    State("peak-factor", "value"),
     prevent_initial_call=True,
 )
-def download_peaks_excel(n_clicks, sklad, article, nom):
-    dff = df_peaks.copy()
+def download_peaks_excel(n_clicks, sklad, article, nom, method, window, factor):
+    dff = get_spikes(method, window, factor)
+    if dff is None:
+        return dash.no_update
     if sklad:
         dff = dff[dff['Склад'] == sklad]
     if article:
@@ -856,13 +1223,7 @@ def download_peaks_excel(n_clicks, sklad, article, nom):
     if dff.empty:
         return dash.no_update
 
-    # Добавим столбец с оборачиваемостью (если нет - считаем как пример)
-    # Например: Оборачиваемость = Всего_продано / Среднее количество на складе (пример)
-    # Здесь подставь свою логику, если нужно
-    if 'Оборачиваемость' not in dff.columns:
-        dff['Оборачиваемость'] = dff['Всего_продано'] / 10  # пример
-
-    import io
+    # dff может быть самой таблицей из кэша get_spikes: выгружается как есть, без изменений
     output = io.BytesIO()
     with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
         dff.to_excel(writer, index=False, sheet_name='Всплески_продаж')
@@ -870,6 +1231,10 @@ def download_peaks_excel(n_clicks, sklad, article, nom):
 
     return dcc.send_bytes(output.read(), filename="всплески_продаж.xlsx")
 
+logger.info(f'⏱ Дашборд запущен за {time.perf_counter() - _started:.2f} с '
+            f'(библиотеки {_libraries_loaded - _started:.2f} с); таблицы загрузятся при первом обращении '
+            f'или в главном процессе gunicorn --preload')
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 10000))  # Используем порт из переменной окружения или 10000 по умолчанию
     app.run_server(debug=False, host='0.0.0.0', port=port)
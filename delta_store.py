@@ -0,0 +1,396 @@
+"""
+Хранилище снимков в виде изменений (дельт) и календаря снимков.
+
+Ежедневный снимок — полный список остатков, но большинство строк день ко дню
+не меняется. Вместо полных снимков по каждому (Склад, Артикул) хранится строка
+только в день, когда меняется количество, цена или наименование, а также когда
+артикул пропадает из снимка (строка с Есть=False) и появляется снова. Календарь —
+даты снимков каждого склада: значение строки действует с её даты до даты
+следующей строки того же артикула.
+
+Изменение остатка, продажи и пополнения считаются прямо по дельтам: в дни без
+изменений они равны нулю. Месячные показатели, зависящие от числа дней
+(дни в наличии, средняя цена), учитывают длительность строки в колонке Дней.
+
+Хранилище ведётся по складам в кэш/дельты/<склад>/: новые снимки, датированные
+позже последнего, дописываются отдельной частью; изменение или удаление старого
+снимка пересобирает склад целиком.
+"""
+import json
+import logging
+import os
+import shutil
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+
+import schema
+import warehouses
+
+DELTA_DIR = os.path.join('кэш', 'дельты')
+STATE_NAME = 'state.json'
+# Увеличивать при изменении формата дельт: хранилище будет пересобрано
+DELTA_VERSION = 1
+
+KEY_COLUMNS = ['Склад', 'Артикул']
+VALUE_COLUMNS = ['Количество', 'Количество_всего', 'Цена', 'Номенклатура', 'Производитель']
+DELTA_COLUMNS = KEY_COLUMNS + ['Дата', 'Есть'] + VALUE_COLUMNS
+
+
+def daily_values(df_all):
+    """Значения артикула за день: первая строка снимка и сумма количества по всем его строкам."""
+    return df_all.groupby(KEY_COLUMNS + ['Дата'], observed=True).agg(
+        Количество=('Количество', 'first'),
+        Количество_всего=('Количество', 'sum'),
+        Цена=('Цена', 'first'),
+        Номенклатура=('Номенклатура', 'first'),
+        Производитель=('Производитель', 'first'),
+    ).reset_index()
+
+
+def build_calendar(df_all):
+    return df_all[['Склад', 'Дата']].drop_duplicates().sort_values(['Склад', 'Дата'], ignore_index=True)
+
+
+def _positions(rows, calendar):
+    """Номер даты строки в общем календаре (склады подряд, даты по возрастанию)."""
+    index = pd.MultiIndex.from_frame(calendar[['Склад', 'Дата']])
+    return index.get_indexer(pd.MultiIndex.from_frame(rows[['Склад', 'Дата']]))
+
+
+def _calendar_ends(calendar):
+    """Для каждой даты календаря — позиция за последней датой её склада."""
+    sizes = calendar.groupby('Склад', observed=True, sort=False)['Дата'].transform('size').to_numpy()
+    return np.arange(len(calendar)) - calendar.groupby('Склад', observed=True, sort=False).cumcount().to_numpy() + sizes
+
+
+def _changed(values):
+    """Значение отличается от предыдущей строки (пустые значения равны друг другу)."""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = values.cat.codes.to_numpy()
+        return np.r_[True, codes[1:] != codes[:-1]]
+    array = values.to_numpy()
+    same = (array[1:] == array[:-1]) | (pd.isna(array[1:]) & pd.isna(array[:-1]))
+    return np.r_[True, ~same]
+
+
+def encode(daily, calendar):
+    """
+    Дельты по дневным значениям (результат daily_values) и календарю снимков.
+    daily не обязан содержать все даты календаря: отсутствие артикула в снимке
+    записывается строкой Есть=False в первый день отсутствия.
+    """
+    daily = daily.sort_values(KEY_COLUMNS + ['Дата'], ignore_index=True)
+    pos = _positions(daily, calendar)
+    key = daily.groupby(KEY_COLUMNS, observed=True, sort=False).ngroup().to_numpy()
+    first = np.r_[True, key[1:] != key[:-1]]
+    last = np.r_[key[1:] != key[:-1], True]
+    gap = np.r_[False, pos[1:] != pos[:-1] + 1] & ~first
+
+    keep = first | gap
+    for col in VALUE_COLUMNS:
+        keep |= _changed(daily[col])
+
+    # Артикул пропал из следующего снимка склада: строка отсутствия в первый день без него
+    next_pos = np.r_[pos[1:], 0]
+    ends = _calendar_ends(calendar)[pos]
+    absent = np.where(last, pos + 1 < ends, next_pos > pos + 1)
+
+    present = daily[keep].assign(Есть=True)
+    missing = daily[absent].assign(Есть=False)
+    missing['Дата'] = calendar['Дата'].to_numpy()[pos[absent] + 1]
+    deltas = pd.concat([present, missing], ignore_index=True)
+    return deltas.sort_values(KEY_COLUMNS + ['Дата'], ignore_index=True)[DELTA_COLUMNS]
+
+
+def last_state(deltas, calendar):
+    """Строки, действующие на последнюю дату календаря, с этой датой — основа для дописывания."""
+    last = deltas.drop_duplicates(KEY_COLUMNS, keep='last')
+    last = last[last['Есть']].drop(columns='Есть')
+    last_dates = calendar.groupby('Склад', observed=True)['Дата'].max().to_dict()
+    return last.assign(Дата=pd.to_datetime(last['Склад'].astype(object).map(last_dates)))
+
+
+def _recategorize(df):
+    """После concat частей с разными словарями возвращает ключевым колонкам тип category."""
+    for col in schema.CATEGORY_COLUMNS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+    return df
+
+
+def sort_deltas(deltas):
+    return deltas.sort_values(KEY_COLUMNS + ['Дата'], ignore_index=True)
+
+
+def append(deltas, calendar, df_new):
+    """
+    Дельты новых снимков, датированных позже календаря: первый новый день сравнивается
+    с последним известным состоянием. Возвращает (новые дельты, новые даты календаря).
+    """
+    new_calendar = build_calendar(df_new)
+    previous = last_state(deltas, calendar)
+    daily = _recategorize(pd.concat([previous, daily_values(df_new)], ignore_index=True))
+    last_dates = calendar.groupby('Склад', observed=True, as_index=False)['Дата'].max()
+    full_calendar = _recategorize(pd.concat([last_dates, new_calendar], ignore_index=True))
+    full_calendar = full_calendar.sort_values(['Склад', 'Дата'], ignore_index=True)
+
+    encoded = encode(daily, full_calendar)
+    cutoff = pd.to_datetime(encoded['Склад'].astype(object).map(last_dates.set_index('Склад')['Дата'].to_dict()))
+    return encoded[(encoded['Дата'] > cutoff).to_numpy()].reset_index(drop=True), new_calendar
+
+
+# --- Вычисления по дельтам ---
+
+def _runs(deltas, calendar):
+    """Позиция строки в календаре и позиция, до которой действует её значение."""
+    pos = _positions(deltas, calendar)
+    key = deltas.groupby(KEY_COLUMNS, observed=True, sort=False).ngroup().to_numpy()
+    same_next = np.r_[key[1:] == key[:-1], False]
+    end = np.where(same_next, np.r_[pos[1:], 0], _calendar_ends(calendar)[pos])
+    return pos, end
+
+
+def since(deltas, start):
+    """
+    Дельты, достаточные для расчётов с даты start: строки с этой даты и по каждому артикулу
+    склада последнее появление до неё (со строкой отсутствия после него, если она есть).
+    От этого появления считается изменение остатка в первый день и действующее на start значение.
+    deltas должны быть упорядочены по (Склад, Артикул, Дата), как их возвращает update.
+    """
+    rows = np.arange(len(deltas))
+    before = (deltas['Дата'] < start).to_numpy()
+    key = deltas.groupby(KEY_COLUMNS, observed=True, sort=False).ngroup().to_numpy()
+    last_present = pd.Series(np.where(before & deltas['Есть'].to_numpy(), rows, -1)).groupby(key).transform('max')
+    return deltas[~before | (rows >= last_present.to_numpy())].reset_index(drop=True)
+
+
+def daily_diffs(deltas, calendar):
+    """
+    Аналог analyze.build_daily_diffs по дельтам: строки только в дни изменений
+    и в первый день каждого месяца, в который продолжает действовать значение.
+    Колонка Дней — число дат календаря, которые строка представляет в своём месяце.
+    """
+    pos, end = _runs(deltas, calendar)
+    present = deltas['Есть'].to_numpy()
+    pos, end = pos[present], end[present]
+    rows = deltas[present].drop(columns=['Есть', 'Количество_всего']).reset_index(drop=True)
+
+    # Изменение остатка — к предыдущему появлению артикула, как в полных снимках
+    diff_dtype = 'float32' if rows['Количество'].dtype.itemsize <= 4 else 'float64'
+    rows['diff_qty'] = (
+        rows.groupby(KEY_COLUMNS, observed=True)['Количество'].diff().fillna(0).astype(diff_dtype)
+    )
+
+    # Начала месяцев календаря: значение, действующее через границу месяца, повторяется в её первый день
+    dates = calendar['Дата']
+    month = (dates.dt.year * 12 + dates.dt.month).to_numpy()
+    starts = np.flatnonzero(np.r_[True, (month[1:] != month[:-1])
+                                  | (calendar['Склад'].to_numpy()[1:] != calendar['Склад'].to_numpy()[:-1])])
+    bounds = np.r_[starts, len(calendar)]
+    first_carry = np.searchsorted(starts, pos, 'right')
+    carry_count = np.searchsorted(starts, end, 'left') - first_carry
+    source = np.repeat(np.arange(len(rows)), carry_count)
+    carry_pos = starts[np.repeat(first_carry, carry_count) + _ranges(carry_count)]
+    carry = rows.iloc[source].reset_index(drop=True)
+    carry['Дата'] = dates.to_numpy()[carry_pos]
+    carry['diff_qty'] = carry['diff_qty'].dtype.type(0)
+
+    all_pos = np.r_[pos, carry_pos]
+    all_end = np.r_[end, end[source]]
+    month_end = bounds[np.searchsorted(starts, all_pos, 'right')]
+    df_daily = pd.concat([rows, carry], ignore_index=True)
+    df_daily['Дней'] = np.minimum(all_end, month_end) - all_pos
+    df_daily = df_daily.sort_values(['Артикул', 'Склад', 'Дата'], ignore_index=True)
+
+    df_daily['Год'] = df_daily['Дата'].dt.year.astype('int16')
+    df_daily['Месяц'] = df_daily['Дата'].dt.month.astype('int8')
+    df_daily['Продано'] = (-df_daily['diff_qty']).clip(lower=0)
+    df_daily['Пополнение'] = df_daily['diff_qty'].clip(lower=0)
+    return df_daily[['Артикул', 'Склад', 'Дата', 'Количество', 'Цена', 'Номенклатура', 'Производитель',
+                     'Год', 'Месяц', 'diff_qty', 'Продано', 'Пополнение', 'Дней']]
+
+
+def _ranges(counts):
+    """[0..c0-1, 0..c1-1, ...] для массива длин."""
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.arange(int(counts.sum())) - offsets
+
+
+def daily_sales(deltas, calendar, start=None):
+    """
+    Аналог analyze.build_daily_sales: значения дельт, развёрнутые на каждый день календаря
+    (с start — только на дни не раньше start, без разворачивания более ранней истории).
+    """
+    pos, end = _runs(deltas, calendar)
+    present = deltas['Есть'].to_numpy()
+    pos, end = pos[present], end[present]
+    rows = deltas[present]
+    if start is not None:
+        # Первая дата склада не раньше start: начало склада в календаре и число его дат до start
+        by_sklad = calendar.groupby('Склад', observed=True, sort=False)
+        earlier = (calendar['Дата'] < start).groupby(calendar['Склад'], observed=True, sort=False).transform('sum')
+        first = np.arange(len(calendar)) - by_sklad.cumcount().to_numpy() + earlier.to_numpy()
+        pos = np.maximum(pos, first[pos])
+        end = np.maximum(end, pos)
+    counts = end - pos
+    source = np.repeat(np.arange(len(rows)), counts)
+    df_daily = pd.DataFrame({
+        'Дата': calendar['Дата'].to_numpy()[np.repeat(pos, counts) + _ranges(counts)],
+        'Артикул': rows['Артикул'].array.take(source),
+        'Склад': rows['Склад'].array.take(source),
+        'Всего_продано': rows['Количество_всего'].to_numpy()[source],
+        'Цена_в_начале_дня': rows['Цена'].to_numpy()[source],
+    })
+    return df_daily.sort_values(['Дата', 'Склад', 'Артикул'], ignore_index=True)
+
+
+# --- Хранение на диске ---
+
+def _warehouse_dir(store_dir, name):
+    return os.path.join(store_dir, quote(name, safe=''))
+
+
+def load_state(store_dir=DELTA_DIR):
+    try:
+        with open(os.path.join(store_dir, STATE_NAME), encoding='utf-8') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning(f'Состояние хранилища дельт повреждено, оно будет пересобрано: {e}')
+        return None
+    return state
+
+
+def _save_state(state, store_dir):
+    path = os.path.join(store_dir, STATE_NAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def _file_signatures(tasks):
+    signatures = {}
+    for path, _, layout in tasks:
+        stat = os.stat(path)
+        signatures[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns, warehouses.layout_key(layout)]
+    return signatures
+
+
+def _read_parts(directory, names):
+    parts = [pd.read_parquet(os.path.join(directory, name)) for name in names]
+    return sort_deltas(_recategorize(pd.concat(parts, ignore_index=True)))
+
+
+def _replace_parquet(df, path):
+    df.to_parquet(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+
+def _write_warehouse(directory, entry, deltas, calendar, pairs):
+    """Дописывает часть дельт склада и заменяет его календарь и пары; пустой список частей — пересборка."""
+    if not entry['parts']:
+        shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory, exist_ok=True)
+    part = f'part-{len(entry["parts"]):06d}.parquet'
+    deltas.to_parquet(os.path.join(directory, part), index=False)
+    entry['parts'].append(part)
+    _replace_parquet(calendar, os.path.join(directory, 'calendar.parquet'))
+    _replace_parquet(pairs, os.path.join(directory, 'pairs.parquet'))
+
+
+def _split_by_warehouse(df):
+    if df is None:
+        return {}
+    return {name: part for name, part in df.groupby('Склад', observed=True, sort=False)}
+
+
+def update(tasks, read_snapshots, versions, rebuild=False, store_dir=DELTA_DIR):
+    """
+    Приводит хранилище в соответствие с исходными снимками и возвращает
+    (дельты, календарь, пары (Номенклатура, Артикул)) по всем складам или None, если данных нет.
+
+    tasks — задачи чтения (путь, склад, раскладка); read_snapshots(tasks) возвращает
+    (подготовленные снимки после analyze.prepare_snapshots или None, список ошибок (путь, текст)).
+    Снимки всех складов читаются одним вызовом. Файлы с ошибками не запоминаются
+    и читаются снова при следующем обновлении.
+    versions — версии разборщика и нормализации: при их смене, как и с rebuild,
+    хранилище пересобирается.
+    """
+    state = None if rebuild else load_state(store_dir)
+    if state is None or state.get('version') != DELTA_VERSION or state.get('versions') != versions:
+        state = {'version': DELTA_VERSION, 'versions': versions, 'warehouses': {}}
+
+    by_warehouse = {}
+    for task in tasks:
+        by_warehouse.setdefault(task[1], []).append(task)
+    for name in set(state['warehouses']) - set(by_warehouse):
+        shutil.rmtree(_warehouse_dir(store_dir, name), ignore_errors=True)
+        del state['warehouses'][name]
+
+    # Склад дописывается, если все запомненные файлы на месте и не изменились, иначе пересобирается
+    stored, signatures = {}, {}
+    for name, warehouse_tasks in by_warehouse.items():
+        signatures[name] = _file_signatures(warehouse_tasks)
+        entry = state['warehouses'].get(name)
+        if entry and entry['parts'] and all(signatures[name].get(path) == sig
+                                            for path, sig in entry['files'].items()):
+            directory = _warehouse_dir(store_dir, name)
+            stored[name] = (_read_parts(directory, entry['parts']),
+                            pd.read_parquet(os.path.join(directory, 'calendar.parquet')),
+                            pd.read_parquet(os.path.join(directory, 'pairs.parquet')))
+    pending = [task for name, warehouse_tasks in by_warehouse.items() for task in warehouse_tasks
+               if name not in stored or os.path.abspath(task[0]) not in state['warehouses'][name]['files']]
+    df_new, errors = read_snapshots(pending) if pending else (None, [])
+    frames = _split_by_warehouse(df_new)
+
+    # Снимки задним числом: такие склады пересобираются целиком
+    backfilled = [name for name, df in frames.items()
+                  if name in stored and df['Дата'].min() <= stored[name][1]['Дата'].max()]
+    if backfilled:
+        logging.info(f'🧮 Снимки задним числом, дельты пересобираются: {", ".join(backfilled)}')
+        for name in backfilled:
+            del stored[name]
+        df_rebuild, rebuild_errors = read_snapshots([task for name in backfilled for task in by_warehouse[name]])
+        frames.update(_split_by_warehouse(df_rebuild))
+        errors = errors + rebuild_errors
+    failed = {os.path.abspath(path) for path, _ in errors}
+
+    results = []
+    for name in by_warehouse:
+        df = frames.get(name)
+        if name in stored:
+            deltas, calendar, pairs = stored[name]
+            entry = state['warehouses'][name]
+        else:
+            deltas = calendar = pairs = None
+            entry = {'files': {}, 'parts': []}
+        if df is not None:
+            new_pairs = df[['Номенклатура', 'Артикул']].drop_duplicates()
+            if deltas is not None:
+                new_deltas, new_calendar = append(deltas, calendar, df)
+                deltas = sort_deltas(_recategorize(pd.concat([deltas, new_deltas], ignore_index=True)))
+                calendar = pd.concat([calendar, new_calendar], ignore_index=True)
+                pairs = pd.concat([pairs, new_pairs], ignore_index=True).drop_duplicates(ignore_index=True)
+            else:
+                calendar = build_calendar(df)
+                new_deltas = deltas = encode(daily_values(df), calendar)
+                pairs = new_pairs.reset_index(drop=True)
+            _write_warehouse(_warehouse_dir(store_dir, name), entry, new_deltas, calendar, pairs)
+            logging.info(f'🧮 Дельты склада {name}: строк снимков {len(df)}, новых дельт {len(new_deltas)}, '
+                         f'всего дельт {len(deltas)}, дат {len(calendar)}')
+        entry['files'] = {path: sig for path, sig in signatures[name].items() if path not in failed}
+        state['warehouses'][name] = entry
+        if deltas is not None:
+            results.append((deltas, calendar, pairs))
+
+    os.makedirs(store_dir, exist_ok=True)
+    _save_state(state, store_dir)
+    if not results:
+        return None
+    deltas = _recategorize(pd.concat([r[0] for r in results], ignore_index=True))
+    calendar = _recategorize(pd.concat([r[1] for r in results], ignore_index=True))
+    pairs = pd.concat([r[2] for r in results], ignore_index=True).drop_duplicates(ignore_index=True)
+    return deltas, calendar, pairs
@@ -0,0 +1,98 @@
+"""
+Прореживание длинных рядов для графиков дашборда: браузеру отправляется не больше точек,
+чем различимо по ширине графика.
+
+Ось X делится на равные отрезки (по два на точку бюджета), и из каждого берутся самая низкая
+и самая высокая точки (min/max-прореживание): линия по ним повторяет огибающую полного ряда,
+пики и провалы не сглаживаются, как при усреднении. Считается сразу для всего ряда, без цикла
+по отрезкам. Отмеченные точки (всплески, смены цены) сохраняются все; если их больше бюджета —
+прореживаются так же, отдельно от остальных.
+
+При увеличении графика ряд прореживается заново в видимом диапазоне: детали появляются
+по мере приближения, а полный диапазон дат остаётся доступен.
+"""
+import numpy as np
+import pandas as pd
+
+DEFAULT_WIDTH = 1200  # ширина графика в пикселях, пока браузер её не сообщил
+POINTS_PER_PIXEL = 1
+MIN_POINTS = 100
+
+
+def point_budget(width=None):
+    """Сколько точек одного ряда отправлять на график шириной width пикселей."""
+    return max(MIN_POINTS, int((width or DEFAULT_WIDTH) * POINTS_PER_PIXEL))
+
+
+def minmax_indices(x, y, budget):
+    """
+    Номера не более чем budget точек ряда (x по возрастанию, y), сохраняющих его форму:
+    первая и последняя точки и самая низкая и самая высокая точка каждого из budget / 2 отрезков оси X.
+    """
+    n = len(y)
+    if n <= budget:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    # Пропуски y не выбираются как крайние точки: вместо них — соседнее значение
+    y = pd.Series(y, dtype='float64').ffill().bfill().fillna(0).to_numpy()
+
+    n_buckets = max(1, (budget - 2) // 2)
+    span = x[-1] - x[0]
+    if span > 0:
+        bucket = np.minimum(((x - x[0]) / span * n_buckets).astype(np.int64), n_buckets - 1)
+    else:
+        bucket = np.zeros(n, dtype=np.int64)
+    order = np.lexsort((y, bucket))
+    sorted_bucket = bucket[order]
+    first = np.flatnonzero(np.r_[True, sorted_bucket[1:] != sorted_bucket[:-1]])
+    last = np.r_[first[1:] - 1, n - 1]
+    return np.unique(np.concatenate([order[first], order[last], [0, n - 1]]))
+
+
+def select_points(x, y, budget, keep=None, x_range=None):
+    """
+    Номера строк ряда для графика: точки формы ряда (minmax_indices) и все отмеченные keep.
+    x — даты по возрастанию; x_range — видимый диапазон (начало, конец) или None для всего ряда:
+    берутся точки диапазона и по одной соседней с каждой стороны, чтобы линия доходила до краёв.
+    Строки с пустой датой на график не попадают.
+    """
+    x = pd.to_datetime(pd.Series(x)).to_numpy(dtype='datetime64[ns]')
+    y = np.asarray(y, dtype=np.float64)
+    positions = np.flatnonzero(~np.isnat(x))
+    x = x[positions].astype(np.int64).astype(np.float64)
+    if x_range is not None:
+        low, high = (pd.Timestamp(bound).value for bound in x_range)
+        start = max(0, int(np.searchsorted(x, low, side='left')) - 1)
+        stop = min(len(x), int(np.searchsorted(x, high, side='right')) + 1)
+        positions, x = positions[start:stop], x[start:stop]
+
+    chosen = minmax_indices(x, y[positions], budget)
+    if keep is not None:
+        marked = np.flatnonzero(np.asarray(keep, dtype=bool)[positions])
+        marked = marked[minmax_indices(x[marked], y[positions][marked], budget)]
+        chosen = np.union1d(chosen, marked)
+    return positions[chosen]
+
+
+def zoom_range(relayout_data):
+    """
+    Видимый диапазон оси X из relayoutData графика: (начало, конец) как pd.Timestamp;
+    None — вся ось (масштаб сброшен или не менялся).
+    """
+    relayout_data = relayout_data or {}
+    if 'xaxis.range[0]' in relayout_data and 'xaxis.range[1]' in relayout_data:
+        bounds = relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]']
+    elif 'xaxis.range' in relayout_data:
+        bounds = relayout_data['xaxis.range']
+    else:
+        return None
+    try:
+        start, end = (pd.Timestamp(bound) for bound in bounds)
+    except (TypeError, ValueError):
+        return None
+    return (start, end) if start <= end else (end, start)
+
+
+def changes_zoom(relayout_data):
+    """Меняет ли событие relayoutData масштаб оси X (а не, например, размер или оси Y)."""
+    return any(key.startswith('xaxis.range') or key == 'xaxis.autorange' for key in (relayout_data or {}))
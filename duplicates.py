@@ -0,0 +1,173 @@
+"""
+Поиск возможных дублей артикулов и наименований в каталоге.
+
+Работает по уникальным парам (артикул, наименование), а не по строкам снимков.
+Кандидаты на дубли отбираются блокировкой по инвертированному индексу
+(символьные n-граммы артикулов, слова наименований): сравниваются только значения
+с общим редким n-граммом/словом, а слишком крупные блоки пропускаются.
+Поэтому объём работы растёт почти линейно с размером каталога, а не квадратично.
+Оценка пары — коэффициент Жаккара по полным множествам n-грамм/слов.
+"""
+import re
+
+import numpy as np
+import pandas as pd
+
+import normalization
+import profiling
+
+PAIR_COLUMNS = ['Номенклатура', 'Артикул', 'Артикул_норм', 'Номенклатура_норм']
+CANDIDATE_COLUMNS = ['Тип', 'Оценка', 'Артикул_1', 'Артикул_2', 'Номенклатура_1', 'Номенклатура_2']
+
+_TOKEN_RE = re.compile(r'\w{2,}')
+
+
+def unique_pairs(df_all):
+    """
+    Уникальные сочетания артикула и наименования в порядке первого появления
+    с нормализованными формами обоих значений.
+    """
+    pairs = df_all[['Номенклатура', 'Артикул']].drop_duplicates().reset_index(drop=True)
+    pairs['Артикул_норм'] = normalization.normalize_articles(pairs['Артикул'])
+    pairs['Номенклатура_норм'] = normalization.normalize_nomenclatures(pairs['Номенклатура'])
+    return pairs[PAIR_COLUMNS]
+
+
+def find_name_conflicts(pairs):
+    """Одно нормализованное наименование встречается с разными нормализованными артикулами."""
+    counts = pairs.groupby('Номенклатура_норм', observed=True)['Артикул_норм'].nunique()
+    conflicting = counts.index[counts > 1]
+    return pairs[pairs['Номенклатура_норм'].isin(conflicting)].reset_index(drop=True)
+
+
+def char_ngrams(value, n=3):
+    padded = f'#{value}#'
+    if len(padded) <= n:
+        return {padded}
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+
+def word_tokens(value):
+    return set(_TOKEN_RE.findall(value))
+
+
+def _gram_table(values, tokenize):
+    """Длинная таблица (id значения, код n-грамма) по уникальным значениям."""
+    grams = [tokenize(v) for v in values]
+    lengths = np.fromiter((len(g) for g in grams), dtype=np.int64, count=len(grams))
+    codes, _ = pd.factorize(np.array([g for group in grams for g in group], dtype=object))
+    return pd.DataFrame({
+        'id': np.repeat(np.arange(len(values), dtype=np.int32), lengths),
+        'gram': codes.astype(np.int32),
+    })
+
+
+def _count_shared(table, ids_1, ids_2, chunk_cells=20_000_000):
+    """
+    Число общих n-грамм для пар (ids_1[i], ids_2[i]): n-граммы значений раскладываются
+    в матрицу (значение × позиция), пары сравниваются блоками без хеш-соединений.
+    """
+    width = int(table['rank'].max()) + 1
+    matrix = np.full((int(table['id'].max()) + 1, width), -1, dtype=np.int32)
+    matrix[table['id'].to_numpy(), table['rank'].to_numpy()] = table['gram'].to_numpy()
+
+    result = np.empty(len(ids_1), dtype=np.int64)
+    step = max(1, chunk_cells // (width * width))
+    for start in range(0, len(ids_1), step):
+        left = matrix[ids_1[start:start + step]][:, :, None]
+        right = matrix[ids_2[start:start + step]][:, None, :]
+        result[start:start + step] = ((left == right) & (left >= 0)).sum(axis=(1, 2))
+    return result
+
+
+def similar_pairs(values, tokenize, threshold, max_block=200):
+    """
+    Пары индексов values с коэффициентом Жаккара не ниже threshold.
+
+    Кандидаты отбираются префиксной фильтрацией: n-граммы каждого значения
+    упорядочиваются от редких к частым, и при J >= threshold у пары обязательно
+    есть общий n-грамм среди первых |A| - ceil(threshold * |A|) + 1 n-грамм.
+    Блоки префиксного индекса больше max_block пропускаются, остальные кандидаты
+    проверяются точным пересечением по всем n-граммам.
+    """
+    table = _gram_table(values, tokenize)
+    empty = pd.DataFrame({'id_1': [], 'id_2': [], 'Оценка': []})
+    if table.empty:
+        return empty
+
+    table['freq'] = table.groupby('gram')['id'].transform('size')
+    table = table.sort_values(['id', 'freq', 'gram'], kind='stable', ignore_index=True)
+    sizes = table.groupby('id').size()
+    size_of = sizes.reindex(table['id']).to_numpy()
+    prefix_len = size_of - np.ceil(threshold * size_of - 1e-9).astype(np.int64) + 1
+    table['rank'] = table.groupby('id').cumcount().to_numpy()
+    prefix = table[table['rank'].to_numpy() < prefix_len]
+
+    block_size = prefix.groupby('gram')['id'].transform('size')
+    blocks = prefix.loc[(block_size > 1) & (block_size <= max_block), ['id', 'gram']]
+    candidates = blocks.merge(blocks, on='gram', suffixes=('_1', '_2'))
+    candidates = candidates.loc[candidates['id_1'] < candidates['id_2'], ['id_1', 'id_2']].drop_duplicates()
+
+    # Фильтр по длине: при J >= threshold меньшее множество не короче threshold * большего
+    n1 = sizes.reindex(candidates['id_1']).to_numpy()
+    n2 = sizes.reindex(candidates['id_2']).to_numpy()
+    candidates = candidates[np.minimum(n1, n2) >= threshold * np.maximum(n1, n2) - 1e-9]
+    if candidates.empty:
+        return empty
+
+    # Точное пересечение по всем n-граммам пары, включая частые
+    shared = candidates.reset_index(drop=True)
+    shared['shared'] = _count_shared(table, shared['id_1'].to_numpy(), shared['id_2'].to_numpy())
+    total = sizes.reindex(shared['id_1']).to_numpy() + sizes.reindex(shared['id_2']).to_numpy()
+    shared['Оценка'] = shared['shared'] / (total - shared['shared'])
+    return shared.loc[shared['Оценка'] >= threshold, ['id_1', 'id_2', 'Оценка']].reset_index(drop=True)
+
+
+def _first_by(pairs, key, value):
+    return pairs.drop_duplicates(key).set_index(key)[value]
+
+
+@profiling.traced
+def find_near_duplicates(pairs, article_threshold=0.6, name_threshold=0.8, max_block=200):
+    """
+    Кандидаты в дубли: похожие нормализованные артикулы (по символьным триграммам)
+    и похожие нормализованные наименования (по словам). Возвращает таблицу пар с оценкой.
+    """
+    # Сортировка делает результат независимым от порядка пар (например, при сборке из шардов)
+    pairs = (
+        pairs.dropna(subset=['Артикул_норм', 'Номенклатура_норм'])[PAIR_COLUMNS].astype(str)
+        .sort_values(['Артикул_норм', 'Номенклатура_норм', 'Артикул', 'Номенклатура'])
+    )
+    articles = pd.Index(np.sort(pairs['Артикул_норм'].unique()))
+    names = pd.Index(np.sort(pairs['Номенклатура_норм'].unique()))
+    name_of_article = _first_by(pairs, 'Артикул_норм', 'Номенклатура')
+    article_of_name = _first_by(pairs.sort_values(['Номенклатура_норм', 'Артикул']), 'Номенклатура_норм', 'Артикул')
+
+    result = []
+    by_article = similar_pairs(articles, char_ngrams, article_threshold, max_block)
+    if not by_article.empty:
+        a1, a2 = articles[by_article['id_1']], articles[by_article['id_2']]
+        result.append(pd.DataFrame({
+            'Тип': 'артикул',
+            'Оценка': by_article['Оценка'].to_numpy(),
+            'Артикул_1': a1, 'Артикул_2': a2,
+            'Номенклатура_1': name_of_article.reindex(a1).to_numpy(),
+            'Номенклатура_2': name_of_article.reindex(a2).to_numpy(),
+        }))
+
+    by_name = similar_pairs(names, word_tokens, name_threshold, max_block)
+    if not by_name.empty:
+        n1, n2 = names[by_name['id_1']], names[by_name['id_2']]
+        result.append(pd.DataFrame({
+            'Тип': 'наименование',
+            'Оценка': by_name['Оценка'].to_numpy(),
+            'Артикул_1': article_of_name.reindex(n1).to_numpy(),
+            'Артикул_2': article_of_name.reindex(n2).to_numpy(),
+            'Номенклатура_1': n1, 'Номенклатура_2': n2,
+        }))
+
+    if not result:
+        return pd.DataFrame(columns=CANDIDATE_COLUMNS)
+    candidates = pd.concat(result, ignore_index=True)
+    return candidates.sort_values(['Тип', 'Оценка', 'Артикул_1', 'Артикул_2'], ascending=[True, False, True, True],
+                                  kind='stable').reset_index(drop=True)
@@ -0,0 +1,142 @@
+"""
+Чтение ежедневных снимков остатков (.xls/.xlsx) в колоночном виде.
+
+Каждый бэкенд возвращает пару (значение ячейки с датой, {колонка: список значений})
+без построчной сборки словарей — колонки сразу передаются в DataFrame.
+"""
+import importlib.util
+import os
+
+# Раскладка снимка: дата в A2, данные с 5-й строки, колонки B..F
+DEFAULT_LAYOUT = {
+    'date_cell': (1, 0),
+    'first_row': 4,
+    'columns': {
+        'Номенклатура': 1,
+        'Количество': 2,
+        'Цена': 3,
+        'Производитель': 4,
+        'Артикул': 5,
+    },
+}
+
+
+def _pick_columns(rows, layout):
+    """Транспонирует строки листа в колонки согласно раскладке."""
+    row_idx, col_idx = layout['date_cell']
+    date_cell = None
+    if len(rows) > row_idx and len(rows[row_idx]) > col_idx:
+        date_cell = rows[row_idx][col_idx]
+
+    data_rows = rows[layout['first_row']:]
+    columns = {}
+    for name, col in layout['columns'].items():
+        columns[name] = [row[col] if len(row) > col else None for row in data_rows]
+    return date_cell, columns
+
+
+def _clean_values(values):
+    """
+    Приводит значения xlrd/calamine к виду openpyxl: пустые ячейки ('') — None,
+    целые числа, пришедшие как float, — int (иначе артикул 12345 станет '12345.0').
+    """
+    return [
+        None if v == '' else int(v) if isinstance(v, float) and v.is_integer() else v
+        for v in values
+    ]
+
+
+def read_openpyxl(file_path, layout=DEFAULT_LAYOUT):
+    """Потоковое чтение .xlsx в режиме read_only через iter_rows(values_only=True)."""
+    from openpyxl import load_workbook
+
+    max_col = max(max(layout['columns'].values()), layout['date_cell'][1]) + 1
+    wb = load_workbook(filename=file_path, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        rows = list(ws.iter_rows(max_col=max_col, values_only=True))
+    finally:
+        wb.close()
+    return _pick_columns(rows, layout)
+
+
+def read_xlrd(file_path, layout=DEFAULT_LAYOUT):
+    """Чтение .xls срезами колонок через xlrd (col_values), без построчного обхода."""
+    import xlrd
+
+    book = xlrd.open_workbook(file_path, on_demand=True)
+    try:
+        sheet = book.sheet_by_index(0)
+        row_idx, col_idx = layout['date_cell']
+        date_cell = None
+        if sheet.nrows > row_idx and sheet.ncols > col_idx:
+            cell = sheet.cell(row_idx, col_idx)
+            date_cell = cell.value
+            if cell.ctype == xlrd.XL_CELL_DATE:
+                date_cell = xlrd.xldate_as_datetime(cell.value, book.datemode)
+
+        first_row = layout['first_row']
+        columns = {}
+        for name, col in layout['columns'].items():
+            if col >= sheet.ncols:
+                columns[name] = [None] * max(sheet.nrows - first_row, 0)
+                continue
+            columns[name] = _clean_values(sheet.col_values(col, start_rowx=first_row))
+    finally:
+        book.release_resources()
+    return date_cell, columns
+
+
+def read_calamine(file_path, layout=DEFAULT_LAYOUT):
+    """Чтение .xls/.xlsx через python-calamine (Rust), если он установлен."""
+    from python_calamine import CalamineWorkbook
+
+    wb = CalamineWorkbook.from_path(file_path)
+    rows = wb.get_sheet_by_index(0).to_python(skip_empty_area=False)
+    date_cell, columns = _pick_columns(rows, layout)
+    if date_cell == '':
+        date_cell = None
+    return date_cell, {name: _clean_values(values) for name, values in columns.items()}
+
+
+READERS = {
+    'calamine': read_calamine,
+    'openpyxl': read_openpyxl,
+    'xlrd': read_xlrd,
+}
+
+# Порядок предпочтения движков по расширению: первый доступный выигрывает
+ENGINES_BY_EXTENSION = {
+    '.xlsx': ['calamine', 'openpyxl'],
+    '.xls': ['calamine', 'xlrd'],
+}
+
+_ENGINE_MODULES = {
+    'calamine': 'python_calamine',
+    'openpyxl': 'openpyxl',
+    'xlrd': 'xlrd',
+}
+
+
+def is_engine_available(engine):
+    return importlib.util.find_spec(_ENGINE_MODULES[engine]) is not None
+
+
+def available_engines(extension):
+    return [e for e in ENGINES_BY_EXTENSION.get(extension, []) if is_engine_available(e)]
+
+
+def read_columns(file_path, engine=None, layout=DEFAULT_LAYOUT):
+    """
+    Читает снимок выбранным движком (или первым доступным для расширения).
+    Возвращает (значение ячейки с датой, {колонка: список значений}).
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    if engine is None:
+        engines = available_engines(extension)
+        if not engines:
+            raise ValueError(f'Нет доступного движка для файлов {extension}')
+        engine = engines[0]
+    elif engine not in ENGINES_BY_EXTENSION.get(extension, []):
+        raise ValueError(f'Движок {engine} не поддерживает файлы {extension}')
+    return READERS[engine](file_path, layout)
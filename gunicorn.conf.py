@@ -0,0 +1,14 @@
+"""
+Настройки gunicorn для дашборда; gunicorn читает этот файл из рабочего каталога сам.
+
+Дашборд загружает таблицы лениво, при первом обращении. С --preload приложение
+импортируется в главном процессе до fork, и таблицы загружаются там же (хук when_ready):
+рабочие процессы наследуют их общими страницами, а не читают каждый свою копию.
+"""
+
+
+def when_ready(server):
+    """Главный процесс запущен, рабочие ещё не созданы: с --preload загружаем таблицы."""
+    if server.cfg.preload_app:
+        import dashboard
+        dashboard.warm_tables()
@@ -0,0 +1,226 @@
+"""
+Инкрементальный месячный анализ для дописываемых снимков.
+
+Снимки только добавляются, поэтому новые файлы затрагивают лишь последние месяцы.
+Новые снимки дописываются в хранилище дельт (как в analyze.py), а пересчитываются
+месяцы начиная с самой ранней даты нового или изменённого файла: дневные и месячные
+показатели считаются теми же функциями по дельтам (delta_store.daily_diffs,
+analyze.aggregate_monthly, delta_store.daily_sales), но только по дельтам с начала
+пересчёта и действующим на него значениям (delta_store.since) — изменение остатка
+в первый день считается от последнего известного. Пересчитанные месяцы заменяют
+соответствующие разделы хранилища, прочие разделы переносятся без чтения,
+итоги и топы заново выводятся из месячной таблицы. Поэтому время ежедневного
+обновления определяется объёмом новых данных, а не длиной истории.
+
+При задержке перемещений новое поступление может погасить отправку предыдущего месяца,
+поэтому пересчитываются и заменяются месяцы начиная с месяца самой ранней отправки,
+которую могут погасить новые снимки (за transfer_lag_days дней до первого из них).
+Дельты ещё за transfer_lag_days дней до этого месяца (с начала их месяца) берутся
+как контекст: поступления пересчитываемых месяцев сопоставляются с отправками
+предыдущих; сами эти дни не пересчитываются.
+
+Полный пересчёт выполняется при первом запуске, смене параметров, удалении
+исходных файлов, если хранилище опубликовано не этим режимом или опубликованную
+месячную таблицу не удалось прочитать.
+
+Запуск: python incremental.py [--transfer-lag N] [--excel] ...
+Тот же пересчёт с тем же состоянием выполняет режим наблюдения: python analyze.py --watch.
+"""
+import argparse
+import json
+import logging
+import os
+
+import pandas as pd
+
+import analyze
+import artifact_store
+import delta_store
+import duplicates
+import excel_readers
+import profiling
+import schema
+import transfers
+import warehouses
+
+STATE_DIR = os.path.join('кэш', 'инкремент')
+STATE_NAME = 'state.json'
+
+
+def load_state(state_dir=STATE_DIR):
+    try:
+        with open(os.path.join(state_dir, STATE_NAME), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning(f'Состояние инкрементального режима повреждено, будет полный пересчёт: {e}')
+        return None
+
+
+def save_state(state, state_dir=STATE_DIR):
+    os.makedirs(state_dir, exist_ok=True)
+    path = os.path.join(state_dir, STATE_NAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def _signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _month_start(date):
+    return pd.Timestamp(date).to_period('M').to_timestamp()
+
+
+def _months_before(month):
+    """Фильтр pyarrow: разделы строго раньше месяца month."""
+    return [[('Год', '<', month.year)], [('Год', '=', month.year), ('Месяц', '<', month.month)]]
+
+
+def _month_index(df):
+    return df['Год'].astype('int32') * 12 + df['Месяц'].astype('int32')
+
+
+def _recategorize(df):
+    """После concat частей с разными словарями возвращает ключевым колонкам тип category."""
+    for col in schema.CATEGORY_COLUMNS + ['Артикул_норм', 'Номенклатура_норм']:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+    return df
+
+
+@profiling.traced
+def update_monthly(jobs=1, engine=None, use_cache=True, transfer_lag_days=0, transfer_qty_tolerance=0,
+                   top_n=analyze.TOP_N, export_excel=False, state_dir=STATE_DIR):
+    """Пересчитывает месяцы, затронутые новыми снимками, и публикует обновлённые наборы."""
+    params = {'transfer_lag_days': transfer_lag_days, 'transfer_qty_tolerance': transfer_qty_tolerance}
+    state = load_state(state_dir)
+    manifest = artifact_store.load_manifest()
+
+    sources = {os.path.abspath(task[0]): task for task in analyze.snapshot_tasks()}
+
+    full = (
+        state is None or state['params'] != params or manifest is None
+        or manifest['version'] != state['store_version']
+        or any(path not in sources for path in state['files'])
+    )
+    known = {} if full else state['files']
+    changed = [
+        task for path, task in sources.items()
+        if path not in known or known[path]['sklad'] != task[1] or known[path]['signature'] != _signature(task[0])
+        or known[path].get('layout') != warehouses.layout_key(task[2])
+    ]
+    if not changed:
+        logging.info('✅ Новых снимков нет, месячные итоги актуальны')
+        return
+
+    new_files, _ = analyze.ingest_files(changed, jobs=jobs, engine=engine, use_cache=use_cache, with_paths=True)
+    if not new_files:
+        logging.warning('Новые снимки не содержат данных')
+        return
+    file_dates = {os.path.abspath(path): df['Дата'].iloc[0] for path, df in new_files}
+
+    # Уже опубликованные месяцы до пересчитываемых — основа для итогов
+    start_month = None
+    df_kept = None
+    if not full:
+        # Перемещение через границу месяца меняет оба месяца: пересчёт — с месяца отправки
+        lag = pd.Timedelta(days=transfer_lag_days)
+        start_month = _month_start(min(file_dates.values()) - lag)
+        df_kept = artifact_store.read_dataset('итог_по_месяцу', filters=_months_before(start_month))
+        if df_kept is None:
+            logging.warning('Не удалось прочитать опубликованные месячные итоги, будет полный пересчёт')
+            full, start_month = True, None
+
+    store = analyze.load_deltas(jobs=jobs, engine=engine, use_cache=use_cache)
+    if store is None:
+        logging.warning('Снимки не содержат данных')
+        return
+    deltas, calendar, snapshot_pairs = store
+
+    deltas_daily = deltas_sales = deltas
+    if full:
+        logging.info(f'🔁 Полный пересчёт: {len(sources)} снимков')
+    else:
+        context_start = _month_start(start_month - lag)
+        deltas_daily = delta_store.since(deltas, context_start)
+        deltas_sales = delta_store.since(deltas, start_month)
+        logging.info(f'➕ Инкрементальный пересчёт с {start_month:%m.%Y}: новых снимков {len(new_files)}, '
+                     f'дельт с {context_start:%d.%m.%Y} {len(deltas_daily)} из {len(deltas)}')
+
+    df_daily = delta_store.daily_diffs(deltas_daily, calendar)
+    df_daily, _ = transfers.reconcile_transfers(
+        df_daily, max_lag_days=transfer_lag_days, qty_tolerance=transfer_qty_tolerance
+    )
+    df_partial = analyze.aggregate_monthly(df_daily)
+    del df_daily
+    df_daily_sales = delta_store.daily_sales(deltas_sales, calendar, start=start_month)
+    if start_month is not None:
+        df_partial = df_partial[_month_index(df_partial) >= start_month.year * 12 + start_month.month]
+        df_partial = df_partial.reset_index(drop=True)
+    df_partial = analyze.finalize_monthly(df_partial)
+
+    # Итоги выводятся из полной месячной таблицы: сохранённые месяцы + пересчитанные
+    df_result = df_partial
+    if df_kept is not None and not df_kept.empty:
+        df_result = _recategorize(pd.concat([df_kept, df_partial], ignore_index=True))
+        df_result = df_result.sort_values(analyze.MONTH_KEYS, kind='stable', ignore_index=True)
+    df_total = analyze.build_totals(df_result)
+    tops = analyze.build_tops(df_total, top_n=top_n)
+
+    # Пары по всей истории хранятся в хранилище дельт
+    pairs = duplicates.unique_pairs(snapshot_pairs)
+    df_flags = analyze.format_flags(duplicates.find_name_conflicts(pairs))
+    df_candidates = duplicates.find_near_duplicates(pairs)
+
+    outputs = analyze.collect_outputs(df_partial, df_total, tops, df_flags, df_candidates, df_daily_sales)
+    replace = None
+    if start_month is not None:
+        start_key = start_month.year * 12 + start_month.month
+
+        def is_recomputed(values):
+            return int(values['Год']) * 12 + int(values['Месяц']) >= start_key
+
+        replace = {'итог_по_месяцу': is_recomputed, 'итог_дневные_продажи': is_recomputed}
+    with profiling.span('публикация'):
+        manifest = artifact_store.publish(outputs, replace_partitions=replace)
+    if export_excel:
+        analyze.export_published()
+
+    files = dict(known)
+    for path in file_dates:
+        source_path, sklad_name, layout = sources[path]
+        files[path] = {'sklad': sklad_name, 'layout': warehouses.layout_key(layout),
+                       'signature': _signature(source_path)}
+    save_state({'params': params, 'store_version': manifest['version'], 'files': files}, state_dir)
+    logging.info(f'✅ Месячные итоги обновлены: пересчитано месячных строк {len(df_partial)}')
+
+
+def run_update(**kwargs):
+    """update_monthly с отчётом профилирования запуска (из командной строки и режима наблюдения)."""
+    with profiling.run('инкремент'):
+        update_monthly(**kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Инкрементальное обновление месячного анализа по новым снимкам')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='число процессов для чтения файлов (0 — по числу ядер)')
+    parser.add_argument('--engine', choices=sorted(excel_readers.READERS),
+                        help='движок чтения Excel (по умолчанию — самый быстрый доступный)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='не использовать кэш разобранных снимков, разобрать все файлы заново')
+    parser.add_argument('--transfer-lag', type=int, default=0,
+                        help='допустимая задержка перемещения между складами, дней')
+    parser.add_argument('--transfer-tolerance', type=int, default=0,
+                        help='допустимое расхождение количества отправленного и полученного товара, целых штук')
+    parser.add_argument('--top-n', type=int, default=analyze.TOP_N, help='число строк в каждом топе')
+    parser.add_argument('--excel', action='store_true',
+                        help='кроме Parquet-хранилища выгрузить результаты в прежние xlsx/csv-файлы')
+    args = parser.parse_args()
+    run_update(jobs=args.jobs, engine=args.engine, use_cache=not args.no_cache,
+               transfer_lag_days=args.transfer_lag, transfer_qty_tolerance=args.transfer_tolerance,
+               top_n=args.top_n, export_excel=args.excel)
@@ -0,0 +1,115 @@
+"""
+Кэш разобранных снимков: один Parquet-файл на исходный .xls/.xlsx.
+
+Манифест хранит для каждого файла путь, размер, mtime и sha256 содержимого.
+При несовпадении версии разборщика кэш сбрасывается целиком.
+"""
+import hashlib
+import json
+import logging
+import os
+
+import pandas as pd
+
+CACHE_DIR = os.path.join('кэш', 'снимки')
+MANIFEST_NAME = 'manifest.json'
+
+
+def content_hash(path, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _cache_file_name(path):
+    return hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:20] + '.parquet'
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def load_manifest(parser_version, cache_dir=CACHE_DIR):
+    """Читает манифест; при смене версии разборщика удаляет все закэшированные файлы."""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, MANIFEST_NAME)
+    manifest = None
+    if os.path.exists(path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f'Манифест кэша {path} повреждён, кэш будет пересобран: {e}')
+
+    if manifest is None or manifest.get('parser_version') != parser_version:
+        if manifest is not None:
+            logging.info(f'Версия разборщика изменилась ({manifest.get("parser_version")} → '
+                         f'{parser_version}), кэш снимков сброшен')
+        for name in os.listdir(cache_dir):
+            if name.endswith('.parquet'):
+                _remove_quietly(os.path.join(cache_dir, name))
+        manifest = {'parser_version': parser_version, 'files': {}}
+    return manifest
+
+
+def save_manifest(manifest, cache_dir=CACHE_DIR):
+    """Атомарно сохраняет манифест и удаляет записи о пропавших исходных файлах."""
+    files = manifest['files']
+    for source in [p for p in files if not os.path.exists(p)]:
+        _remove_quietly(os.path.join(cache_dir, files.pop(source)['cache_file']))
+
+    path = os.path.join(cache_dir, MANIFEST_NAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+def lookup(manifest, path, sklad_name, layout_key=None, cache_dir=CACHE_DIR):
+    """
+    Возвращает закэшированный DataFrame для файла или None, если файла нет в кэше,
+    он изменился или разобран в другой раскладке (layout_key).
+    Хэш считается только если изменились размер или mtime.
+    """
+    entry = manifest['files'].get(os.path.abspath(path))
+    if entry is None or entry['sklad'] != sklad_name or entry.get('layout') != layout_key:
+        return None
+    cache_path = os.path.join(cache_dir, entry['cache_file'])
+    if not os.path.exists(cache_path):
+        return None
+
+    stat = os.stat(path)
+    if (stat.st_size, stat.st_mtime_ns) != (entry['size'], entry['mtime_ns']):
+        if stat.st_size != entry['size'] or content_hash(path) != entry['sha256']:
+            return None
+        # Файл перезаписан без изменений (например, скопирован заново) — обновляем mtime
+        entry['mtime_ns'] = stat.st_mtime_ns
+
+    try:
+        return pd.read_parquet(cache_path)
+    except Exception as e:
+        logging.warning(f'Не удалось прочитать кэш {cache_path} для {path}: {e}')
+        return None
+
+
+def store(manifest, path, sklad_name, df, layout_key=None, cache_dir=CACHE_DIR):
+    """Сохраняет разобранный DataFrame файла в кэш и обновляет манифест."""
+    stat = os.stat(path)
+    cache_file = _cache_file_name(path)
+    cache_path = os.path.join(cache_dir, cache_file)
+    tmp_path = cache_path + '.tmp'
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, cache_path)
+    manifest['files'][os.path.abspath(path)] = {
+        'sklad': sklad_name,
+        'layout': layout_key,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': content_hash(path),
+        'cache_file': cache_file,
+    }
@@ -0,0 +1,104 @@
+"""
+Нормализация артикулов и наименований для сопоставления позиций.
+
+Преобразование выполняется векторными операциями .str только над уникальными
+значениями колонки и раскладывается обратно по кодам категорий. Уже посчитанные
+пары «исходное → нормализованное» сохраняются между запусками.
+"""
+import logging
+import os
+
+import pandas as pd
+
+import schema
+
+MEMO_DIR = os.path.join('кэш', 'нормализация')
+# Увеличивать при изменении правил нормализации — сохранённые таблицы будут пересчитаны
+NORMALIZER_VERSION = 1
+
+_memo = {}
+
+
+def _normalize_articles(values):
+    # Удаляем дефисы, пробелы, подчёркивания и приводим к верхнему регистру
+    return values.str.strip().str.replace(r'[- _]', '', regex=True).str.upper()
+
+
+def _normalize_nomenclatures(values):
+    return values.str.lower().str.replace('дефект', '', regex=False).str.strip()
+
+
+NORMALIZERS = {
+    'article': _normalize_articles,
+    'nomenclature': _normalize_nomenclatures,
+}
+
+
+def _memo_path(kind):
+    return os.path.join(MEMO_DIR, f'{kind}_v{NORMALIZER_VERSION}.parquet')
+
+
+def _get_memo(kind):
+    """
+    Таблица kind этого процесса; при первом обращении читается сохранённая. Читается всегда,
+    независимо от persist: иначе последующее сохранение перезаписало бы её одними новыми значениями.
+    """
+    if kind in _memo:
+        return _memo[kind]
+    memo = pd.Series(dtype=object)
+    path = _memo_path(kind)
+    if os.path.exists(path):
+        try:
+            df = pd.read_parquet(path)
+            memo = pd.Series(df['normalized'].to_numpy(dtype=object), index=pd.Index(df['raw'], dtype=object))
+        except Exception as e:
+            logging.warning(f'Не удалось прочитать таблицу нормализации {path}: {e}')
+    _memo[kind] = memo
+    return memo
+
+
+def _save_memo(kind, memo):
+    os.makedirs(MEMO_DIR, exist_ok=True)
+    path = _memo_path(kind)
+    # Временный файл свой у каждого процесса: шарды могут нормализовать значения параллельно
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    pd.DataFrame({'raw': memo.index.to_numpy(), 'normalized': memo.to_numpy()}).to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def normalize_uniques(uniques, kind, persist=True):
+    """
+    Нормализует уникальные значения (pd.Index). Нестроковые значения возвращаются
+    без изменений. Новые строки считаются векторно и дописываются в таблицу kind;
+    persist=False — не сохранять её на диск (сохранённая таблица при этом читается).
+    """
+    uniques = pd.Index(uniques, dtype=object)
+    is_str = uniques.map(lambda v: isinstance(v, str)).to_numpy(dtype=bool)
+    strings = uniques[is_str]
+
+    memo = _get_memo(kind)
+    new = strings[~strings.isin(memo.index)]
+    if len(new):
+        computed = NORMALIZERS[kind](pd.Series(new, dtype=object))
+        memo = pd.concat([memo, pd.Series(computed.to_numpy(dtype=object), index=new)])
+        _memo[kind] = memo
+        if persist:
+            try:
+                _save_memo(kind, memo)
+            except Exception as e:
+                logging.warning(f'Не удалось сохранить таблицу нормализации {kind}: {e}')
+        logging.info(f'Нормализация {kind}: {len(new)} новых значений, всего в таблице {len(memo)}')
+
+    result = uniques.to_numpy(dtype=object).copy()
+    result[is_str] = memo.reindex(strings).to_numpy(dtype=object)
+    return result
+
+
+def normalize_articles(series, persist=True):
+    """Нормализованный артикул (категориальная колонка той же длины)."""
+    return schema.map_categories(series, lambda uniques: normalize_uniques(uniques, 'article', persist))
+
+
+def normalize_nomenclatures(series, persist=True):
+    """Нормализованное наименование (категориальная колонка той же длины)."""
+    return schema.map_categories(series, lambda uniques: normalize_uniques(uniques, 'nomenclature', persist))
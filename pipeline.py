@@ -0,0 +1,310 @@
+"""
+Анализ склада как граф этапов с сохранёнными промежуточными результатами.
+
+Каждый этап объявляет зависимости, параметры и выходные таблицы. Отпечаток этапа —
+хэш его параметров, версии конвейера и отпечатков зависимостей (у этапа загрузки —
+размеры и mtime исходных файлов). Если отпечаток совпадает с сохранённым, этап
+не выполняется, а его результаты при необходимости читаются из кэш/этапы/.
+Так, смена числа строк в топах пересчитывает только топы и публикацию.
+
+Запуск:
+    python pipeline.py                    # все устаревшие этапы вплоть до публикации
+    python pipeline.py --top-n 500        # пересчитаются только топы и публикация
+    python pipeline.py --stage итоги      # только этап итогов и его устаревшие зависимости
+    python pipeline.py --force месяцы     # пересчитать этап, даже если он актуален
+    python pipeline.py --list             # состояние этапов
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import pandas as pd
+
+import analyze
+import artifact_store
+import delta_store
+import duplicates
+import excel_readers
+import normalization
+import profiling
+import transfers
+import warehouses
+
+CHECKPOINT_DIR = os.path.join('кэш', 'этапы')
+STATE_NAME = 'state.json'
+# Увеличивать при изменении логики этапов: все сохранённые результаты станут устаревшими
+PIPELINE_VERSION = 2
+
+DEFAULT_PARAMS = {
+    'jobs': 1,
+    'engine': None,
+    'use_cache': True,
+    'transfer_lag_days': 0,
+    'transfer_qty_tolerance': 0,
+    'top_n': analyze.TOP_N,
+    'export_excel': False,
+}
+
+
+# --- Этапы: получают словарь входных таблиц и параметры, возвращают словарь выходных ---
+
+def _stage_snapshots(inputs, params):
+    # Снимки хранятся дельтами (как в analyze.py): читаются только новые файлы
+    store = analyze.load_deltas(jobs=params['jobs'], engine=params['engine'], use_cache=params['use_cache'])
+    if store is None:
+        raise RuntimeError('Нет данных для анализа')
+    deltas, calendar, snapshot_pairs = store
+    return {'deltas': deltas, 'calendar': calendar, 'snapshot_pairs': snapshot_pairs}
+
+
+def _stage_daily(inputs, params):
+    df_daily = delta_store.daily_diffs(inputs['deltas'], inputs['calendar'])
+    df_daily, df_moves = transfers.reconcile_transfers(
+        df_daily, max_lag_days=params['transfer_lag_days'], qty_tolerance=params['transfer_qty_tolerance']
+    )
+    return {'df_daily': df_daily, 'df_moves': df_moves}
+
+
+def _stage_monthly(inputs, params):
+    return {'df_result': analyze.finalize_monthly(analyze.aggregate_monthly(inputs['df_daily']))}
+
+
+def _stage_pairs(inputs, params):
+    return {'pairs': duplicates.unique_pairs(inputs['snapshot_pairs'])}
+
+
+def _stage_flags(inputs, params):
+    return {'df_flags': analyze.format_flags(duplicates.find_name_conflicts(inputs['pairs']))}
+
+
+def _stage_duplicates(inputs, params):
+    df_candidates = duplicates.find_near_duplicates(inputs['pairs'])
+    logging.info(f"🔎 Кандидатов в дубли артикулов/наименований: {len(df_candidates)}")
+    return {'df_candidates': df_candidates}
+
+
+def _stage_totals(inputs, params):
+    return {'df_total': analyze.build_totals(inputs['df_result'])}
+
+
+def _stage_tops(inputs, params):
+    return analyze.build_tops(inputs['df_total'], top_n=params['top_n'])
+
+
+def _stage_daily_sales(inputs, params):
+    return {'df_daily_sales': delta_store.daily_sales(inputs['deltas'], inputs['calendar'])}
+
+
+def _stage_publish(inputs, params):
+    tops = {name: inputs[name] for name in ('самые_ходовые', 'залежалые', 'чаще_всего_пополнялись')}
+    df_daily_sales = inputs['df_daily_sales'] if not inputs['df_daily_sales'].empty else None
+    outputs = analyze.collect_outputs(inputs['df_result'], inputs['df_total'], tops, inputs['df_flags'],
+                                      inputs['df_candidates'], df_daily_sales)
+    manifest = analyze.publish_outputs(outputs, export_excel=params['export_excel'])
+    return {'version': manifest['version']}
+
+
+def _published_version_is_current(state):
+    manifest = artifact_store.load_manifest()
+    return manifest is not None and manifest['version'] == state.get('outputs', {}).get('version')
+
+
+# Порядок словаря — топологический: зависимости объявлены раньше зависящих этапов.
+# params — параметры, меняющие результат этапа (jobs и engine на результат не влияют).
+STAGES = {
+    'снимки': {'deps': [], 'params': [], 'outputs': ['deltas', 'calendar', 'snapshot_pairs'],
+               'run': _stage_snapshots},
+    'дневные': {'deps': ['снимки'], 'params': ['transfer_lag_days', 'transfer_qty_tolerance'],
+                'outputs': ['df_daily', 'df_moves'], 'run': _stage_daily},
+    'месяцы': {'deps': ['дневные'], 'params': [], 'outputs': ['df_result'], 'run': _stage_monthly},
+    'пары': {'deps': ['снимки'], 'params': [], 'outputs': ['pairs'], 'run': _stage_pairs},
+    'подмены': {'deps': ['пары'], 'params': [], 'outputs': ['df_flags'], 'run': _stage_flags},
+    'дубли': {'deps': ['пары'], 'params': [], 'outputs': ['df_candidates'], 'run': _stage_duplicates},
+    'итоги': {'deps': ['месяцы'], 'params': [], 'outputs': ['df_total'], 'run': _stage_totals},
+    'топы': {'deps': ['итоги'], 'params': ['top_n'],
+             'outputs': ['самые_ходовые', 'залежалые', 'чаще_всего_пополнялись'], 'run': _stage_tops},
+    'дневные_продажи': {'deps': ['снимки'], 'params': [], 'outputs': ['df_daily_sales'],
+                        'run': _stage_daily_sales},
+    'публикация': {'deps': ['месяцы', 'итоги', 'топы', 'подмены', 'дубли', 'дневные_продажи'],
+                   'params': ['export_excel'], 'outputs': [], 'run': _stage_publish,
+                   'is_current': _published_version_is_current},
+}
+
+
+# --- Отпечатки и сохранённое состояние ---
+
+def _hash(data):
+    return hashlib.sha256(json.dumps(data, ensure_ascii=False, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def sources_fingerprint(registry=None):
+    """Отпечаток исходных снимков: склады, раскладки, пути, размеры и mtime всех файлов."""
+    files = []
+    for path, sklad_name, layout in analyze.snapshot_tasks(registry):
+        stat = os.stat(path)
+        files.append([sklad_name, warehouses.layout_key(layout), os.path.abspath(path),
+                      stat.st_size, stat.st_mtime_ns])
+    return _hash([analyze.PARSER_VERSION, normalization.NORMALIZER_VERSION, files])
+
+
+def compute_fingerprints(params):
+    fingerprints = {}
+    for name, spec in STAGES.items():
+        data = {
+            'stage': name,
+            'version': PIPELINE_VERSION,
+            'params': {p: params[p] for p in spec['params']},
+            'deps': [fingerprints[d] for d in spec['deps']],
+        }
+        if not spec['deps']:
+            data['sources'] = sources_fingerprint()
+        fingerprints[name] = _hash(data)
+    return fingerprints
+
+
+def load_state(checkpoint_dir=CHECKPOINT_DIR):
+    try:
+        with open(os.path.join(checkpoint_dir, STATE_NAME), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.warning(f'Состояние этапов повреждено, все этапы будут пересчитаны: {e}')
+        return {}
+
+
+def save_state(state, checkpoint_dir=CHECKPOINT_DIR):
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    path = os.path.join(checkpoint_dir, STATE_NAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+def _output_path(stage, output, checkpoint_dir):
+    return os.path.join(checkpoint_dir, stage, f'{output}.parquet')
+
+
+def save_checkpoint(stage, outputs, checkpoint_dir=CHECKPOINT_DIR):
+    stage_dir = os.path.join(checkpoint_dir, stage)
+    tmp_dir = stage_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for output in STAGES[stage]['outputs']:
+        outputs[output].to_parquet(os.path.join(tmp_dir, f'{output}.parquet'), index=False)
+    shutil.rmtree(stage_dir, ignore_errors=True)
+    os.replace(tmp_dir, stage_dir)
+
+
+def load_checkpoint(stage, checkpoint_dir=CHECKPOINT_DIR):
+    return {output: pd.read_parquet(_output_path(stage, output, checkpoint_dir))
+            for output in STAGES[stage]['outputs']}
+
+
+def _is_current(stage, fingerprint, state, checkpoint_dir):
+    entry = state.get(stage)
+    if entry is None or entry.get('fingerprint') != fingerprint:
+        return False
+    if not all(os.path.exists(_output_path(stage, o, checkpoint_dir)) for o in STAGES[stage]['outputs']):
+        return False
+    is_current = STAGES[stage].get('is_current')
+    return is_current is None or is_current(entry)
+
+
+def _required_stages(targets):
+    """Цели и все их зависимости в топологическом порядке."""
+    needed = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(STAGES[name]['deps'])
+    return [name for name in STAGES if name in needed]
+
+
+def plan(targets, params, force=(), checkpoint_dir=CHECKPOINT_DIR):
+    """Список (этап, отпечаток, устарел ли) для целей и их зависимостей."""
+    fingerprints = compute_fingerprints(params)
+    state = load_state(checkpoint_dir)
+    return [
+        (name, fingerprints[name],
+         name in force or not _is_current(name, fingerprints[name], state, checkpoint_dir))
+        for name in _required_stages(targets)
+    ]
+
+
+def run(targets=('публикация',), force=(), checkpoint_dir=CHECKPOINT_DIR, **params):
+    """
+    Выполняет устаревшие этапы, нужные для targets. Результаты актуальных этапов
+    читаются с диска только тогда, когда они нужны устаревшему этапу.
+    Возвращает список выполненных этапов.
+    """
+    params = {**DEFAULT_PARAMS, **params}
+    steps = plan(targets, params, force, checkpoint_dir)
+    stale = {name for name, _, is_stale in steps if is_stale}
+    state = load_state(checkpoint_dir)
+    results = {}
+
+    def inputs_of(stage):
+        inputs = {}
+        for dep in STAGES[stage]['deps']:
+            if dep not in results:
+                results[dep] = load_checkpoint(dep, checkpoint_dir)
+            inputs.update(results[dep])
+        return inputs
+
+    executed = []
+    with profiling.run('конвейер'):
+        for name, fingerprint, is_stale in steps:
+            if not is_stale:
+                logging.info(f'⏭ Этап «{name}» актуален, пропущен')
+                continue
+            logging.info(f'▶ Этап «{name}»')
+            with profiling.span(f'этап:{name}'):
+                outputs = STAGES[name]['run'](inputs_of(name), params)
+                save_checkpoint(name, outputs, checkpoint_dir)
+            results[name] = {o: outputs[o] for o in STAGES[name]['outputs']}
+            state[name] = {'fingerprint': fingerprint,
+                           'outputs': {k: v for k, v in outputs.items() if not isinstance(v, pd.DataFrame)}}
+            save_state(state, checkpoint_dir)
+            executed.append(name)
+    if not stale:
+        logging.info('✅ Все этапы актуальны')
+    return executed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Анализ складских остатков по этапам с промежуточными результатами')
+    parser.add_argument('--stage', nargs='+', choices=list(STAGES), default=['публикация'],
+                        help='этапы-цели (по умолчанию — публикация, то есть весь анализ)')
+    parser.add_argument('--force', nargs='+', choices=list(STAGES), default=[],
+                        help='пересчитать указанные этапы, даже если они актуальны')
+    parser.add_argument('--list', action='store_true', help='показать этапы и их состояние, ничего не выполняя')
+    parser.add_argument('--top-n', type=int, default=analyze.TOP_N, help='число строк в каждом топе')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='число процессов для чтения файлов (0 — по числу ядер)')
+    parser.add_argument('--engine', choices=sorted(excel_readers.READERS),
+                        help='движок чтения Excel (по умолчанию — самый быстрый доступный)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='не использовать кэш разобранных снимков, разобрать все файлы заново')
+    parser.add_argument('--transfer-lag', type=int, default=0,
+                        help='допустимая задержка перемещения между складами, дней')
+    parser.add_argument('--transfer-tolerance', type=int, default=0,
+                        help='допустимое расхождение количества отправленного и полученного товара, целых штук')
+    parser.add_argument('--excel', action='store_true',
+                        help='кроме Parquet-хранилища выгрузить результаты в прежние xlsx/csv-файлы')
+    args = parser.parse_args()
+
+    run_params = dict(jobs=args.jobs, engine=args.engine, use_cache=not args.no_cache,
+                      transfer_lag_days=args.transfer_lag, transfer_qty_tolerance=args.transfer_tolerance,
+                      top_n=args.top_n, export_excel=args.excel)
+    if args.list:
+        for name, fingerprint, is_stale in plan(args.stage, {**DEFAULT_PARAMS, **run_params}, args.force):
+            print(f'{name:<16} {"устарел" if is_stale else "актуален":<9} {fingerprint[:12]}')
+    else:
+        run(targets=args.stage, force=args.force, **run_params)
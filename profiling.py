@@ -0,0 +1,181 @@
+"""
+Лёгкое профилирование запуска анализа: вложенные интервалы (запуск → этап → файл)
+с временем по часам и CPU, числом строк на входе/выходе и пиковой памятью процесса.
+Пик памяти — наибольший размер процесса с его запуска: у интервала записываются и он
+(process_peak_rss_mb), и его рост за интервал (peak_rss_growth_mb) — сколько памяти
+сверх прежнего пика понадобилось этапу. В Windows (нет модуля resource) память не пишется.
+
+Интервалы пишутся только внутри profiling.run(...); в конце запуска сохраняется
+один JSON-профиль в формате Chrome trace (открывается в chrome://tracing или Perfetto).
+Частые мелкие вызовы (@counted) не порождают событий, а суммируются в агрегаты.
+"""
+import functools
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows: пиковая память процесса недоступна
+    resource = None
+
+PROFILE_DIR = 'логи'
+
+_run = None
+_aggregates = {}
+_in_worker = False
+
+
+def _is_frame(obj):
+    return hasattr(obj, 'columns') and hasattr(obj, '__len__')
+
+
+def peak_rss_mb():
+    """Пиковая память процесса с его запуска, МБ; None, если платформа её не сообщает."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss в macOS — в байтах, в Linux — в килобайтах
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def add_event(name, ts, wall, cpu, args=None, pid=None):
+    """Добавляет готовый интервал (ts — время начала в секундах эпохи, wall/cpu — секунды)."""
+    if _run is None:
+        return
+    event_args = {'cpu_ms': round(cpu * 1000, 3)}
+    event_args.update({k: v for k, v in (args or {}).items() if v is not None})
+    _run['events'].append({
+        'name': name,
+        'ph': 'X',
+        'ts': int(ts * 1_000_000),
+        'dur': int(wall * 1_000_000),
+        'pid': _run['pid'],
+        'tid': pid or _run['pid'],
+        'args': event_args,
+    })
+
+
+@contextmanager
+def span(name, rows_in=None, **args):
+    """
+    Интервал профиля. Внутри можно дописать в словарь-результат rows_out и другие поля:
+        with profiling.span('экспорт') as info: ...; info['rows_out'] = len(df)
+    """
+    info = {'rows_in': rows_in, **args}
+    if _run is None:
+        yield info
+        return
+    ts, wall, cpu = time.time(), time.perf_counter(), time.process_time()
+    peak_before = peak_rss_mb()
+    try:
+        yield info
+    finally:
+        peak = peak_rss_mb()
+        if peak is not None:
+            info['process_peak_rss_mb'] = round(peak, 1)
+            info['peak_rss_growth_mb'] = round(peak - peak_before, 1)
+        add_event(name, ts, time.perf_counter() - wall, time.process_time() - cpu, info)
+
+
+def traced(func=None, *, name=None):
+    """Декоратор этапа: интервал со строками первого DataFrame-аргумента и результата."""
+    def decorate(f):
+        label = name or f.__name__
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if _run is None:
+                return f(*args, **kwargs)
+            rows_in = next((len(a) for a in args if _is_frame(a)), None)
+            with span(label, rows_in=rows_in) as info:
+                result = f(*args, **kwargs)
+                out = result[0] if isinstance(result, tuple) and result else result
+                if _is_frame(out):
+                    info['rows_out'] = len(out)
+            return result
+        return wrapper
+
+    return decorate(func) if func is not None else decorate
+
+
+def counted(func):
+    """Декоратор для частых вызовов: только счётчик и суммарное время, без событий."""
+    label = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stats = _aggregates.setdefault(label, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += time.perf_counter() - wall
+            stats[2] += time.process_time() - cpu
+    return wrapper
+
+
+def init_worker():
+    """Инициализатор процесса пула: агрегаты копии родителя не должны учитываться дважды."""
+    global _run, _in_worker
+    _run = None
+    _in_worker = True
+    _aggregates.clear()
+
+
+def take_worker_aggregates():
+    """В процессе пула возвращает и обнуляет накопленные агрегаты; в основном процессе — None."""
+    if not _in_worker:
+        return None
+    snapshot = {k: list(v) for k, v in _aggregates.items()}
+    _aggregates.clear()
+    return snapshot
+
+
+def merge_aggregates(aggregates):
+    for label, (count, wall, cpu) in (aggregates or {}).items():
+        stats = _aggregates.setdefault(label, [0, 0.0, 0.0])
+        stats[0] += count
+        stats[1] += wall
+        stats[2] += cpu
+
+
+@contextmanager
+def run(name):
+    """Профилируемый запуск: по выходу пишет логи/профиль_<name>_<время>.json."""
+    global _run
+    _aggregates.clear()
+    _run = {'events': [], 'pid': os.getpid()}
+    started = datetime.now()
+    try:
+        with span(name):
+            yield
+    finally:
+        events, _run = _run['events'], None
+        path = _write_profile(name, started, events)
+        total = next((e['dur'] for e in events if e['name'] == name), 0) / 1_000_000
+        peak = peak_rss_mb()
+        memory = f', пик памяти {peak:.0f} МБ' if peak is not None else ''
+        logging.info(f'⏱ {name}: {total:.2f} с{memory}, профиль: {path}')
+
+
+def _write_profile(name, started, events):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f'профиль_{name}_{started:%Y%m%d_%H%M%S}.json')
+    aggregates = {
+        label: {'calls': count, 'wall_ms': round(wall * 1000, 3), 'cpu_ms': round(cpu * 1000, 3)}
+        for label, (count, wall, cpu) in sorted(_aggregates.items())
+    }
+    profile = {
+        'traceEvents': sorted(events, key=lambda e: e['ts']),
+        'displayTimeUnit': 'ms',
+        'otherData': {'run': name, 'started': started.isoformat(), 'aggregates': aggregates},
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(profile, f, ensure_ascii=False)
+    return path
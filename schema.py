@@ -0,0 +1,57 @@
+"""
+Компактные типы колонок для всего конвейера анализа.
+
+Ключевые текстовые колонки хранятся как категории с общим словарём, числовые —
+в наименьшем типе без потери точности. Все groupby по категориальным колонкам
+должны выполняться с observed=True, иначе pandas строит декартово произведение категорий.
+"""
+import numpy as np
+import pandas as pd
+
+CATEGORY_COLUMNS = ['Артикул', 'Склад', 'Номенклатура', 'Производитель']
+NUMERIC_COLUMNS = ['Количество', 'Цена']
+
+
+def downcast_numeric(series):
+    """Целочисленные значения — в минимальный целый тип, прочие — в float32, если это без потерь."""
+    series = pd.to_numeric(series, errors='coerce')
+    values = series.to_numpy(dtype='float64', na_value=np.nan)
+    if series.notna().all() and np.array_equal(values, np.round(values)):
+        return pd.to_numeric(series.astype('int64'), downcast='integer')
+    as_float32 = values.astype('float32')
+    if np.array_equal(as_float32.astype('float64'), values, equal_nan=True):
+        return pd.Series(as_float32, index=series.index, name=series.name)
+    return series.astype('float64')
+
+
+def map_categories(series, func):
+    """
+    Преобразует значения колонки через словарь: func получает pd.Index уникальных
+    значений (категорий) и возвращает массив той же длины. Совпавшие после
+    преобразования значения сливаются в одну категорию; словарь результата
+    отсортирован, как у astype('category').
+    """
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.astype('category')
+    mapped = np.asarray(func(series.cat.categories), dtype=object)
+    new_codes, new_categories = pd.factorize(mapped, sort=True)
+    codes = series.cat.codes.to_numpy()
+    result_codes = np.where(codes >= 0, new_codes[codes], -1)
+    return pd.Series(
+        pd.Categorical.from_codes(result_codes, categories=new_categories),
+        index=series.index, name=series.name
+    )
+
+
+def apply_schema(df):
+    """Приводит объединённые снимки к компактным типам (один словарь категорий на колонку)."""
+    df = df.copy()
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    for col in NUMERIC_COLUMNS:
+        if col in df.columns:
+            df[col] = downcast_numeric(df[col])
+    if 'Дата' in df.columns:
+        df['Дата'] = pd.to_datetime(df['Дата'], errors='coerce')
+    return df
@@ -0,0 +1,195 @@
+"""
+Анализ по частям (шардам) для истории, не помещающейся в память целиком.
+
+Вся логика по товару — изменение остатка, перемещения между складами, месячные
+показатели и итоги по (Артикул, Склад) — не выходит за пределы одного артикула.
+Поэтому строки снимков раскладываются на диск по хэшу нормализованного артикула,
+а затем каждый шард обрабатывается отдельно (последовательно или в пуле процессов)
+и пишет свои результаты на диск. В памяти одновременно находятся только пачка
+читаемых файлов и один шард на процесс.
+
+Глобальными остаются только небольшие таблицы: итоги для топов и уникальные пары
+(артикул, наименование) для поиска подмен и дублей — они собираются из всех шардов.
+
+Запуск: python sharded.py --shards 16 [--jobs 2] [--excel] ...
+"""
+import argparse
+import glob
+import logging
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import analyze
+import artifact_store
+import delta_store
+import duplicates
+import excel_readers
+import normalization
+import profiling
+import transfers
+
+SHARD_DIR = os.path.join('кэш', 'шарды')
+FILES_PER_BATCH = 32
+
+
+def shard_of(articles, n_shards):
+    """Номер шарда для каждой строки по стабильному хэшу нормализованного артикула."""
+    articles = normalization.normalize_articles(articles)
+    shard_by_category = pd.util.hash_array(articles.cat.categories.to_numpy(dtype=object)) % n_shards
+    codes = articles.cat.codes.to_numpy()
+    return shard_by_category[codes], articles
+
+
+def _shard_path(shard_dir, kind, shard):
+    return os.path.join(shard_dir, kind, f'{shard:04d}')
+
+
+@profiling.traced
+def spool_shards(tasks, n_shards, shard_dir=SHARD_DIR, jobs=1, engine=None, use_cache=True):
+    """Читает снимки пачками и раскладывает строки по шардам на диск. Возвращает число строк."""
+    rows = 0
+    for batch_no, start in enumerate(range(0, len(tasks), FILES_PER_BATCH)):
+        dfs, _ = analyze.ingest_files(tasks[start:start + FILES_PER_BATCH], jobs=jobs,
+                                      engine=engine, use_cache=use_cache)
+        if not dfs:
+            continue
+        df = pd.concat(dfs, ignore_index=True)
+        df = df[df['Артикул'].notna()]
+        shards, articles = shard_of(df['Артикул'], n_shards)
+        df = df.assign(Артикул=articles.astype(str).to_numpy())
+        for shard, part in df.groupby(shards, sort=False):
+            path = _shard_path(shard_dir, 'вход', shard)
+            os.makedirs(path, exist_ok=True)
+            part.to_parquet(os.path.join(path, f'{batch_no:06d}.parquet'), index=False)
+        rows += len(df)
+    return rows
+
+
+def _read_parts(path):
+    # Части читаются по одной: типы колонок в разных пачках могут различаться
+    files = sorted(glob.glob(os.path.join(path, '*.parquet')))
+    return pd.concat([pd.read_parquet(f) for f in files], ignore_index=True) if files else None
+
+
+def _process_shard(task):
+    """Обрабатывает один шард и пишет его результаты на диск. Запускается и в пуле процессов."""
+    shard, shard_dir, transfer_lag_days, transfer_qty_tolerance = task
+    df_all = _read_parts(_shard_path(shard_dir, 'вход', shard))
+    if df_all is None:
+        return shard, 0
+    df_all = analyze.prepare_snapshots(df_all)
+
+    # Дельты шарда в памяти: дневные и месячные показатели — те же функции, что в analyze.py
+    calendar = delta_store.build_calendar(df_all)
+    deltas = delta_store.encode(delta_store.daily_values(df_all), calendar)
+    df_daily = delta_store.daily_diffs(deltas, calendar)
+    df_daily, _ = transfers.reconcile_transfers(
+        df_daily, max_lag_days=transfer_lag_days, qty_tolerance=transfer_qty_tolerance
+    )
+    df_result = analyze.finalize_monthly(analyze.aggregate_monthly(df_daily))
+    del df_daily
+
+    outputs = {
+        'итог_по_месяцу': df_result,
+        'итоги': analyze.build_totals(df_result),
+        'пары': duplicates.unique_pairs(df_all),
+        'итог_дневные_продажи': delta_store.daily_sales(deltas, calendar),
+    }
+    path = _shard_path(shard_dir, 'выход', shard)
+    os.makedirs(path, exist_ok=True)
+    for name, df in outputs.items():
+        if df is not None:
+            df.to_parquet(os.path.join(path, f'{name}.parquet'), index=False)
+    return shard, len(df_all)
+
+
+@profiling.traced
+def process_shards(n_shards, shard_dir=SHARD_DIR, jobs=1, transfer_lag_days=0, transfer_qty_tolerance=0):
+    tasks = [(shard, shard_dir, transfer_lag_days, transfer_qty_tolerance) for shard in range(n_shards)]
+    if not jobs or jobs < 1:
+        jobs = os.cpu_count() or 1
+    if jobs == 1:
+        results = [_process_shard(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=profiling.init_worker) as executor:
+            results = list(executor.map(_process_shard, tasks))
+    return sum(rows for _, rows in results)
+
+
+def _shard_outputs(shard_dir, name):
+    """Результаты шардов по одному — для потоковой публикации."""
+    for path in sorted(glob.glob(os.path.join(shard_dir, 'выход', '*', f'{name}.parquet'))):
+        yield pd.read_parquet(path)
+
+
+def _concat_shards(shard_dir, name):
+    parts = list(_shard_outputs(shard_dir, name))
+    if not parts:
+        return None
+    df = pd.concat(parts, ignore_index=True)
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].astype('category')
+    return df
+
+
+@profiling.traced
+def run_sharded(n_shards=16, jobs=1, engine=None, use_cache=True, transfer_lag_days=0, transfer_qty_tolerance=0,
+                top_n=analyze.TOP_N, export_excel=False, shard_dir=SHARD_DIR):
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    rows = spool_shards(analyze.snapshot_tasks(), n_shards, shard_dir, jobs=jobs, engine=engine, use_cache=use_cache)
+    if not rows:
+        logging.error("❌ Нет данных для анализа")
+        return
+    logging.info(f'🧩 Строк снимков: {rows}, шардов: {n_shards}')
+
+    process_shards(n_shards, shard_dir, jobs=jobs, transfer_lag_days=transfer_lag_days,
+                   transfer_qty_tolerance=transfer_qty_tolerance)
+
+    # Итоги и пары невелики и нужны целиком: топы и поиск подмен/дублей — по всем артикулам
+    df_total = _concat_shards(shard_dir, 'итоги').sort_values(['Артикул', 'Склад'], ignore_index=True)
+    tops = analyze.build_tops(df_total, top_n=top_n)
+    pairs = _concat_shards(shard_dir, 'пары')
+    df_flags = analyze.format_flags(duplicates.find_name_conflicts(pairs))
+    df_candidates = duplicates.find_near_duplicates(pairs)
+    logging.info(f"🔎 Кандидатов в дубли артикулов/наименований: {len(df_candidates)}")
+
+    outputs = analyze.collect_outputs(_shard_outputs(shard_dir, 'итог_по_месяцу'), df_total, tops,
+                                      df_flags, df_candidates, None)
+    outputs['итоги'] = (df_total, None, ['Артикул', 'Склад'])
+    outputs['итог_дневные_продажи'] = (
+        (analyze.with_month_columns(df) for df in _shard_outputs(shard_dir, 'итог_дневные_продажи')),
+        ['Склад', 'Год', 'Месяц'], ['Дата', 'Склад', 'Артикул'],
+    )
+    with profiling.span('публикация'):
+        artifact_store.publish(outputs)
+    if export_excel:
+        analyze.export_published()
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    logging.info("✅ Анализ по шардам завершен")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Анализ складских остатков по шардам артикулов с ограниченной памятью')
+    parser.add_argument('--shards', type=int, default=16, help='число шардов')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='число процессов для чтения файлов и обработки шардов (0 — по числу ядер)')
+    parser.add_argument('--engine', choices=sorted(excel_readers.READERS),
+                        help='движок чтения Excel (по умолчанию — самый быстрый доступный)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='не использовать кэш разобранных снимков, разобрать все файлы заново')
+    parser.add_argument('--transfer-lag', type=int, default=0,
+                        help='допустимая задержка перемещения между складами, дней')
+    parser.add_argument('--transfer-tolerance', type=int, default=0,
+                        help='допустимое расхождение количества отправленного и полученного товара, целых штук')
+    parser.add_argument('--top-n', type=int, default=analyze.TOP_N, help='число строк в каждом топе')
+    parser.add_argument('--excel', action='store_true',
+                        help='кроме Parquet-хранилища выгрузить результаты в прежние xlsx/csv-файлы')
+    args = parser.parse_args()
+    with profiling.run('анализ_по_шардам'):
+        run_sharded(n_shards=args.shards, jobs=args.jobs, engine=args.engine, use_cache=not args.no_cache,
+                    transfer_lag_days=args.transfer_lag, transfer_qty_tolerance=args.transfer_tolerance,
+                    top_n=args.top_n, export_excel=args.excel)
@@ -0,0 +1,123 @@
+"""
+Таблицы дашборда, общие для всех процессов gunicorn: Arrow IPC-файлы, открываемые через mmap.
+
+Таблица один раз сохраняется в кэш/arrow/<имя>-<ключ>.arrow, после чего каждый процесс
+открывает файл через memory_map без копирования: числа, даты и строки DataFrame указывают
+прямо в отображённый файл, и страницы лежат в кэше ОС один раз на все процессы.
+С gunicorn --preload таблицы открываются в главном процессе до fork и наследуются
+рабочими; без --preload первый процесс строит файл, остальные ждут его и открывают тот же.
+
+Чтобы данные не копировались при открытии:
+- строки хранятся как large_string и открываются как string[pyarrow];
+- NaN в дробных колонках остаётся значением, а не null (иначе pyarrow заполнял бы пропуски копией);
+- даты хранятся как int64, пропуск — NaT (минимальное int64), по той же причине.
+Колонки открытой таблицы только для чтения: изменения — через присваивание новой колонки.
+
+Ключ — версия исходных данных (например, версия хранилища результатов): при смене ключа
+таблица строится заново, файлы прежних ключей удаляются.
+"""
+import glob
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+try:
+    import fcntl
+except ImportError:  # Windows: без блокировки процессы могут построить файл дважды, это безопасно
+    fcntl = None
+
+FRAME_DIR = os.path.join('кэш', 'arrow')
+
+
+def _column_array(series):
+    """Колонка DataFrame в массив Arrow, который потом открывается без копирования."""
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        series = series.astype(dtype.categories.dtype)
+        dtype = series.dtype
+    if dtype == object or isinstance(dtype, pd.StringDtype):
+        try:
+            return pa.array(series, type=pa.large_string(), from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass
+        try:
+            # Не строки (например, флаги True/False с пропусками): тип выводит Arrow
+            return pa.array(series, from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # Смешанные значения (например, артикулы-числа из Excel) хранятся строками
+            return pa.array([None if pd.isna(v) else str(v) for v in series], type=pa.large_string())
+    if dtype.kind == 'f':
+        return pa.array(series.to_numpy(), from_pandas=False)
+    if dtype.kind == 'M' and getattr(dtype, 'tz', None) is None:
+        return pa.array(series.to_numpy().view(np.int64)).view(pa.timestamp(np.datetime_data(dtype)[0]))
+    return pa.array(series, from_pandas=True)
+
+
+def _string_dtype(arrow_type):
+    return pd.StringDtype('pyarrow') if pa.types.is_large_string(arrow_type) else None
+
+
+def _frame_path(name, key, frame_dir):
+    return os.path.join(frame_dir, f'{name}-{key}.arrow')
+
+
+def save_frame(df, path):
+    """Пишет DataFrame в Arrow IPC-файл одним пакетом; файл появляется атомарно."""
+    table = pa.Table.from_arrays([_column_array(df[col]) for col in df.columns],
+                                 names=[str(col) for col in df.columns])
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+def open_frame(path):
+    """DataFrame поверх отображённого в память файла или None, если файла нет или он повреждён."""
+    try:
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    except FileNotFoundError:
+        return None
+    except (OSError, pa.ArrowInvalid) as e:
+        logging.warning(f'Не удалось открыть {path}: {e}')
+        return None
+    return table.to_pandas(split_blocks=True, types_mapper=_string_dtype)
+
+
+def _prune(name, key, frame_dir):
+    # Открытые другими процессами файлы остаются доступны им до закрытия (POSIX)
+    for path in glob.glob(os.path.join(glob.escape(frame_dir), f'{glob.escape(name)}-*.arrow')):
+        if path != _frame_path(name, key, frame_dir):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def shared_frame(name, key, build, frame_dir=FRAME_DIR):
+    """
+    Таблица name для версии данных key: открывается из файла через mmap, а если файла нет —
+    строится функцией build(), сохраняется и открывается. Построение под файловой блокировкой,
+    поэтому одновременно стартующие процессы строят таблицу один раз.
+    """
+    started = time.perf_counter()
+    path = _frame_path(name, key, frame_dir)
+    df = open_frame(path)
+    if df is not None:
+        logging.info(f'📂 Таблица {name} открыта из {path} за {time.perf_counter() - started:.3f} с')
+        return df
+
+    os.makedirs(frame_dir, exist_ok=True)
+    with open(os.path.join(frame_dir, f'{name}.lock'), 'w') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        df = open_frame(path)
+        if df is None:
+            save_frame(build(), path)
+            _prune(name, key, frame_dir)
+            df = open_frame(path)
+            logging.info(f'🛠 Таблица {name} построена и сохранена в {path} за {time.perf_counter() - started:.2f} с')
+    return df
@@ -1,23 +1,120 @@
+"""
+Поиск всплесков продаж по месячному итогу анализа.
+
+Всплеск — месяц, в котором продажи товара на складе выше среднего за предыдущие
+window месяцев, умноженного на коэффициент. Средние считаются сразу для всех рядов
+(Артикул, Склад) по накопленным суммам в порядке рядов, без Python-кода на каждый ряд,
+и сразу для сетки окон и коэффициентов: каждый вариант — строки с колонками Окно и Коэффициент
+в одной общей таблице. Вместо правила «среднее × коэффициент» можно выбрать устойчивый
+детектор из spike_detectors (медиана/MAD, EWMA, сезонный).
+
+Запуск: python spike_analysis.py [--method mean|mad|ewma|seasonal] [--windows 3 6] [--factors 1.5 2]
+"""
+import argparse
+
+import numpy as np
 import pandas as pd
 
-def load_monthly_data(filepath='итог_по_месяцу.xlsx'):
-    df = pd.read_excel(filepath)
+import artifact_store
+import spike_detectors
+
+SERIES_KEYS = ['Артикул', 'Склад']
+
+
+def prepare_monthly_data(df):
+    """Месячный итог с колонкой Дата (первое число месяца), упорядоченный по рядам и датам."""
+    df = df.copy()
     df['Дата'] = pd.to_datetime(df['Год'].astype(str) + '-' + df['Месяц'].astype(str) + '-01')
     df = df.sort_values(['Артикул', 'Склад', 'Дата']).reset_index(drop=True)
     return df
 
+
+def load_monthly_data(filepath='итог_по_месяцу.xlsx'):
+    """Месячный итог из Parquet-хранилища анализа; если его нет — из Excel-файла filepath."""
+    df = artifact_store.read_or_excel('итог_по_месяцу', filepath, categories=False)
+    return prepare_monthly_data(df)
+
+
+def lagged_means(df, windows, column='Всего_продано', keys=SERIES_KEYS):
+    """
+    Среднее column за предыдущие window строк своего ряда (без текущей) для каждого окна:
+    {окно: массив по строкам df}. Совпадает с groupby(keys)[column].transform(lambda x:
+    x.rolling(window, min_periods=1).mean().shift(1)): у первой строки ряда и у строк
+    с пустым ключом — NaN, пустые значения в среднее не входят.
+    """
+    codes = df.groupby(keys, sort=False, observed=True, dropna=True).ngroup().to_numpy()
+    # Строки каждого ряда подряд, внутри ряда — в исходном порядке
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    values = df[column].to_numpy(dtype=np.float64)[order]
+    is_valid = ~np.isnan(values)
+
+    n = len(values)
+    sums = np.zeros(n + 1)
+    np.cumsum(np.where(is_valid, values, 0.0), out=sums[1:])
+    counts = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(is_valid, out=counts[1:])
+
+    position = np.arange(n)
+    is_start = np.ones(n, dtype=bool)
+    is_start[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    series_start = np.maximum.accumulate(np.where(is_start, position, 0))
+
+    result = {}
+    for window in windows:
+        low = np.maximum(series_start, position - window)
+        count = counts[position] - counts[low]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, (sums[position] - sums[low]) / count, np.nan)
+        mean[sorted_codes < 0] = np.nan
+        unsorted = np.empty(n)
+        unsorted[order] = mean
+        result[window] = unsorted
+    return result
+
+
 def find_sales_spikes(df, window=3, spike_factor=1.5):
     df = df.copy()
-    df['Среднее_последних_месяцев'] = df.groupby(['Артикул', 'Склад'])['Всего_продано']\
-        .transform(lambda x: x.rolling(window=window, min_periods=1).mean().shift(1))
+    df['Среднее_последних_месяцев'] = lagged_means(df, [window])[window]
     df['Всплеск'] = df['Всего_продано'] > (df['Среднее_последних_месяцев'] * spike_factor)
-    df['Всплеск'] = df['Всплеск'].fillna(False)
     return df
 
-def prepare_spike_analysis(filepath='итог_по_месяцу.xlsx', window=3, spike_factor=1.5):
-    df = load_monthly_data(filepath)
-    df_spikes = find_sales_spikes(df, window, spike_factor)
-    return df_spikes
+
+def find_sales_spikes_grid(df, windows=(3,), factors=(1.5,)):
+    """
+    Всплески для всех сочетаний окна и коэффициента одной таблицей: строки df повторяются
+    для каждого варианта, вариант указан в колонках Окно и Коэффициент.
+    Средние считаются один раз на окно и общие для всех коэффициентов.
+    """
+    means = lagged_means(df, windows)
+    sales = df['Всего_продано'].to_numpy(dtype=np.float64)
+    variants = [(window, factor) for window in windows for factor in factors]
+
+    result = df.take(np.tile(np.arange(len(df)), len(variants))).reset_index(drop=True)
+    result['Окно'] = np.repeat([window for window, _ in variants], len(df))
+    result['Коэффициент'] = np.repeat([factor for _, factor in variants], len(df))
+    mean = np.concatenate([means[window] for window, _ in variants]) if variants else np.empty(0)
+    result['Среднее_последних_месяцев'] = mean
+    result['Всплеск'] = np.tile(sales, len(variants)) > mean * result['Коэффициент'].to_numpy()
+    return result
+
+
+def find_spikes(df, windows=(3,), factors=(1.5,), method='mean', threshold=None):
+    """
+    Всплески подготовленного месячного итога df. method='mean' — правило «среднее за window месяцев
+    × коэффициент» по сетке windows × factors; иначе — детектор spike_detectors.DETECTORS[method]
+    для каждого окна из windows с порогом threshold (по умолчанию — порогом детектора).
+    """
+    if method == 'mean':
+        return find_sales_spikes_grid(df, windows, factors)
+    return spike_detectors.detect_spikes(df, method, windows, threshold)
+
+
+def prepare_spike_analysis(filepath='итог_по_месяцу.xlsx', windows=(3,), factors=(1.5,), method='mean',
+                           threshold=None):
+    """Всплески месячного итога из хранилища (или filepath), параметры — как у find_spikes."""
+    return find_spikes(load_monthly_data(filepath), windows, factors, method, threshold)
+
 
 def save_analysis(df, output_path='всплески_продаж1.xlsx'):
     """
@@ -26,6 +123,20 @@ def save_analysis(df, output_path='всплески_продаж1.xlsx'):
     df.to_excel(output_path, index=False)
     print(f'Результат сохранён в файл: {output_path}')
 
+
 if __name__ == '__main__':
-    df_spikes = prepare_spike_analysis()
-    save_analysis(df_spikes)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Поиск всплесков продаж по месячному итогу')
+    parser.add_argument('--method', choices=['mean', *spike_detectors.DETECTORS], default='mean',
+                        help='правило поиска: mean — среднее × коэффициент, mad — медиана/MAD, '
+                             'ewma — z-оценка по EWMA, seasonal — тот же месяц прошлых лет')
+    parser.add_argument('--windows', type=int, nargs='+', default=[3],
+                        help='окна, месяцев (для seasonal — лет); все варианты пишутся в одну таблицу')
+    parser.add_argument('--factors', type=float, nargs='+', default=[1.5],
+                        help='для mean: во сколько раз продажи должны превысить среднее')
+    parser.add_argument('--threshold', type=float,
+                        help='для устойчивых детекторов: порог оценки (по умолчанию — порог детектора)')
+    parser.add_argument('--output', default='всплески_продаж1.xlsx', help='файл результата')
+    args = parser.parse_args()
+    df_spikes = prepare_spike_analysis(windows=args.windows, factors=args.factors, method=args.method,
+                                       threshold=args.threshold)
+    save_analysis(df_spikes, args.output)
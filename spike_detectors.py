@@ -0,0 +1,165 @@
+"""
+Устойчивые детекторы всплесков продаж на матрице ряд × месяц.
+
+Месячные продажи (Всего_продано) раскладываются в плотную NumPy-матрицу: строка —
+ряд (Артикул, Склад), столбец — календарный месяц, месяцы без строки итога — NaN
+(товара не было в снимках, это не ноль продаж). Базовый уровень каждого месяца
+считается только по предыдущим месяцам ряда, сразу для всех рядов:
+
+- mad — скользящая медиана и медианное абсолютное отклонение (MAD) за window месяцев;
+  оценка — (продажи − медиана) / (1.4826 · MAD). Один случайный пик не сдвигает медиану,
+  поэтому правило меньше шумит на товарах с редким спросом;
+- ewma — экспоненциально взвешенные среднее и дисперсия с периодом window месяцев;
+  оценка — z-оценка продаж относительно них;
+- seasonal — среднее того же календарного месяца за window предыдущих лет;
+  оценка — превышение в единицах пуассоновского разброса √базы.
+
+Разброс снизу ограничен min_scale штук: у рядов с постоянными продажами MAD и дисперсия
+нулевые, и любое отклонение на единицу иначе стало бы всплеском. Всплеск — оценка выше порога.
+"""
+import numpy as np
+
+SERIES_KEYS = ['Артикул', 'Склад']
+MAD_SCALE = 1.4826
+CHUNK_CELLS = 20_000_000
+
+
+def to_matrix(df, column='Всего_продано', keys=SERIES_KEYS):
+    """
+    Плотная матрица ряд × месяц по колонке column и координаты строк df в ней:
+    (матрица, номер ряда, номер месяца). Месяцы отсчитываются от самого раннего в df,
+    у строк с пустым ключом номер ряда −1.
+    """
+    rows = df.groupby(keys, sort=False, observed=True, dropna=True).ngroup().to_numpy()
+    months = (df['Год'].to_numpy(dtype=np.int64) * 12 + df['Месяц'].to_numpy(dtype=np.int64) - 1)
+    if len(months):
+        months = months - months.min()
+
+    n_series = int(rows.max()) + 1 if len(rows) else 0
+    n_months = int(months.max()) + 1 if len(months) else 0
+    matrix = np.full((n_series, n_months), np.nan)
+    is_keyed = rows >= 0
+    matrix[rows[is_keyed], months[is_keyed]] = df[column].to_numpy(dtype=np.float64)[is_keyed]
+    return matrix, rows, months
+
+
+def _lagged_windows(matrix, window):
+    """Для каждого месяца — значения window предыдущих месяцев ряда: массив ряд × месяц × window."""
+    padded = np.concatenate([np.full((matrix.shape[0], window), np.nan), matrix], axis=1)
+    return np.lib.stride_tricks.sliding_window_view(padded, window, axis=1)[:, :matrix.shape[1]]
+
+
+def _nanmedian(values):
+    """Медиана по последней оси без учёта NaN (NaN, если значений нет); быстрее np.nanmedian."""
+    ordered = np.sort(values, axis=-1)
+    count = (~np.isnan(ordered)).sum(axis=-1)
+    low = np.take_along_axis(ordered, np.maximum(count - 1, 0)[..., None] // 2, axis=-1)[..., 0]
+    high = np.take_along_axis(ordered, (count // 2)[..., None], axis=-1)[..., 0]
+    return np.where(count > 0, (low + high) / 2, np.nan), count
+
+
+def rolling_mad(matrix, window=6, min_periods=3, min_scale=1.0):
+    """Медиана предыдущих window месяцев и оценка (x − медиана) / (1.4826 · MAD)."""
+    baseline = np.full(matrix.shape, np.nan)
+    scale = np.full(matrix.shape, np.nan)
+    # Окна разворачиваются в память порциями рядов, чтобы не держать series × months × window целиком
+    step = max(1, CHUNK_CELLS // max(1, matrix.shape[1] * window))
+    for start in range(0, matrix.shape[0], step):
+        windows = _lagged_windows(matrix[start:start + step], window)
+        median, count = _nanmedian(windows)
+        mad, _ = _nanmedian(np.abs(windows - median[..., None]))
+        enough = count >= min_periods
+        baseline[start:start + step] = np.where(enough, median, np.nan)
+        scale[start:start + step] = np.where(enough, MAD_SCALE * mad, np.nan)
+    return baseline, (matrix - baseline) / np.maximum(scale, min_scale)
+
+
+def ewma(matrix, window=6, min_periods=3, min_scale=1.0):
+    """
+    Экспоненциально взвешенные среднее и стандартное отклонение (alpha = 2 / (window + 1))
+    по предыдущим месяцам и z-оценка продаж. Цикл идёт по месяцам, каждый шаг — по всем рядам сразу;
+    пропущенные месяцы не меняют состояние ряда.
+    """
+    alpha = 2 / (window + 1)
+    n_series, n_months = matrix.shape
+    mean = np.full(n_series, np.nan)
+    variance = np.zeros(n_series)
+    seen = np.zeros(n_series, dtype=np.int64)
+    baseline = np.full(matrix.shape, np.nan)
+    scale = np.full(matrix.shape, np.nan)
+
+    for month in range(n_months):
+        enough = seen >= min_periods
+        baseline[:, month] = np.where(enough, mean, np.nan)
+        scale[:, month] = np.where(enough, np.sqrt(variance), np.nan)
+
+        values = matrix[:, month]
+        has_value = ~np.isnan(values)
+        is_first = has_value & (seen == 0)
+        diff = np.where(has_value & ~is_first, values - mean, 0.0)
+        increment = alpha * diff
+        mean = np.where(is_first, values, mean + increment)
+        variance = np.where(has_value, (1 - alpha) * (variance + diff * increment), variance)
+        seen += has_value
+    return baseline, (matrix - baseline) / np.maximum(scale, min_scale)
+
+
+def seasonal(matrix, window=2, min_periods=1, min_scale=1.0):
+    """Среднее того же месяца за window предыдущих лет и превышение в единицах √базы."""
+    n_series, n_months = matrix.shape
+    total = np.zeros(matrix.shape)
+    count = np.zeros(matrix.shape, dtype=np.int64)
+    for years in range(1, window + 1):
+        lag = 12 * years
+        if lag >= n_months:
+            break
+        previous = matrix[:, :-lag]
+        has_value = ~np.isnan(previous)
+        total[:, lag:] += np.where(has_value, previous, 0.0)
+        count[:, lag:] += has_value
+    with np.errstate(invalid='ignore', divide='ignore'):
+        baseline = np.where(count >= min_periods, total / count, np.nan)
+    return baseline, (matrix - baseline) / np.maximum(np.sqrt(baseline), min_scale)
+
+
+# Детектор: (функция, порог по умолчанию)
+DETECTORS = {
+    'mad': (rolling_mad, 3.5),
+    'ewma': (ewma, 3.0),
+    'seasonal': (seasonal, 3.0),
+}
+
+
+def detect_spikes(df, method='mad', windows=(6,), threshold=None, min_periods=None, min_scale=1.0):
+    """
+    Всплески месячного итога df детектором method для каждого окна из windows одной таблицей:
+    строки df повторяются для каждого окна с колонками Метод, Окно, Порог,
+    Базовый_уровень, Оценка и Всплеск.
+    """
+    if method not in DETECTORS:
+        raise ValueError(f'Неизвестный детектор всплесков {method}: доступны {", ".join(DETECTORS)}')
+    detector, default_threshold = DETECTORS[method]
+    threshold = default_threshold if threshold is None else threshold
+    options = {'min_scale': min_scale}
+    if min_periods is not None:
+        options['min_periods'] = min_periods
+
+    matrix, rows, months = to_matrix(df)
+    is_keyed = rows >= 0
+    baselines, scores = [], []
+    for window in windows:
+        baseline, score = detector(matrix, window=window, **options)
+        for result, values in [(baselines, baseline), (scores, score)]:
+            column = np.full(len(df), np.nan)
+            column[is_keyed] = values[rows[is_keyed], months[is_keyed]]
+            result.append(column)
+
+    result = df.take(np.tile(np.arange(len(df)), len(windows))).reset_index(drop=True)
+    result['Метод'] = method
+    result['Окно'] = np.repeat(list(windows), len(df))
+    result['Порог'] = threshold
+    result['Базовый_уровень'] = np.concatenate(baselines) if baselines else np.empty(0)
+    result['Оценка'] = np.concatenate(scores) if scores else np.empty(0)
+    result['Всплеск'] = result['Оценка'].to_numpy() > threshold
+    return result
+
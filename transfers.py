@@ -0,0 +1,148 @@
+"""
+Поиск перемещений товара между складами и их исключение из продаж и пополнений.
+
+Перемещение — уменьшение остатка на одном складе и такое же увеличение на другом
+(в тот же день или с задержкой в пути). Оно не является ни продажей, ни пополнением,
+поэтому соответствующие строки дневных данных обнуляются по ключу
+(Дата, Артикул, Склад) одним векторным проходом.
+"""
+import numpy as np
+import pandas as pd
+
+import profiling
+
+MOVE_COLUMNS = ['Дата', 'Артикул', 'Склад_откуда', 'Склад_куда', 'Кол-во']
+LAGGED_MOVE_COLUMNS = ['Дата_отправки', 'Дата', 'Артикул', 'Склад_откуда', 'Склад_куда',
+                       'Кол-во', 'Кол-во_отправлено']
+ARRIVAL_KEY = ['Дата', 'Артикул', 'Склад_куда']
+SHIPMENT_KEY = ['Дата_отправки', 'Артикул', 'Склад_откуда']
+
+
+def find_same_day_transfers(df_daily):
+    """Пары «пополнение на одном складе — списание на другом» с одинаковыми датой, артикулом и количеством."""
+    restock_rows = df_daily.loc[df_daily['diff_qty'] > 0, ['Дата', 'Артикул', 'Склад', 'diff_qty']]
+    restock_rows = restock_rows.rename(columns={'Склад': 'Склад_куда', 'diff_qty': 'Кол-во'})
+
+    sold_rows = df_daily.loc[df_daily['diff_qty'] < 0, ['Дата', 'Артикул', 'Склад', 'diff_qty']]
+    sold_rows = sold_rows.rename(columns={'Склад': 'Склад_откуда', 'diff_qty': 'Кол-во'})
+    sold_rows['Кол-во'] = -sold_rows['Кол-во']
+
+    moves = pd.merge(restock_rows, sold_rows, on=['Дата', 'Артикул', 'Кол-во'], how='inner')
+    return moves[moves['Склад_куда'] != moves['Склад_откуда']]
+
+
+def find_lagged_transfers(df_daily, max_lag_days, qty_tolerance=0):
+    """
+    Перемещения с задержкой в пути: пополнение на складе-получателе сопоставляется
+    с ближайшим предшествующим (не более чем на max_lag_days дней) списанием того же
+    артикула на любом другом складе, если количества отличаются не больше чем
+    на qty_tolerance (в целых единицах товара).
+
+    Сопоставление — одно соединение по (Артикул, Кол-во, корзина дат) сразу для всех
+    пар складов: даты делятся на корзины шириной max_lag_days + 1 день, и подходящее
+    списание лежит в корзине пополнения или в предыдущей. Поэтому время растёт
+    с числом строк и кандидатов в окне задержки, но не с числом складов.
+    Каждое пополнение и каждое списание используются не более одного раза:
+    предпочтение отдаётся меньшему расхождению количества, затем меньшей задержке
+    (см. _claim_pairs).
+    """
+    arrivals = df_daily.loc[df_daily['diff_qty'] > 0, ['Дата', 'Артикул', 'Склад', 'diff_qty']]
+    arrivals = arrivals.rename(columns={'Склад': 'Склад_куда', 'diff_qty': 'Кол-во'})
+
+    shipments = df_daily.loc[df_daily['diff_qty'] < 0, ['Дата', 'Артикул', 'Склад', 'diff_qty']]
+    shipments = shipments.rename(columns={'Дата': 'Дата_отправки', 'Склад': 'Склад_откуда',
+                                          'diff_qty': 'Кол-во_отправлено'})
+    shipments['Кол-во_отправлено'] = -shipments['Кол-во_отправлено']
+
+    width = int(max_lag_days) + 1
+    epoch = pd.Timestamp('1970-01-01')
+    arrivals['_корзина'] = (arrivals['Дата'] - epoch).dt.days // width
+    shipment_bucket = (shipments['Дата_отправки'] - epoch).dt.days // width
+    # Каждое списание доступно пополнениям своей и следующей корзины
+    shipments = pd.concat([shipments.assign(_корзина=shipment_bucket),
+                           shipments.assign(_корзина=shipment_bucket + 1)], ignore_index=True)
+
+    tolerance = pd.Timedelta(days=max_lag_days)
+    offsets = sorted(range(-int(qty_tolerance), int(qty_tolerance) + 1), key=abs)
+
+    parts = []
+    for offset in offsets:
+        matched = arrivals.merge(
+            shipments.assign(**{'Кол-во': shipments['Кол-во_отправлено'] + offset}),
+            on=['Артикул', 'Кол-во', '_корзина']
+        )
+        lag = matched['Дата'] - matched['Дата_отправки']
+        keep = (lag >= pd.Timedelta(0)) & (lag <= tolerance) & (matched['Склад_откуда'] != matched['Склад_куда'])
+        parts.append(matched[keep.to_numpy()])
+
+    candidates = pd.concat(parts, ignore_index=True)
+    candidates = (
+        candidates.assign(_qty_gap=(candidates['Кол-во'] - candidates['Кол-во_отправлено']).abs(),
+                          _lag=candidates['Дата'] - candidates['Дата_отправки'])
+        .sort_values(['_qty_gap', '_lag', 'Дата', 'Склад_куда', 'Склад_откуда'], kind='stable')
+        .reset_index(drop=True)
+    )
+    moves = _claim_pairs(candidates).sort_values(['Дата', 'Артикул', 'Склад_куда'], kind='stable')
+    return moves[LAGGED_MOVE_COLUMNS].reset_index(drop=True)
+
+
+def _claim_pairs(candidates):
+    """
+    Пары «пополнение — списание» из кандидатов, упорядоченных по предпочтению; каждое пополнение
+    и каждое списание — не больше одного раза. За проход каждое пополнение выбирает лучшее списание,
+    а каждое списание — лучшее из выбравших его пополнений; занятые пополнения и списания убираются
+    из кандидатов, и проход повторяется по оставшимся. Так пополнение, уступившее лучшее списание
+    другому, получает следующее свободное, а не теряется. Лучший из оставшихся кандидатов
+    принимается на каждом проходе, поэтому проходов не больше числа пар, а обычно — единицы.
+    """
+    arrival = candidates.groupby(ARRIVAL_KEY, sort=False, observed=True, dropna=False).ngroup().to_numpy()
+    shipment = candidates.groupby(SHIPMENT_KEY, sort=False, observed=True, dropna=False).ngroup().to_numpy()
+    is_free = np.ones(len(candidates), dtype=bool)
+    claimed = []
+    while is_free.any():
+        free = np.flatnonzero(is_free)
+        _, first = np.unique(arrival[free], return_index=True)
+        best = np.sort(free[first])
+        _, first = np.unique(shipment[best], return_index=True)
+        accepted = best[first]
+        claimed.append(accepted)
+        is_free &= ~np.isin(arrival, arrival[accepted]) & ~np.isin(shipment, shipment[accepted])
+    return candidates.take(np.sort(np.concatenate(claimed)) if claimed else [])
+
+
+def _keys_isin(df, keys):
+    """Маска строк df, чей ключ (Дата, Артикул, Склад) входит в keys."""
+    index = pd.MultiIndex.from_frame(df[['Дата', 'Артикул', 'Склад']])
+    return index.isin(pd.MultiIndex.from_frame(keys.drop_duplicates()))
+
+
+def apply_transfers(df_daily, moves):
+    """Обнуляет 'Пополнение' на складе-получателе и 'Продано' на складе-отправителе."""
+    if moves.empty:
+        return df_daily
+
+    # У перемещений с задержкой списание датировано днём отправки
+    sold_date = 'Дата_отправки' if 'Дата_отправки' in moves.columns else 'Дата'
+    restock_keys = moves[['Дата', 'Артикул', 'Склад_куда']].set_axis(['Дата', 'Артикул', 'Склад'], axis=1)
+    sold_keys = moves[[sold_date, 'Артикул', 'Склад_откуда']].set_axis(['Дата', 'Артикул', 'Склад'], axis=1)
+
+    df_daily.loc[_keys_isin(df_daily, restock_keys), 'Пополнение'] = 0
+    df_daily.loc[_keys_isin(df_daily, sold_keys), 'Продано'] = 0
+    return df_daily
+
+
+@profiling.traced
+def reconcile_transfers(df_daily, max_lag_days=0, qty_tolerance=0):
+    """
+    Находит перемещения в дневных данных (с колонками diff_qty, Продано, Пополнение)
+    и исключает их из продаж и пополнений. Возвращает (df_daily, DataFrame перемещений).
+
+    При max_lag_days=0 и qty_tolerance=0 ищутся только перемещения в один день
+    с точным совпадением количества.
+    """
+    if max_lag_days == 0 and qty_tolerance == 0:
+        moves = find_same_day_transfers(df_daily)[MOVE_COLUMNS]
+    else:
+        moves = find_lagged_transfers(df_daily, max_lag_days, qty_tolerance)
+    df_daily = apply_transfers(df_daily, moves)
+    return df_daily, moves
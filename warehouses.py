@@ -0,0 +1,98 @@
+"""
+Реестр складов: откуда брать снимки, в какой раскладке они выгружены и как называется склад.
+
+Реестр хранится в warehouses.json:
+
+    {
+      "layouts": {
+        "со_штрихкодом": {"first_row": 5, "columns": {"Артикул": 6}}
+      },
+      "warehouses": [
+        {"name": "Москва", "folder": "data/moscow"},
+        {"name": "Новосибирск", "folder": "data/novosibirsk", "layout": "со_штрихкодом"}
+      ]
+    }
+
+Раскладка (layout) — вариант excel_readers.DEFAULT_LAYOUT: в реестре задаются только
+отличающиеся ключи, колонки дополняют колонки по умолчанию. У одного склада может быть
+несколько папок (несколько записей с одним именем), например, старые и новые выгрузки
+в разных раскладках. Новый склад добавляется записью в реестре без изменения кода.
+"""
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import excel_readers
+
+CONFIG_PATH = 'warehouses.json'
+
+# Используется, если файла реестра нет
+DEFAULT_WAREHOUSES = [
+    {'name': 'Москва', 'folder': 'data/moscow'},
+    {'name': 'Хабаровск', 'folder': 'data/khabarovsk'},
+]
+
+
+def resolve_layout(overrides):
+    """Раскладка по умолчанию с заменёнными ключами; колонки объединяются с колонками по умолчанию."""
+    layout = {**excel_readers.DEFAULT_LAYOUT, **overrides}
+    layout['columns'] = {**excel_readers.DEFAULT_LAYOUT['columns'], **overrides.get('columns', {})}
+    layout['date_cell'] = tuple(layout['date_cell'])
+    unknown = set(layout) - set(excel_readers.DEFAULT_LAYOUT)
+    if unknown:
+        raise ValueError(f'Неизвестные ключи раскладки: {", ".join(sorted(unknown))}')
+    return layout
+
+
+def layout_key(layout):
+    """Короткий отпечаток раскладки: при её смене разобранные снимки устаревают."""
+    data = json.dumps(layout, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()[:12]
+
+
+def load_warehouses(path=CONFIG_PATH):
+    """
+    Список складов реестра: словари с ключами name, folder и layout (готовая раскладка).
+    Ошибки в реестре — ValueError с указанием записи.
+    """
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+    else:
+        logging.info(f'Реестр складов {path} не найден, используются склады по умолчанию')
+        config = {'warehouses': DEFAULT_WAREHOUSES}
+
+    layouts = {name: resolve_layout(overrides) for name, overrides in config.get('layouts', {}).items()}
+    warehouses = []
+    for i, entry in enumerate(config.get('warehouses', [])):
+        if not entry.get('name') or not entry.get('folder'):
+            raise ValueError(f'Запись {i} реестра складов {path}: нужны поля name и folder')
+        layout_name = entry.get('layout')
+        if layout_name is not None and layout_name not in layouts:
+            raise ValueError(f'Склад {entry["name"]}: раскладка {layout_name} не описана в {path}')
+        warehouses.append({
+            'name': entry['name'],
+            'folder': entry['folder'],
+            'layout': layouts[layout_name] if layout_name else excel_readers.DEFAULT_LAYOUT,
+        })
+    if not warehouses:
+        raise ValueError(f'В реестре складов {path} нет ни одного склада')
+    return warehouses
+
+
+def snapshot_tasks(warehouses, list_files):
+    """
+    Задачи чтения (путь, склад, раскладка) по всем складам в порядке реестра.
+    Папки складов просматриваются параллельно — на сетевых дисках это заметная часть времени.
+    """
+    with ThreadPoolExecutor(max_workers=min(8, len(warehouses)) or 1) as executor:
+        listings = list(executor.map(lambda w: list_files(w['folder']), warehouses))
+
+    tasks = []
+    for warehouse, files in zip(warehouses, listings):
+        if not files:
+            logging.warning(f'Нет данных в папке: {warehouse["folder"]} (склад {warehouse["name"]})')
+        tasks.extend((path, warehouse['name'], warehouse['layout']) for path in files)
+    return tasks